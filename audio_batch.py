@@ -0,0 +1,80 @@
+##Batch transcription of recorded kiosk audio, also usable as a load test without a microphone.
+##Clips (a WAV file or a directory of them) are transcribed concurrently by a pool of recognizers and
+##each transcript is answered by the app's answer pipeline (speech_recognition_package/answer_pipeline.py)
+##as the first question of a new conversation, like cache_warmup.py.
+##Run with: python audio_batch.py clips/ [--pool-size 4] [--concurrency 4] [--transcribe-only] [--no-avatar]
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.cognitiveservices.speech as speechsdk
+import streamlit as st
+
+import cache_warmup
+import variables
+from speech_recognition_package.answer_pipeline import answer_offline
+from speech_recognition_package.audio_input import iter_audio_files, transcribe_many
+from variables import recognition_pool_size
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def run(path, pool_size=recognition_pool_size, concurrency=4, answer=True, warm_avatar=True,
+        searchtype="Elser"):
+    speech_config = speechsdk.SpeechConfig(subscription=st.secrets['speech_key'],
+                                           region=st.secrets['speech_region'])
+    speech_config.speech_recognition_language = "en-US"
+
+    clips = iter_audio_files(path)
+    start_time = time.time()
+    print(f"Transcribing {len(clips)} clips with {pool_size} recognizers")
+
+    on_result = None
+    pipeline = None
+    if answer:
+        es, client = cache_warmup.create_clients()
+        pipeline = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="pipeline")
+
+        # Answers run on their own pool so recognizers are freed for the next clip right away
+        def on_result(result):
+            return pipeline.submit(answer_offline, es, client, result['transcript'], searchtype, warm_avatar)
+
+    results = transcribe_many(speech_config, clips, pool_size, on_result)
+
+    print(f"{'recognize':>10}{'first':>8}{'answer':>8}  clip / transcript")
+    for result in results:
+        answer_cost = result['answer'].result() if 'answer' in result else None
+        result['answer'] = answer_cost
+        first = f"{result['first_result_seconds']:.1f}" if result['first_result_seconds'] is not None else "-"
+        answered = f"{answer_cost['seconds']:.1f}" if answer_cost else "-"
+        error = result['error'] or (answer_cost or {}).get('error')
+        print(f"{result['seconds'] or 0:>10.1f}{first:>8}{answered:>8}  {result['source']}: {result['transcript']}"
+              + (f"  ERROR: {error}" if error else ""))
+
+    if pipeline is not None:
+        pipeline.shutdown()
+        variables.cache.flush()
+
+    latencies = [r['seconds'] for r in results if r['seconds'] is not None and not r['error']]
+    print(f"Done in {time.time() - start_time:.1f}s: {len(latencies)} of {len(results)} clips transcribed, "
+          f"recognition p50 {_percentile(latencies, 0.5):.1f}s, p95 {_percentile(latencies, 0.95):.1f}s, "
+          f"mean {statistics.fmean(latencies) if latencies else 0.0:.1f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcribe recorded questions and run them through search/answer")
+    parser.add_argument("path", help="a WAV file or a directory of WAV clips")
+    parser.add_argument("--pool-size", type=int, default=recognition_pool_size, help="concurrent recognizers")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent search/answer pipelines")
+    parser.add_argument("--searchtype", default="Elser")
+    parser.add_argument("--transcribe-only", action="store_true", help="skip search and answers")
+    parser.add_argument("--no-avatar", action="store_true", help="skip avatar summaries and videos")
+    args = parser.parse_args()
+
+    run(args.path, args.pool_size, args.concurrency, not args.transcribe_only, not args.no_avatar, args.searchtype)
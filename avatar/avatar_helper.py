@@ -1,15 +1,32 @@
+import hashlib
 import json
 import logging
+import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from utils.text_segmentation import SENTENCE_BOUNDARY
 from variables import SERVICE_HOST, NAME, DESCRIPTION, SERVICE_REGION, SUBSCRIPTION_KEY
+from variables import avatar_voice, avatar_character, avatar_style, avatar_video_format
+from variables import avatar_video_cache_file, avatar_video_cache_dir, avatar_video_cache_ttl
+from variables import avatar_poll_initial_interval, avatar_poll_max_interval, avatar_poll_backoff, \
+    avatar_poll_deadline
+from variables import avatar_segment_max_chars
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO,  # set to logging.DEBUG for verbose output
         format="[%(asctime)s] %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p %Z")
 logger = logging.getLogger(__name__)
 
+# Pooled session so submits and status polls reuse TLS connections to the speech service
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 
 
 def submit_synthesis(response_text):
@@ -24,7 +41,7 @@ def submit_synthesis(response_text):
         'description': DESCRIPTION,
         "textType": "PlainText",
         'synthesisConfig': {
-            "voice": "en-US-JennyNeural",
+            "voice": avatar_voice,
         },
         # Replace with your custom voice name and deployment ID if you want to use custom voice.
         # Multiple voices are supported, the mixture of custom voices and platform voices is allowed.
@@ -39,16 +56,16 @@ def submit_synthesis(response_text):
         ],
         "properties": {
             "customized": False, # set to True if you want to use customized avatar
-            "talkingAvatarCharacter": "lisa",  # talking avatar character
-            "talkingAvatarStyle": "casual-sitting",  # talking avatar style, required for prebuilt avatar, optional for custom avatar, https://learn.microsoft.com/en-us/azure/ai-services/speech-service/text-to-speech-avatar/avatar-gestures-with-ssml
-            "videoFormat": "mp4",  # mp4 or webm, webm is required for transparent background
+            "talkingAvatarCharacter": avatar_character,  # talking avatar character
+            "talkingAvatarStyle": avatar_style,  # talking avatar style, required for prebuilt avatar, optional for custom avatar, https://learn.microsoft.com/en-us/azure/ai-services/speech-service/text-to-speech-avatar/avatar-gestures-with-ssml
+            "videoFormat": avatar_video_format,  # mp4 or webm, webm is required for transparent background
             "videoCodec": "h264",  # hevc, h264 or vp9, vp9 is required for transparent background; default is hevc
             "subtitleType": "soft_embedded",
             "backgroundColor": "#FFFFFFFF", # background color in RGBA format, default is white; can be set to 'transparent' for transparent background
         }
     }
 
-    response = requests.post(url, json.dumps(payload), headers=header)
+    response = session.post(url, json.dumps(payload), headers=header)
     if response.status_code < 400:
         print('Batch avatar synthesis job submitted successfully')
         logger.info('Batch avatar synthesis job submitted successfully')
@@ -64,7 +81,7 @@ def get_synthesis(job_id):
     header = {
         'Ocp-Apim-Subscription-Key': SUBSCRIPTION_KEY
     }
-    response = requests.get(url, headers=header, timeout=120)
+    response = session.get(url, headers=header, timeout=120)
     if response.status_code < 400:
         url = None
         print('Get batch synthesis job successfully')
@@ -86,7 +103,7 @@ def list_synthesis_jobs(skip: int = 0, top: int = 100):
     header = {
         'Ocp-Apim-Subscription-Key': SUBSCRIPTION_KEY
     }
-    response = requests.get(url, headers=header)
+    response = session.get(url, headers=header)
     if response.status_code < 400:
         print(f'List batch synthesis jobs successfully, got {len(response.json()["values"])} jobs')
         logger.info(f'List batch synthesis jobs successfully, got {len(response.json()["values"])} jobs')
@@ -96,3 +113,238 @@ def list_synthesis_jobs(skip: int = 0, top: int = 100):
         print(f'Failed to list batch synthesis jobs: {response.text}')
         logger.error(f'Failed to list batch synthesis jobs: {response.text}')
 
+
+def avatar_cache_key(response_text):
+    """
+    Hash of the normalized response text and every setting that changes the rendered video.
+    """
+    normalized = " ".join(response_text.split()).lower()
+    key_parts = [normalized, avatar_voice, avatar_character, avatar_style, avatar_video_format]
+    return hashlib.sha256("\x1f".join(key_parts).encode("utf-8")).hexdigest()
+
+
+class AvatarVideoCache:
+    """
+    Maps avatar_cache_key(response text) to a finished video URL (or local copy), persisted as JSON.
+    Entries expire after ttl seconds, which should not exceed how long the service keeps outputs.
+    """
+
+    def __init__(self, cache_file, ttl, video_dir=None):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.video_dir = video_dir
+        self.lock = threading.Lock()
+        self.entries = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.entries = json.load(f)
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def get(self, response_text):
+        key = avatar_cache_key(response_text)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            # Local copies outlive the service retention, remote URLs do not
+            if entry.get('path') and os.path.exists(entry['path']):
+                return entry['path']
+            if entry['expires'] > time.time():
+                return entry['url']
+            del self.entries[key]
+            self._save()
+            return None
+
+    def put(self, response_text, url):
+        key = avatar_cache_key(response_text)
+        entry = {'url': url, 'expires': time.time() + self.ttl}
+        if self.video_dir:
+            entry['path'] = download_video(url, os.path.join(self.video_dir, f"{key}.{avatar_video_format}"))
+        with self.lock:
+            self.entries[key] = entry
+            self._save()
+        return entry.get('path') or url
+
+
+def download_video(url, path):
+    """
+    Download a finished avatar video to path. Returns the path, or None if the download failed.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    response = session.get(url, stream=True, timeout=120)
+    if response.status_code >= 400:
+        logger.error(f'Failed to download avatar video: {response.status_code}')
+        return None
+    with open(path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=1 << 20):
+            f.write(chunk)
+    return path
+
+
+class SynthesisPoller:
+    """
+    Tracks outstanding batch avatar synthesis jobs on one background thread.
+
+    Each job is polled with its own interval: reset to initial_interval whenever the job's status
+    changes (e.g. NotStarted -> Running) and multiplied by backoff while it stays the same, capped
+    at max_interval. Jobs that are not finished after deadline seconds resolve as 'TimedOut'.
+    track() returns a Future resolving to a dict with status, url and submit-to-ready latency.
+    """
+
+    def __init__(self, initial_interval=1.0, max_interval=10.0, backoff=1.5, deadline=600):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.deadline = deadline
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def track(self, job_id, submitted_at=None):
+        future = Future()
+        now = time.time()
+        with self.condition:
+            self.jobs[job_id] = {
+                'future': future,
+                'submitted_at': submitted_at or now,
+                'status': None,
+                'interval': self.initial_interval,
+                'next_poll': now + self.initial_interval
+            }
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="avatar-synthesis-poller", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.jobs:
+                    self.thread = None
+                    return
+                now = time.time()
+                next_poll = min(job['next_poll'] for job in self.jobs.values())
+                if next_poll > now:
+                    self.condition.wait(next_poll - now)
+                    continue
+                due = [job_id for job_id, job in self.jobs.items() if job['next_poll'] <= now]
+
+            for job_id in due:
+                self._poll(job_id)
+
+    @property
+    def result_timeout(self):
+        # Upper bound for waiting on a tracked Future: the poll deadline plus one max interval and slack
+        return self.deadline + self.max_interval + 30
+
+    def _poll(self, job_id):
+        job = self.jobs[job_id]
+        try:
+            result = get_synthesis(job_id)
+        except requests.RequestException as e:
+            logger.error(f'Failed to poll batch synthesis job {job_id}: {e}')
+            result = None
+        except Exception as e:
+            # An unexpected response (missing keys, bad JSON) fails only this job, not the poller thread
+            logger.error(f'Batch synthesis job {job_id} failed while polling: {e}')
+            self._finish(job_id, job, 'Failed', None)
+            return
+        status, url = result if result else (job['status'], None)
+
+        now = time.time()
+        latency = now - job['submitted_at']
+        if status in ('Succeeded', 'Failed') or latency > self.deadline:
+            if status not in ('Succeeded', 'Failed'):
+                status = 'TimedOut'
+            logger.info(f'Batch synthesis job {job_id} {status} after {latency:.1f}s')
+            self._finish(job_id, job, status, url)
+            return
+
+        if status != job['status']:
+            job['interval'] = self.initial_interval
+        else:
+            job['interval'] = min(self.max_interval, job['interval'] * self.backoff)
+        job['status'] = status
+        job['next_poll'] = now + job['interval']
+        logger.info(f'Batch synthesis job {job_id} is {status}, next check in {job["interval"]:.1f}s')
+
+    def _finish(self, job_id, job, status, url):
+        with self.condition:
+            self.jobs.pop(job_id, None)
+        job['future'].set_result({'job_id': job_id, 'status': status, 'url': url,
+                                  'latency': time.time() - job['submitted_at']})
+
+
+synthesis_poller = SynthesisPoller(avatar_poll_initial_interval, avatar_poll_max_interval, avatar_poll_backoff,
+                                   avatar_poll_deadline)
+
+
+
+def wait_for_synthesis(future, timeout=None):
+    """
+    The result of a tracked synthesis Future, or a 'TimedOut' result if it does not resolve within
+    timeout seconds (default: the poller's deadline plus a margin).
+    """
+    try:
+        return future.result(timeout=timeout or synthesis_poller.result_timeout)
+    except FutureTimeoutError:
+        logger.error('Timed out waiting for a batch synthesis result')
+        return {'job_id': None, 'status': 'TimedOut', 'url': None, 'latency': None}
+
+
+avatar_video_cache = AvatarVideoCache(avatar_video_cache_file, avatar_video_cache_ttl, avatar_video_cache_dir)
+
+
+def split_response_segments(response_text, max_chars=avatar_segment_max_chars):
+    """
+    Split a response into segments of whole sentences, each up to max_chars long
+    (a single longer sentence becomes its own segment).
+    """
+    segments = []
+    current = ""
+    for sentence in SENTENCE_BOUNDARY.split(response_text.strip()):
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            segments.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        segments.append(current)
+    return segments
+
+
+def _start_segment(segment):
+    # Resolve a segment from the cache, or submit it and hand it to the poller
+    cached = avatar_video_cache.get(segment)
+    future = Future()
+    if cached:
+        future.set_result({'job_id': None, 'status': 'Succeeded', 'url': cached, 'latency': 0.0})
+        return future
+    submitted_at = time.time()
+    job_id = submit_synthesis(segment)
+    if job_id is None:
+        future.set_result({'job_id': None, 'status': 'Failed', 'url': None, 'latency': 0.0})
+        return future
+    return synthesis_poller.track(job_id, submitted_at)
+
+
+def submit_segmented_synthesis(response_text, max_chars=avatar_segment_max_chars):
+    """
+    Submit one batch synthesis job per sentence-bounded segment of response_text, in parallel.
+
+    Returns:
+    - A list of (segment, Future) in playback order; each Future resolves like SynthesisPoller.track.
+    """
+    segments = split_response_segments(response_text, max_chars)
+    with ThreadPoolExecutor(max_workers=max(1, len(segments))) as executor:
+        futures = list(executor.map(_start_segment, segments))
+    return list(zip(segments, futures))
@@ -0,0 +1,93 @@
+##Cache warm-up job: replays the most frequent spoken queries through the app's answer pipeline
+##(speech_recognition_package/answer_pipeline.py) as the first question of a fresh kiosk session, so the
+##llm_cache index, the query-embedding cache and the avatar video cache are populated before the first
+##visitor. Reports per-query cost (tokens, synthesis jobs, seconds).
+##Run with: python cache_warmup.py queries.log [--top 50] [--concurrency 4] [--no-avatar]
+##The log has one query per line (blank lines and # comments ignored); repeats rank a query higher.
+
+import argparse
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from openai.lib.azure import AzureOpenAI
+import streamlit as st
+
+import variables
+from speech_recognition_package.answer_pipeline import answer_offline
+from utils.embedding_cache import embedding_cache
+from utils.es_helper import get_es_client
+from utils.llm_cache import get_llm_cache
+from utils.search_templates import register_search_templates
+from variables import openai_api_sa_base, openai_completion_api_version
+
+
+def read_query_log(path, top=None):
+    """
+    Queries from a log file, most frequent first.
+    """
+    with open(path) as f:
+        queries = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    return [query for query, _ in Counter(queries).most_common(top)]
+
+
+def create_clients():
+    """
+    Elasticsearch and Azure OpenAI clients for answer_offline, with the same startup work as the app
+    (LLM cache in variables.cache, cache index, search templates).
+    """
+    es = get_es_client()
+    variables.cache = get_llm_cache(es)
+    variables.cache.create_index(768)
+    if variables.use_search_templates:
+        register_search_templates(es)
+    client = AzureOpenAI(
+        api_key=st.secrets['sa_pass'],
+        api_version=openai_completion_api_version,
+        azure_endpoint=openai_api_sa_base
+    )
+    return es, client
+
+
+def run(queries, concurrency=4, searchtype="Elser", warm_avatar=True):
+    es, client = create_clients()
+
+    start_time = time.time()
+    print(f"Warming caches with {len(queries)} queries, {concurrency} at a time")
+    print(f"{'seconds':>8}{'prompt':>8}{'compl.':>8}{'hits':>6}{'jobs':>6}  query")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        costs = []
+        for cost in executor.map(lambda query: answer_offline(es, client, query, searchtype, warm_avatar),
+                                 queries):
+            costs.append(cost)
+            status = f"  ERROR: {cost['error']}" if cost['error'] else ""
+            print(f"{cost['seconds']:>8.1f}{cost['prompt_tokens']:>8}{cost['completion_tokens']:>8}"
+                  f"{cost['cache_hits']:>6}{cost['synthesis_jobs']:>6}  {cost['query']}{status}")
+
+    variables.cache.flush()
+    elapsed = time.time() - start_time
+    print(f"Warm-up done in {elapsed:.1f}s: "
+          f"{sum(c['prompt_tokens'] for c in costs)} prompt tokens, "
+          f"{sum(c['completion_tokens'] for c in costs)} completion tokens, "
+          f"{sum(c['synthesis_jobs'] for c in costs)} synthesis jobs, "
+          f"{sum(1 for c in costs if c['error'])} failed")
+    print(f"LLM cache: {variables.cache.stats()}")
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    if not variables.embedding_cache_dir:
+        print("Note: embedding_cache_dir is not set, so warmed query embeddings only last for this process")
+    return costs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-populate the LLM, embedding and avatar video caches")
+    parser.add_argument("query_log", nargs="?", help="file with one spoken query per line")
+    parser.add_argument("--query", action="append", default=[], help="a query to warm (repeatable)")
+    parser.add_argument("--top", type=int, default=None, help="only the N most frequent logged queries")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--searchtype", default="Elser")
+    parser.add_argument("--no-avatar", action="store_true", help="skip avatar summaries and videos")
+    args = parser.parse_args()
+
+    warm_queries = read_query_log(args.query_log, args.top) if args.query_log else []
+    warm_queries += [query for query in args.query if query not in warm_queries]
+    run(warm_queries, args.concurrency, args.searchtype, not args.no_avatar)
@@ -0,0 +1,82 @@
+##Micro-benchmark of per-query build cost: the previous dict-from-scratch builders with their
+##json.dumps(indent=4) + print debug dump, versus the compiled templates in utils/query_templates.
+##Run with: python query_build_benchmark.py
+
+import io
+import json
+import random
+import timeit
+from contextlib import redirect_stdout
+
+from utils.query_templates import BM25_TEMPLATE, KNN_TEMPLATE, RRF_TEMPLATE, ELSER_TEMPLATE, debug_dump_query
+
+USER_QUERY = "movies like inception with leonardo dicaprio"
+MINILM_VECTOR = [random.random() for _ in range(384)]
+
+
+def legacy_bm25(user_query):
+    query = {"size": 5, "query": {"bool": {"should": [
+        {"query_string": {"default_field": "body_content", "query": user_query}}]}}}
+    print(json.dumps(query, indent=4))
+    return query
+
+
+def legacy_knn(query_vector):
+    query = {"query": {"nested": {"path": "passages", "query": {"knn": {
+        "query_vector": query_vector, "field": "passages.vector.predicted_value", "num_candidates": 2}},
+        "inner_hits": {"_source": ["passages.text"]}}}}
+    print(json.dumps(query, indent=4))
+    return query
+
+
+def legacy_elser(user_query):
+    query = {"size": 5, "query": {"nested": {"path": "passages", "query": {"bool": {"should": [
+        {"text_expansion": {"passages.content_embedding.predicted_value": {
+            "model_id": ".elser_model_2_linux-x86_64", "model_text": user_query}}}]}}}}}
+    print(json.dumps(query, indent=4))
+    return query
+
+
+def legacy_rrf(embeddings, user_query, rrf_rank_constant, rrf_window_size):
+    query = {"sub_searches": [
+        {"query": {"match": {"body_content": user_query}}},
+        {"query": {"nested": {"path": "passages", "query": {"knn": {
+            "query_vector": embeddings, "field": "passages.vector.predicted_value", "num_candidates": 50}}}}},
+        {"query": {"nested": {"path": "passages", "query": {"bool": {"should": [
+            {"text_expansion": {"passages.content_embedding.predicted_value": {
+                "model_id": ".elser_model_2_linux-x86_64", "model_text": user_query}}}]}}}}}],
+        "rank": {"rrf": {"window_size": rrf_window_size, "rank_constant": rrf_rank_constant}}}
+    print(json.dumps(query, indent=4))
+    return query
+
+
+def compiled(template, **values):
+    query = template.render(**values)
+    debug_dump_query(query)
+    return query
+
+
+CASES = [
+    ("BM25", lambda: legacy_bm25(USER_QUERY),
+     lambda: compiled(BM25_TEMPLATE, user_query=USER_QUERY)),
+    ("Vector", lambda: legacy_knn(MINILM_VECTOR),
+     lambda: compiled(KNN_TEMPLATE, query_vector=MINILM_VECTOR)),
+    ("Elser", lambda: legacy_elser(USER_QUERY),
+     lambda: compiled(ELSER_TEMPLATE, user_query=USER_QUERY)),
+    ("Reciprocal Rank Fusion", lambda: legacy_rrf(MINILM_VECTOR, USER_QUERY, 1, 200),
+     lambda: compiled(RRF_TEMPLATE, user_query=USER_QUERY, embeddings=MINILM_VECTOR, elser_text=USER_QUERY,
+                      window_size=200, rank_constant=1)),
+]
+
+
+def run(number=2000):
+    print(f"{'searchtype':<24}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name, before, after in CASES:
+        with redirect_stdout(io.StringIO()):
+            before_us = timeit.timeit(before, number=number) / number * 1e6
+        after_us = timeit.timeit(after, number=number) / number * 1e6
+        print(f"{name:<24}{before_us:>14.1f}{after_us:>14.1f}{before_us / after_us:>9.0f}x")
+
+
+if __name__ == "__main__":
+    run()
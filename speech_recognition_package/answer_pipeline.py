@@ -0,0 +1,316 @@
+##Answer steps for a recognized question: titles search, table answer, avatar summary and avatar video.
+##They read and update a conversation instead of st.session_state directly, so the app (passing
+##st.session_state) and batch jobs such as cache_warmup.py and audio_batch.py (passing a fresh
+##Conversation per question) send the same prompts and fill the same caches.
+##Output goes to an AnswerDisplay; the base class shows nothing, the app renders into Streamlit.
+
+import logging
+import time
+from contextlib import nullcontext
+
+import streamlit as st
+
+import variables
+from avatar.avatar_helper import submit_synthesis, avatar_video_cache, synthesis_poller, \
+    submit_segmented_synthesis, wait_for_synthesis
+from utils.conversation_history import fit_history
+from utils.llm_cache import cache_context
+from utils.openai_helper import CHAT_SYSTEM_PROMPT, AVATAR_SYSTEM_PROMPT, add_to_cache, get_chat_completion, \
+    stream_chat_completion
+from utils.query_helper import search_titles
+from variables import azure_client_deployment_name, history_max_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Conversation:
+    """
+    Conversation state for callers without a Streamlit session, with the attributes ini_chat_prompts
+    sets up in st.session_state.
+    """
+
+    def __init__(self):
+        self.messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+        self.avatar_messages = [{"role": "system", "content": AVATAR_SYSTEM_PROMPT}]
+        self.titles = []
+        self.ini_engage = True
+        self.genAIResponse = ""
+
+
+class AnswerDisplay:
+    """
+    Where the answer steps show their output. This one shows nothing, and since it doesn't stream,
+    completions are requested whole so their token usage can be counted.
+    """
+    streams = False
+
+    def text(self, text):
+        pass
+
+    def stream(self, deltas):
+        return "".join(deltas).strip()
+
+    def video(self, url):
+        pass
+
+    def progress(self, message):
+        return nullcontext()
+
+
+def _count(cost, key, amount=1):
+    if cost is not None:
+        cost[key] += amount
+
+
+def avatar_shortcut_url(user_query, use_shortcuts=None):
+    """
+    Pre-rendered avatar video for a few common questions, or None.
+
+    Parameters:
+    - use_shortcuts: Whether pre-rendered videos may be used; None reads the app's toggle_state, which
+      batch jobs outside a Streamlit session never set, so it defaults to on.
+    """
+    if use_shortcuts is None:
+        use_shortcuts = st.session_state.get('toggle_state', True)
+    if not use_shortcuts:
+        return None
+    if "cage" in user_query.lower():
+        print("build_avatar_response cache_toggle_state and cage")
+        return 'https://sunmanapp.blob.core.windows.net/publicstuff/movies/nick-cage-movies.mp4'
+    elif "date" in user_query.lower():
+        return 'https://sunmanapp.blob.core.windows.net/publicstuff/movies/movie-release-dates.mp4'
+    elif "length" in user_query.lower() or "runtime" in user_query.lower():
+        return 'https://sunmanapp.blob.core.windows.net/publicstuff/movies/movie-length.mp4'
+    return None
+
+
+def chat_context(conversation):
+    """
+    LLM cache context for the table completion: its system prompt, the titles it was given and the
+    deployment that answers (see utils/llm_cache.cache_context).
+    """
+    return cache_context(conversation.messages[0]['content'], conversation.titles, azure_client_deployment_name)
+
+
+def avatar_context(conversation):
+    """
+    LLM cache context for the avatar summary completion.
+    """
+    return cache_context(conversation.avatar_messages[0]['content'], conversation.titles,
+                         azure_client_deployment_name)
+
+
+def add_question(conversation, es, user_query, titles=None, searchtype="Elser"):
+    """
+    Add a question to the chat history. The first question of a conversation is sent with the titles
+    found for it.
+
+    Parameters:
+    - titles: Titles already found by a speculative or concurrent search; the search is skipped then.
+    """
+    if conversation.ini_engage:
+        if titles is None:
+            print("Calling search_titles")
+            titles = search_titles(es, user_query, searchtype, 1, 200)
+        conversation.titles.extend(titles)
+        conversation.messages.append(
+            {"role": "user", "content": f"Answer this question: {user_query} with the following movies  {conversation.titles}"})
+        conversation.ini_engage = False
+    else:
+        conversation.messages.append(
+            {"role": "user", "content": f"{user_query}"})
+
+
+def _completion(conversation, key, client, display, cost):
+    # Keep the history within the token budget before sending it
+    messages = fit_history(getattr(conversation, key), history_max_tokens, client)
+    setattr(conversation, key, messages)
+    if display.streams:
+        return display.stream(stream_chat_completion(client, messages))
+
+    response = get_chat_completion(client, messages)
+    if response.usage:
+        _count(cost, 'prompt_tokens', response.usage.prompt_tokens)
+        _count(cost, 'completion_tokens', response.usage.completion_tokens)
+    return response.choices[0].message.content.strip()
+
+
+def table_answer(conversation, user_query, client, display=None, cost=None):
+    """
+    Table answer for the newest question, from the LLM cache or the chat deployment.
+
+    Parameters:
+    - display: AnswerDisplay the answer is shown (or streamed) in.
+    - cost: Optional counter dictionary updated with tokens and cache hits.
+
+    Returns:
+    - The answer text.
+    """
+    display = display or AnswerDisplay()
+    context = chat_context(conversation)
+    cache_response = variables.cache.query(prompt_text=user_query, similarity_threshold=0.6, context=context)
+    if cache_response:
+        print(f"response from cache ({cache_response['tier']})")
+        _count(cost, 'cache_hits')
+        display.text(cache_response["response"][0])
+        return cache_response["response"][0]
+
+    answer = _completion(conversation, 'messages', client, display, cost)
+    if not display.streams:
+        display.text(answer)
+    conversation.genAIResponse = answer
+    add_to_cache(variables.cache, user_query, answer, context)
+    return answer
+
+
+def append_avatar_prompt(conversation, user_query):
+    if conversation.ini_engage:
+        conversation.avatar_messages.append(
+            {"role": "user", "content": f"Provide me short description for each of the following movies {conversation.titles}"})
+        conversation.ini_engage = False
+    else:
+        conversation.avatar_messages.append(
+            {"role": "user", "content": f"{user_query}"})
+
+
+def avatar_summary(conversation, user_query, client, cost=None):
+    """
+    The avatar summary for the question, from the LLM cache or the chat deployment. Avatar summaries
+    are cached like table answers, so warmed-up videos (cache_warmup.py) are reused.
+    """
+    append_avatar_prompt(conversation, user_query)
+
+    # # Print the messages array for debugging or logging purposes
+    print("build_avatar: Messages being sent to Azure OpenAI:")
+    for message in conversation.avatar_messages:
+        print(f"{message['role'].title()}: {message['content']}")
+
+    context = avatar_context(conversation)
+    cache_response = variables.cache.query(prompt_text=user_query, similarity_threshold=0.6, context=context)
+    if cache_response:
+        print(f"build_avatar: avatar response from cache ({cache_response['tier']})")
+        _count(cost, 'cache_hits')
+        return cache_response["response"][0]
+
+    avatar_response = _completion(conversation, 'avatar_messages', client, AnswerDisplay(), cost)
+    add_to_cache(variables.cache, user_query, avatar_response, context)
+    return avatar_response
+
+
+def avatar_answer(conversation, user_query, client, display=None, avatar_response=None, use_shortcuts=None,
+                  cost=None):
+    """
+    The avatar part of an answer: a pre-rendered video for common questions, otherwise the avatar
+    summary and its video.
+
+    Parameters:
+    - avatar_response: Avatar summary the caller already generated (the async pipeline overlaps it
+      with the table answer).
+
+    Returns:
+    - The avatar summary, or None when a pre-rendered video was shown.
+    """
+    display = display or AnswerDisplay()
+    shortcut_url = avatar_shortcut_url(user_query, use_shortcuts)
+    if shortcut_url:
+        display.video(shortcut_url)
+        return None
+
+    if avatar_response is None:
+        avatar_response = avatar_summary(conversation, user_query, client, cost)
+
+    conversation.avatar_messages.append(
+        {"role": "assistant", "content": avatar_response})
+
+    print("build_avatar: Azure OpenAI Response: " + avatar_response)
+
+    avatar_video(avatar_response, display, cost)
+    return avatar_response
+
+
+def avatar_video(avatar_response, display=None, cost=None):
+    """
+    Show the avatar video for a summary, synthesizing it (whole or in segments) on a cache miss.
+    """
+    display = display or AnswerDisplay()
+    # Segmented synthesis caches each segment's video, never the whole response's
+    if variables.avatar_segmented:
+        return segmented_avatar_video(avatar_response, display, cost)
+
+    cached_video = avatar_video_cache.get(avatar_response)
+    if cached_video:
+        print("build_avatar: avatar video from cache")
+        _count(cost, 'cache_hits')
+        display.video(cached_video)
+        return
+
+    with display.progress('Avatar generation....'):
+        submitted_at = time.time()
+        job_id = submit_synthesis(avatar_response)
+        if job_id is None:
+            return
+        _count(cost, 'synthesis_jobs')
+        result = wait_for_synthesis(synthesis_poller.track(job_id, submitted_at))
+    if result['status'] == 'Succeeded':
+        print(f"batch avatar synthesis job succeeded in {result['latency']:.1f}s")
+        logger.info('batch avatar synthesis job succeeded')
+        display.video(avatar_video_cache.put(avatar_response, result['url']))
+    else:
+        print(f"batch avatar synthesis job {result['status']}")
+        logger.error(f"batch avatar synthesis job {result['status']}")
+
+
+def segmented_avatar_video(avatar_response, display=None, cost=None):
+    """
+    Synthesize the response as parallel sentence-bounded segments and show each video as soon as it
+    and every segment before it are ready, so playback starts after the first segment finishes.
+    """
+    display = display or AnswerDisplay()
+    with display.progress('Avatar generation....'):
+        segments = submit_segmented_synthesis(avatar_response)
+
+    for index, (segment, future) in enumerate(segments):
+        with display.progress(f'Avatar segment {index + 1} of {len(segments)}....'):
+            result = wait_for_synthesis(future)
+        if result['job_id'] is not None:
+            _count(cost, 'synthesis_jobs')
+        elif result['status'] == 'Succeeded':
+            _count(cost, 'cache_hits')
+        if result['status'] != 'Succeeded':
+            print(f"batch avatar synthesis segment {index + 1} {result['status']}")
+            logger.error(f"batch avatar synthesis segment {index + 1} {result['status']}")
+            continue
+        print(f"batch avatar synthesis segment {index + 1} ready in {result['latency']:.1f}s")
+        url = result['url'] if result['job_id'] is None else avatar_video_cache.put(segment, result['url'])
+        display.video(url)
+
+
+def answer_question(conversation, es, client, user_query, titles=None, searchtype="Elser", display=None,
+                    with_avatar=True, use_shortcuts=None, cost=None):
+    """
+    Answer a recognized question: search (first question only), table answer, avatar summary and video.
+    """
+    display = display or AnswerDisplay()
+    add_question(conversation, es, user_query, titles, searchtype)
+    table_answer(conversation, user_query, client, display, cost)
+    if with_avatar:
+        avatar_answer(conversation, user_query, client, display, use_shortcuts=use_shortcuts, cost=cost)
+
+
+def answer_offline(es, client, user_query, searchtype="Elser", with_avatar=True):
+    """
+    answer_question as the first question of a new conversation, for batch jobs.
+
+    Returns:
+    - A dictionary with the query's tokens, cache hits, synthesis jobs, seconds and error (if any).
+    """
+    cost = {'query': user_query, 'prompt_tokens': 0, 'completion_tokens': 0, 'cache_hits': 0,
+            'synthesis_jobs': 0, 'error': None}
+    start_time = time.time()
+    try:
+        answer_question(Conversation(), es, client, user_query, searchtype=searchtype, with_avatar=with_avatar,
+                        use_shortcuts=True, cost=cost)
+    except Exception as e:
+        cost['error'] = str(e)
+    cost['seconds'] = time.time() - start_time
+    return cost
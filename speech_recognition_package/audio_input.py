@@ -0,0 +1,132 @@
+##Audio sources other than the default microphone: WAV files, raw PCM byte streams (through a
+##PushAudioInputStream) and directories of clips, plus concurrent batch transcription for recorded
+##kiosk audio and load tests. Per-clip recognition latency is recorded with each transcript.
+
+import io
+import os
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.cognitiveservices.speech as speechsdk
+
+AUDIO_EXTENSIONS = (".wav",)
+
+
+def push_stream_config(pcm_bytes, samples_per_second=16000, bits_per_sample=16, channels=1,
+                       chunk_size=32000):
+    """
+    AudioConfig reading raw PCM bytes through a PushAudioInputStream. The bytes are written in
+    chunks and the stream closed, so recognition ends at the end of the audio.
+    """
+    stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=samples_per_second,
+                                                      bits_per_sample=bits_per_sample, channels=channels)
+    stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+    for start in range(0, len(pcm_bytes), chunk_size):
+        stream.write(pcm_bytes[start:start + chunk_size])
+    stream.close()
+    return speechsdk.audio.AudioConfig(stream=stream)
+
+
+def audio_config_for(source, samples_per_second=16000):
+    """
+    AudioConfig for a recognition source.
+
+    Parameters:
+    - source: None for the default microphone, a WAV file path, WAV file bytes, raw 16-bit mono PCM
+      bytes at samples_per_second, or a binary file-like object holding either kind of bytes.
+    """
+    if source is None:
+        return speechsdk.audio.AudioConfig(use_default_microphone=True)
+    if isinstance(source, (str, os.PathLike)):
+        return speechsdk.audio.AudioConfig(filename=os.fspath(source))
+    if hasattr(source, "read"):
+        source = source.read()
+    if bytes(source[:4]) == b"RIFF":
+        # WAV bytes (e.g. an upload): push the frames with the format from the header
+        with wave.open(io.BytesIO(source)) as wav:
+            return push_stream_config(wav.readframes(wav.getnframes()), wav.getframerate(),
+                                      wav.getsampwidth() * 8, wav.getnchannels())
+    return push_stream_config(bytes(source), samples_per_second)
+
+
+def iter_audio_files(path):
+    """
+    The audio clips at path: the file itself, or every WAV file in a directory tree in name order.
+    """
+    if os.path.isfile(path):
+        return [path]
+    clips = []
+    for root, _, files in os.walk(path):
+        clips.extend(os.path.join(root, name) for name in files if name.lower().endswith(AUDIO_EXTENSIONS))
+    return sorted(clips)
+
+
+def transcribe(speech_config, source, timeout=300):
+    """
+    Transcribe a whole clip with continuous recognition (clips may hold several utterances).
+
+    Returns:
+    - A dictionary with the source, transcript, first_result_seconds (time to the first final
+      utterance), seconds (time to the end of the clip) and error (None on success).
+    """
+    started_at = time.perf_counter()
+    result = {'source': source if isinstance(source, str) else "<stream>", 'transcript': "",
+              'first_result_seconds': None, 'seconds': None, 'error': None}
+    texts = []
+    done = threading.Event()
+
+    def on_recognized(evt):
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+            if result['first_result_seconds'] is None:
+                result['first_result_seconds'] = time.perf_counter() - started_at
+            texts.append(evt.result.text)
+
+    def on_canceled(evt):
+        details = evt.result.cancellation_details
+        if details.reason == speechsdk.CancellationReason.Error:
+            result['error'] = f"{details.reason}: {details.error_details}"
+        done.set()
+
+    try:
+        recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config_for(source))
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+
+    recognizer.recognized.connect(on_recognized)
+    recognizer.canceled.connect(on_canceled)
+    recognizer.session_stopped.connect(lambda evt: done.set())
+
+    recognizer.start_continuous_recognition_async().get()
+    if not done.wait(timeout):
+        result['error'] = f"Recognition did not finish within {timeout}s"
+    recognizer.stop_continuous_recognition_async().get()
+
+    result['transcript'] = " ".join(texts)
+    result['seconds'] = time.perf_counter() - started_at
+    return result
+
+
+def transcribe_many(speech_config, sources, pool_size=4, on_result=None):
+    """
+    Transcribe many clips concurrently, at most pool_size recognizers at a time. Speech SDK
+    recognizers are bound to their audio source, so each clip gets its own recognizer on a shared
+    SpeechConfig.
+
+    Parameters:
+    - on_result: Optional function called with each transcribe() result (in a worker thread) as soon
+      as it is ready, e.g. to feed the transcript into the search/answer pipeline.
+
+    Returns:
+    - The transcribe() results in source order, each with on_result's return value under 'answer'.
+    """
+    def run(source):
+        result = transcribe(speech_config, source)
+        if on_result is not None and result['transcript']:
+            result['answer'] = on_result(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="recognizer") as executor:
+        return list(executor.map(run, sources))
@@ -0,0 +1,148 @@
+##Continuous speech recognition with early query dispatch. A recognizer is created and connected once
+##and reused for every question; while the visitor is still speaking, a partial hypothesis that stays
+##unchanged for a short time is searched speculatively, and the search is re-issued only if the final
+##transcript turns out different. The search then overlaps the end-of-utterance silence detection.
+
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.cognitiveservices.speech as speechsdk
+
+from utils.embedding_cache import normalize_query_text
+
+
+class ContinuousRecognizer:
+    """
+    A warm SpeechRecognizer that returns one final utterance per recognize_utterance call.
+
+    Parameters:
+    - speech_config: speechsdk.SpeechConfig for the recognizer.
+    - audio_config: Audio source, default microphone.
+    - stable_partial_ms: How long a partial transcript must stay unchanged before it is searched.
+    """
+
+    def __init__(self, speech_config, audio_config=None, stable_partial_ms=300):
+        if audio_config is None:
+            audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
+        self.recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+        # Open the service connection now, so the first question does not pay for the handshake
+        self.connection = speechsdk.Connection.from_recognizer(self.recognizer)
+        self.connection.open(True)
+
+        self.stable_partial = stable_partial_ms / 1000
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculative-search")
+        self.search_fn = None
+        self.partial = ""
+        self.timer = None
+        self.speculation = None  # (partial text, search future)
+        self.stop_future = None
+        self.stats = Counter()
+
+        self.recognizer.recognizing.connect(self._on_recognizing)
+        self.recognizer.recognized.connect(self._on_recognized)
+        self.recognizer.canceled.connect(self._on_canceled)
+
+    def _on_recognizing(self, evt):
+        with self.lock:
+            self.partial = evt.result.text
+            if self.search_fn is None:
+                return
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.stable_partial, self._speculate, args=(self.partial,))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _speculate(self, text):
+        with self.lock:
+            if text != self.partial or self.search_fn is None:
+                return
+            if self.speculation:
+                if normalize_query_text(self.speculation[0]) == normalize_query_text(text):
+                    return
+                self.speculation[1].cancel()
+            print(f"Speculative search on partial transcript: {text}")
+            self.speculation = (text, self.executor.submit(self.search_fn, text))
+            self.stats['speculative_searches'] += 1
+
+    def _on_recognized(self, evt):
+        result = evt.result
+        if result.reason == speechsdk.ResultReason.NoMatch:
+            # Speech that could not be recognized ends the utterance, instead of waiting out the timeout
+            self.results.put((result, None))
+            return
+        if result.reason != speechsdk.ResultReason.RecognizedSpeech or not result.text:
+            return
+
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            speculation, self.speculation = self.speculation, None
+            self.partial = ""
+            search_fn = self.search_fn
+
+        search = None
+        if search_fn is not None:
+            if speculation and normalize_query_text(speculation[0]) == normalize_query_text(result.text):
+                search = speculation[1]
+                self.stats['speculative_hits'] += 1
+            else:
+                # A search already running on the wrong text cannot be stopped; its result is dropped
+                if speculation:
+                    speculation[1].cancel()
+                    self.stats['speculative_misses'] += 1
+                search = self.executor.submit(search_fn, result.text)
+        self.results.put((result, search))
+
+    def _on_canceled(self, evt):
+        self.results.put((evt.result, None))
+
+    def recognize_utterance(self, search_fn=None, timeout=15):
+        """
+        Listen until the next final utterance.
+
+        Parameters:
+        - search_fn: Optional function of the transcript, run speculatively on stable partials and
+          confirmed (or re-run) on the final text.
+        - timeout: Seconds to wait for speech.
+
+        Returns:
+        - A tuple (result, search_future); result is the SpeechRecognitionResult (None on timeout, reason
+          NoMatch when speech was heard but not recognized) and search_future the Future of search_fn for
+          the final text, or None.
+        """
+        while not self.results.empty():
+            self.results.get_nowait()
+        if self.stop_future is not None:
+            self.stop_future.get()
+            self.stop_future = None
+
+        with self.lock:
+            self.search_fn = search_fn
+        self.recognizer.start_continuous_recognition_async().get()
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+        finally:
+            with self.lock:
+                self.search_fn = None
+                if self.timer:
+                    self.timer.cancel()
+                # A speculation left by a timeout or NoMatch must not be matched against the next question
+                if self.speculation:
+                    self.speculation[1].cancel()
+                    self.speculation = None
+                self.partial = ""
+            # Stopping is finished before the next start, not on this question's critical path
+            self.stop_future = self.recognizer.stop_continuous_recognition_async()
+
+    def close(self):
+        if self.stop_future is not None:
+            self.stop_future.get()
+        self.connection.close()
+        self.executor.shutdown(wait=False)
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import os
 import sys
@@ -8,18 +9,22 @@ from openai.lib.azure import AzureOpenAI
 import time
 
 import variables
-from avatar.avatar_helper import submit_synthesis, get_synthesis
-from utils.es_helper import create_es_client
-from utils.openai_helper import get_chat_guidance, get_chat_guidance_summarized, add_to_cache
-from utils.query_helper import  search_products_v2
+from utils.conversation_history import bound_session_history_async
+from utils.async_clients import get_async_es_client, get_async_openai_client
+from utils.es_helper import get_es_client
+from utils.openai_helper import get_chat_guidance, add_to_cache, get_chat_guidance_async, get_chat_guidance_stream, \
+    render_chat_stream, get_chat_guidance_stream_async, render_chat_stream_async
+from speech_recognition_package.answer_pipeline import AnswerDisplay, add_question, answer_question, \
+    append_avatar_prompt, avatar_answer, avatar_context, avatar_shortcut_url, chat_context
+from speech_recognition_package.audio_input import audio_config_for
+from speech_recognition_package.continuous_recognition import ContinuousRecognizer
+from utils.query_helper import  search_products_v2, search_titles_async, search_titles
 from variables import openai_api_sa_base, openai_completion_api_version
+from variables import recognition_stable_partial_ms, recognition_timeout
 
 # Connect to Elasticsearch
 try:
-    username = st.secrets['es_username']
-    password = st.secrets['es_password']
-    cloudid = st.secrets['es_cloudid']
-    es = create_es_client(username, password, cloudid)
+    es = get_es_client()
 except Exception as e:
     print("Connection failed", str(e))
     st.error("Error connecting to Elasticsearch. Fix connection and restart app")
@@ -89,10 +94,8 @@ def microphone_to_es():
 
         st.session_state.messages.append(
             {"role": "user", "content": f"Answer this question: {user_query} with the following movies  {titles}"})
-        response_text = get_chat_guidance(azureclient)
-
         c.success("Question: {}".format(user_query))
-        c.markdown(response_text, unsafe_allow_html=True)
+        response_text = render_chat_stream(c, get_chat_guidance_stream(azureclient))
 
     elif speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
         st.error("No speech could be recognized.")
@@ -105,80 +108,55 @@ def microphone_to_es():
     return user_query
 
 
-def build_avatar_response(user_query, titles):
-    if st.session_state['toggle_state'] and "cage" in user_query.lower():
-        print("build_avatar_response cache_toggle_state and cage")
-        st.video(
-            'https://sunmanapp.blob.core.windows.net/publicstuff/movies/nick-cage-movies.mp4',
-            format="video/mp4", start_time=0)
-        return 0
-    elif st.session_state['toggle_state'] and "date" in user_query.lower():
-        st.video(
-            'https://sunmanapp.blob.core.windows.net/publicstuff/movies/movie-release-dates.mp4',
-            format="video/mp4", start_time=0)
-        return 0
-    elif st.session_state['toggle_state'] and ("length" in user_query.lower() or "runtime" in user_query.lower()):
-        st.video(
-            'https://sunmanapp.blob.core.windows.net/publicstuff/movies/movie-length.mp4',
-            format="video/mp4", start_time=0)
-        return 0
-
-    if (st.session_state.ini_engage == True):
-        st.session_state.avatar_messages.append(
-            {"role": "user", "content": f"Provide me short description for each of the following movies {titles}"})
-        st.session_state.ini_engage = False
-    else:
-        st.session_state.avatar_messages.append(
-            {"role": "user", "content": f"{user_query}"})
-
-    # # Print the messages array for debugging or logging purposes
-    print("build_avatar: Messages being sent to Azure OpenAI:")
-    for message in st.session_state.avatar_messages:
-        print(f"{message['role'].title()}: {message['content']}")
-
-    avatar_response = get_chat_guidance_summarized(azureclient)
-
-    st.session_state.avatar_messages.append(
-        {"role": "system", "content": avatar_response})
-
-    print("build_avatar: Azure OpenAI Response: " + avatar_response)
-
-    with st.spinner('Avatar generation....'):
-        job_id = submit_synthesis(avatar_response)
-        if job_id is not None:
-            while True:
-                status, url = get_synthesis(job_id)
-                if status == 'Succeeded':
-                    print('batch avatar synthesis job succeeded')
-                    logger.info('batch avatar synthesis job succeeded')
-                    st.video(
-                        url,
-                        format="video/mp4", start_time=0)
-                    break
-                elif status == 'Failed':
-                    print('batch avatar synthesis job failed')
-                    logger.error('batch avatar synthesis job failed')
-                    break
-                else:
-                    print(f'batch avatar synthesis job is still running, status [{status}]')
-                    logger.info(f'batch avatar synthesis job is still running, status [{status}]')
-                    time.sleep(5)
-
-
-def speak2text():
+class StreamlitAnswerDisplay(AnswerDisplay):
+    """
+    Shows the answer steps' output in the app: answers in container c, videos and spinners on the page.
+    """
+    streams = True
+
+    def __init__(self, container):
+        self.container = container
+
+    def text(self, text):
+        self.container.markdown(text, unsafe_allow_html=True)
+
+    def stream(self, deltas):
+        return render_chat_stream(self.container, deltas)
+
+    def video(self, url):
+        st.video(url, format="video/mp4", start_time=0)
+
+    def progress(self, message):
+        return st.spinner(message)
+
+
+def build_avatar_response(user_query, avatar_response=None):
+    """
+    Show the avatar answer for a question in the app (see answer_pipeline.avatar_answer).
+
+    Parameters:
+    - avatar_response: Avatar summary the async pipeline already generated, if any.
+    """
+    return avatar_answer(st.session_state, user_query, azureclient, StreamlitAnswerDisplay(st), avatar_response)
+
+
+def speak2text(audio_source=None):
+    """
+    Recognize one utterance from the microphone, or from audio_source (see audio_input.audio_config_for).
+    """
     speech_config = speechsdk.SpeechConfig(subscription=st.secrets['speech_key'],
                                            region=st.secrets['speech_region'])
     speech_config.speech_recognition_language = "en-US"
 
-    audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
+    audio_config = audio_config_for(audio_source)
     speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
 
     # st.write("Speak into your microphone.")
     return speech_recognizer.recognize_once_async().get()
 
 
-def microphone_to_es_with_avatar():
-    speech_recognition_result = speak2text()
+def microphone_to_es_with_avatar(audio_source=None):
+    speech_recognition_result = speak2text(audio_source)
 
     # Initialize user_query as an empty string in case recognition fails
     user_query = ""
@@ -189,51 +167,99 @@ def microphone_to_es_with_avatar():
         c = st.container()
         c.success("Question: {}".format(user_query))
 
-        if st.session_state.ini_engage:
-            print("Calling search_products_v2")
-            search_products_v2(es, user_query, 'Elser', 1, 200)
-            st.session_state.messages.append(
-                {"role": "user", "content": f"Answer this question: {user_query} with the following movies  {st.session_state.titles}"})
+        answer_question(st.session_state, es, azureclient, user_query, display=StreamlitAnswerDisplay(c))
+        print(f"LLM cache: {variables.cache.stats()}")
+    elif speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
+        st.error("No speech could be recognized.")
+    elif speech_recognition_result.reason == speechsdk.ResultReason.Canceled:
+        cancellation_details = speech_recognition_result.cancellation_details
+        st.error(
+            f"Speech Recognition canceled: {cancellation_details.reason}. Error details: {cancellation_details.error_details}")
 
-            # Query the cache
-            cache_response = variables.cache.query(prompt_text=user_query, similarity_threshold=0.6)
+    # Return the user_query variable to use it outside the function
+    return user_query
 
-            if cache_response:
-                print("response from cache")
-                c.markdown(cache_response["response"][0], unsafe_allow_html=True)
-            else:
-                st.session_state.genAIResponse = get_chat_guidance(azureclient)
-                add_to_cache(variables.cache, user_query, st.session_state.genAIResponse)
-                c.markdown(st.session_state.genAIResponse, unsafe_allow_html=True)
 
-            #st.session_state.genAIResponse = get_chat_guidance(azureclient)
+async def avatar_summary_async(aclient, user_query):
+    """
+    The avatar summary for the pending avatar prompt, from the LLM cache when possible.
+    """
+    context = avatar_context(st.session_state)
+    cache_response = await asyncio.to_thread(variables.cache.query, prompt_text=user_query,
+                                             similarity_threshold=0.6, context=context)
+    if cache_response:
+        print(f"avatar response from cache ({cache_response['tier']})")
+        return cache_response["response"][0]
 
-            #add_to_cache(variables.cache, user_query, st.session_state.genAIResponse)
+    messages = await bound_session_history_async('avatar_messages', azureclient)
+    avatar_response = await get_chat_guidance_async(aclient, messages)
+    await asyncio.to_thread(add_to_cache, variables.cache, user_query, avatar_response, context)
+    return avatar_response
 
-            #c.markdown(st.session_state.genAIResponse, unsafe_allow_html=True)
 
-            st.session_state.ini_engage = False
-        else:
-            st.session_state.messages.append(
-                {"role": "user", "content": f"{user_query}"})
+async def answer_query_async(user_query, c, titles=None):
+    """
+    Async variant of the answer steps in microphone_to_es_with_avatar.
 
-            # Query the cache
-            cache_response = variables.cache.query(prompt_text=user_query, similarity_threshold=0.6)
+    Once the transcript is known the ELSER search and the LLM cache's prompt embedding run concurrently,
+    and the avatar summary completion runs concurrently with the table completion.
 
-            if cache_response:
-                print("response from cache")
-                c.markdown(cache_response["response"][0], unsafe_allow_html=True)
-            else:
-                st.session_state.genAIResponse = get_chat_guidance(azureclient)
-                add_to_cache(variables.cache, user_query, st.session_state.genAIResponse)
-                c.markdown(st.session_state.genAIResponse, unsafe_allow_html=True)
+    titles are search results already found by a speculative search; the search is skipped then.
 
-            #get_chat_guidance(azureclient)
+    Returns:
+    - The avatar response text, or None when a pre-rendered avatar video will be used.
+    """
+    # Shared clients: connections stay open across questions and sessions
+    aes = get_async_es_client()
+    aclient = get_async_openai_client()
 
-            #add_to_cache(variables.cache, user_query, st.session_state.genAIResponse)
+    # The cache key depends on the retrieved titles, so only the prompt embedding overlaps the search
+    prompt_vector = asyncio.to_thread(variables.cache.prompt_vector, user_query)
 
-            #c.markdown(st.session_state.genAIResponse, unsafe_allow_html=True)
-        build_avatar_response(user_query, st.session_state.titles)
+    if st.session_state.ini_engage and titles is None:
+        print("Calling search_titles_async")
+        titles, _ = await asyncio.gather(search_titles_async(aes, es, user_query, 'Elser', 1, 200), prompt_vector)
+    else:
+        await prompt_vector
+    add_question(st.session_state, es, user_query, titles)
+
+    context = chat_context(st.session_state)
+    cache_response = await asyncio.to_thread(variables.cache.query, prompt_text=user_query,
+                                             similarity_threshold=0.6, context=context)
+
+    # Start the avatar summary now so it overlaps with the table completion
+    avatar_task = None
+    if not avatar_shortcut_url(user_query):
+        append_avatar_prompt(st.session_state, user_query)
+        avatar_task = asyncio.create_task(avatar_summary_async(aclient, user_query))
+
+    if cache_response:
+        print(f"response from cache ({cache_response['tier']})")
+        c.markdown(cache_response["response"][0], unsafe_allow_html=True)
+    else:
+        st.session_state.genAIResponse = await render_chat_stream_async(
+            c, get_chat_guidance_stream_async(aclient, await bound_session_history_async('messages', azureclient)))
+        await asyncio.to_thread(add_to_cache, variables.cache, user_query, st.session_state.genAIResponse,
+                                context)
+
+    return await avatar_task if avatar_task else None
+
+
+def microphone_to_es_with_avatar_async(audio_source=None):
+    speech_recognition_result = speak2text(audio_source)
+
+    # Initialize user_query as an empty string in case recognition fails
+    user_query = ""
+
+    if speech_recognition_result.reason == speechsdk.ResultReason.RecognizedSpeech:
+        user_query = speech_recognition_result.text  # Store the recognized text in user_query
+
+        c = st.container()
+        c.success("Question: {}".format(user_query))
+
+        avatar_response = asyncio.run(answer_query_async(user_query, c))
+        build_avatar_response(user_query, avatar_response)
+        print(f"LLM cache: {variables.cache.stats()}")
     elif speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
         st.error("No speech could be recognized.")
     elif speech_recognition_result.reason == speechsdk.ResultReason.Canceled:
@@ -243,3 +269,57 @@ def microphone_to_es_with_avatar():
 
     # Return the user_query variable to use it outside the function
     return user_query
+
+
+def get_session_recognizer():
+    """
+    The session's warm continuous recognizer, created and connected on first use.
+    """
+    if 'continuous_recognizer' not in st.session_state:
+        speech_config = speechsdk.SpeechConfig(subscription=st.secrets['speech_key'],
+                                               region=st.secrets['speech_region'])
+        speech_config.speech_recognition_language = "en-US"
+        st.session_state.continuous_recognizer = ContinuousRecognizer(speech_config,
+                                                                      stable_partial_ms=recognition_stable_partial_ms)
+    return st.session_state.continuous_recognizer
+
+
+def microphone_to_es_with_avatar_continuous():
+    """
+    microphone_to_es_with_avatar on the session's warm recognizer. On the first question of a
+    conversation the search starts on a stable partial transcript, before the visitor stops talking.
+    """
+    recognizer = get_session_recognizer()
+
+    # Only the first question searches; follow-ups are answered from the session's titles
+    search_fn = None
+    if st.session_state.ini_engage:
+        search_fn = lambda text: search_titles(es, text, 'Elser', 1, 200)
+    speech_recognition_result, search = recognizer.recognize_utterance(search_fn, recognition_timeout)
+
+    # Initialize user_query as an empty string in case recognition fails
+    user_query = ""
+
+    if speech_recognition_result is None or speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
+        st.error("No speech could be recognized.")
+    elif speech_recognition_result.reason == speechsdk.ResultReason.RecognizedSpeech:
+        user_query = speech_recognition_result.text  # Store the recognized text in user_query
+
+        c = st.container()
+        c.success("Question: {}".format(user_query))
+
+        titles = search.result() if search else None
+        if variables.use_async_pipeline:
+            avatar_response = asyncio.run(answer_query_async(user_query, c, titles))
+            build_avatar_response(user_query, avatar_response)
+        else:
+            answer_question(st.session_state, es, azureclient, user_query, titles, display=StreamlitAnswerDisplay(c))
+        print(f"LLM cache: {variables.cache.stats()}")
+        print(f"Speculative search: {dict(recognizer.stats)}")
+    elif speech_recognition_result.reason == speechsdk.ResultReason.Canceled:
+        cancellation_details = speech_recognition_result.cancellation_details
+        st.error(
+            f"Speech Recognition canceled: {cancellation_details.reason}. Error details: {cancellation_details.error_details}")
+
+    # Return the user_query variable to use it outside the function
+    return user_query
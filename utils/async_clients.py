@@ -0,0 +1,70 @@
+##Process-wide async Elasticsearch and Azure OpenAI clients for the async pipeline.
+##Async clients are bound to the event loop they first send on, so both live on one background loop
+##shared by every session and keep their connection pools between questions. Each question still runs
+##on its own asyncio.run loop (which keeps Streamlit's script context) and hands client requests to the
+##background loop with on_client_loop / iterate_on_client_loop.
+
+import asyncio
+import threading
+
+import streamlit as st
+from openai import AsyncAzureOpenAI
+
+from utils.es_helper import create_async_es_client
+from variables import openai_api_sa_base, openai_completion_api_version
+
+
+@st.cache_resource
+def get_client_loop():
+    """
+    The background event loop the shared async clients run on.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-clients", daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def get_async_es_client():
+    """
+    Process-wide AsyncElasticsearch client; use its coroutines through on_client_loop.
+    """
+    return create_async_es_client()
+
+
+@st.cache_resource
+def get_async_openai_client():
+    """
+    Process-wide AsyncAzureOpenAI client; use its coroutines through on_client_loop.
+    """
+    return AsyncAzureOpenAI(
+        api_key=st.secrets['sa_pass'],
+        api_version=openai_completion_api_version,
+        azure_endpoint=openai_api_sa_base
+    )
+
+
+async def on_client_loop(coro):
+    """
+    Await a coroutine of a shared async client by running it on the client loop.
+    """
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_client_loop()))
+
+
+async def _next_item(iterator):
+    try:
+        return True, await iterator.__anext__()
+    except StopAsyncIteration:
+        return False, None
+
+
+async def iterate_on_client_loop(async_iterable):
+    """
+    Iterate a shared client's async stream (e.g. a streamed completion) from another event loop.
+    """
+    iterator = async_iterable.__aiter__()
+    while True:
+        has_item, item = await on_client_loop(_next_item(iterator))
+        if not has_item:
+            return
+        yield item
@@ -0,0 +1,122 @@
+##Token-budgeted conversation history for st.session_state.messages / avatar_messages.
+##The system prompt and the first user turn (which carries the movie titles) are always kept, the newest
+##turns are kept while they fit the budget, and older turns are dropped or, optionally, folded into a
+##rolling summary message.
+
+import asyncio
+
+import streamlit as st
+
+from utils.rate_limiter import estimate_tokens, get_rate_limiter
+from variables import azure_client_deployment_name, history_max_tokens, history_summarize, tiktoken_encoding
+
+try:
+    import tiktoken
+except ImportError:  # fall back to the ~4 chars/token estimate
+    tiktoken = None
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+_encoding = None
+
+
+def count_tokens(text):
+    global _encoding
+    if tiktoken is None:
+        return estimate_tokens(text)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(tiktoken_encoding)
+    return len(_encoding.encode(text))
+
+
+def count_message_tokens(message):
+    # Each chat message carries ~4 tokens of role/formatting overhead
+    return count_tokens(message['content']) + 4
+
+
+def is_summary(message):
+    return message['role'] == "system" and message['content'].startswith(SUMMARY_PREFIX)
+
+
+def summarize_messages(client, previous_summary, evicted):
+    """
+    Fold evicted turns into the rolling summary with one short completion.
+    """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+    prompt = [
+        {"role": "system",
+         "content": "Summarize this conversation between a user and a movie assistant in under 80 words. "
+                    "Keep the movie titles that were discussed."},
+        {"role": "user", "content": f"{previous_summary}\n{transcript}"}
+    ]
+    response = get_rate_limiter(azure_client_deployment_name).call(
+        lambda: client.chat.completions.create(model=azure_client_deployment_name, messages=prompt),
+        estimate_tokens(prompt))
+    return response.choices[0].message.content.strip()
+
+
+def fit_history(messages, max_tokens=history_max_tokens, client=None):
+    """
+    Trim a chat message list to max_tokens.
+
+    Parameters:
+    - messages: Chat messages; a leading system message is always kept.
+    - max_tokens: Token budget for the whole list.
+    - client: AzureOpenAI client used to summarize evicted turns when history_summarize is on.
+
+    Returns:
+    - A new message list: system prompt, optional rolling summary, the first user turn, then the
+      newest turns that fit, starting with a user turn.
+    """
+    head = messages[:1] if messages and messages[0]['role'] == "system" else []
+    rest = messages[len(head):]
+    summary = rest[0] if rest and is_summary(rest[0]) else None
+    turns = rest[1:] if summary else rest
+    # The first question is sent with the titles every later turn refers to, so it is never evicted
+    anchor = turns[:1] if turns and turns[0]['role'] == "user" else []
+    turns = turns[len(anchor):]
+
+    budget = max_tokens - sum(count_message_tokens(m) for m in head + anchor)
+    if summary:
+        budget -= count_message_tokens(summary)
+
+    kept = []
+    for message in reversed(turns):
+        cost = count_message_tokens(message)
+        # Always keep the newest turn, it is the question being asked
+        if kept and cost > budget:
+            break
+        kept.append(message)
+        budget -= cost
+    kept.reverse()
+    # Don't start the kept turns with an answer whose question was evicted
+    while kept[:-1] and kept[0]['role'] != "user":
+        kept.pop(0)
+
+    evicted = turns[:len(turns) - len(kept)]
+    if not evicted:
+        return list(messages)
+
+    print(f"Conversation history over budget, dropping {len(evicted)} oldest messages")
+    if history_summarize and client is not None:
+        previous = summary['content'][len(SUMMARY_PREFIX):] if summary else ""
+        summary = {"role": "system", "content": SUMMARY_PREFIX + summarize_messages(client, previous, evicted)}
+
+    return head + ([summary] if summary else []) + anchor + kept
+
+
+def bound_session_history(key, client=None, max_tokens=history_max_tokens):
+    """
+    Apply fit_history to st.session_state[key] in place and return the bounded list.
+    """
+    st.session_state[key] = fit_history(st.session_state[key], max_tokens, client)
+    return st.session_state[key]
+
+
+async def bound_session_history_async(key, client=None, max_tokens=history_max_tokens):
+    """
+    bound_session_history for async callers: fit_history (token counting and the optional summary
+    completion) runs in a worker thread, session state is read and written on the calling thread.
+    """
+    st.session_state[key] = await asyncio.to_thread(fit_history, st.session_state[key], max_tokens, client)
+    return st.session_state[key]
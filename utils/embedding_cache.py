@@ -0,0 +1,221 @@
+##Query-embedding cache used in front of get_embedding (Azure OpenAI) and build_vector (Elasticsearch ML).
+##Spoken queries repeat a lot, so vectors are cached by (model id, normalized text) in an in-process LRU
+##with a TTL, optionally backed by an on-disk float32 store that is memory-mapped for reads.
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking (Windows); a single process per cache directory is safe
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:  # the disk tier is optional
+    np = None
+
+from variables import embedding_cache_size, embedding_cache_ttl, embedding_cache_dir
+
+
+def normalize_query_text(text):
+    """
+    Canonical form of a query for cache keys: lower case, no punctuation, single spaces.
+    """
+    text = re.sub(r"[^\w\s']", " ", text.lower())
+    return " ".join(text.split())
+
+
+class DiskVectorStore:
+    """
+    Append-only float32 vector file for one model, with an append-only journal of (key, row, dims)
+    lines. Appends take an exclusive file lock and the row number is the file's actual length in rows,
+    so a crash between the two writes or several processes sharing the directory cannot misalign keys
+    and vectors. Reads go through a numpy memmap that is re-opened only when new rows have been appended.
+    """
+
+    def __init__(self, directory, model_id):
+        safe_name = re.sub(r"[^\w.-]", "_", model_id)
+        self.vectors_path = os.path.join(directory, f"{safe_name}.f32")
+        self.journal_path = os.path.join(directory, f"{safe_name}.keys.jsonl")
+        self.rows = {}
+        self.dims = None
+        self.matrix = None
+        self.journal_offset = 0
+        with self._locked():
+            self._trim_partial_row()
+            self._read_journal()
+
+    @contextmanager
+    def _locked(self):
+        with open(self.journal_path, "a") as journal:
+            if fcntl is not None:
+                fcntl.flock(journal, fcntl.LOCK_EX)
+            try:
+                yield journal
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(journal, fcntl.LOCK_UN)
+
+    def _stored_rows(self):
+        if self.dims is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dims * 4)
+
+    def _trim_partial_row(self):
+        # A crash in the middle of an append leaves a partial row; cut it so the next row is aligned
+        if self.dims is None:
+            self._read_journal()
+        if self.dims is not None and os.path.exists(self.vectors_path):
+            size = os.path.getsize(self.vectors_path)
+            if size % (self.dims * 4):
+                os.truncate(self.vectors_path, size - size % (self.dims * 4))
+
+    def _read_journal(self):
+        """
+        Pick up journal lines appended since the last read (by this or another process). Lines for
+        rows the vector file does not hold are ignored.
+        """
+        if not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) <= self.journal_offset:
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(self.journal_offset)
+            data = f.read()
+        # Only complete lines; a line still being written is read next time
+        data = data[:data.rfind(b"\n") + 1]
+        self.journal_offset += len(data)
+        stored_rows = None
+        for line in data.splitlines():
+            key, row, dims = json.loads(line)
+            if self.dims is None:
+                self.dims = dims
+            if stored_rows is None or row >= stored_rows:
+                stored_rows = self._stored_rows()
+            if dims == self.dims and row < stored_rows:
+                self.rows[key] = row
+
+    def _matrix(self, row):
+        if self.matrix is None or len(self.matrix) <= row:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r').reshape(-1, self.dims)
+        return self.matrix
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            self._read_journal()
+            row = self.rows.get(key)
+            if row is None:
+                return None
+        return self._matrix(row)[row].tolist()
+
+    def put(self, key, vector):
+        with self._locked() as journal:
+            self._read_journal()
+            if key in self.rows:
+                return
+            if self.dims is None:
+                self.dims = len(vector)
+            if len(vector) != self.dims:
+                return
+            self._trim_partial_row()
+            row = self._stored_rows()
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.asarray(vector, dtype=np.float32).tobytes())
+            # The journal line is written only after its vector, so readers never see a row that is not there
+            line = json.dumps([key, row, self.dims]) + "\n"
+            journal.write(line)
+            journal.flush()
+            self.rows[key] = row
+            self.journal_offset = journal.tell()
+
+
+class EmbeddingCache:
+    """
+    LRU + TTL cache of query embeddings keyed by (model id, normalized text).
+
+    Parameters:
+    - max_size: Maximum number of vectors held in memory.
+    - ttl: Seconds an in-memory entry stays valid.
+    - disk_dir: Optional directory for the persistent float32 store (requires numpy).
+    """
+
+    def __init__(self, max_size=1024, ttl=86400, disk_dir=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_dir = disk_dir if disk_dir and np is not None else None
+        self.disk_stores = {}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_store(self, model_id):
+        if model_id not in self.disk_stores:
+            self.disk_stores[model_id] = DiskVectorStore(self.disk_dir, model_id)
+        return self.disk_stores[model_id]
+
+    def _remember(self, key, vector):
+        self.entries[key] = (vector, time.time() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, model_id, text):
+        key = (model_id, normalize_query_text(text))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self.entries[key]
+
+            if self.disk_dir:
+                vector = self._disk_store(model_id).get(key[1])
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, model_id, text, vector):
+        key = (model_id, normalize_query_text(text))
+        with self.lock:
+            self._remember(key, vector)
+            if self.disk_dir:
+                self._disk_store(model_id).put(key[1], vector)
+
+    def get_or_compute(self, model_id, text, compute):
+        """
+        Return the cached vector for text, calling compute(text) and caching the result on a miss.
+        """
+        vector = self.get(model_id, text)
+        if vector is None:
+            vector = compute(text)
+            if vector:
+                self.put(model_id, text, vector)
+        return vector
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'size': len(self.entries)
+        }
+
+
+embedding_cache = EmbeddingCache(embedding_cache_size, embedding_cache_ttl, embedding_cache_dir)
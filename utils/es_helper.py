@@ -1,16 +1,60 @@
-from elasticsearch import Elasticsearch
+import streamlit as st
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+from utils.vector_quantization import quantize_dense_vector_mappings
+from variables import es_connections_per_node, es_request_timeout, es_max_retries, es_retry_on_timeout, \
+    es_http_compress, vector_index_quantization
 
 
 def create_es_client(username, password, cloudid):
+    # Connections in the per-node urllib3 pool are kept alive and reused between requests
     es = Elasticsearch(
         cloud_id=cloudid,
-        basic_auth=(username, password)
+        basic_auth=(username, password),
+        connections_per_node=es_connections_per_node,
+        request_timeout=es_request_timeout,
+        max_retries=es_max_retries,
+        retry_on_timeout=es_retry_on_timeout,
+        http_compress=es_http_compress
     )
     return es
 
 
+@st.cache_resource
+def get_es_client():
+    """
+    Process-wide Elasticsearch client, created lazily on first use and shared by every module
+    and every Streamlit rerun/session so there is a single connection pool per process.
+    """
+    username = st.secrets['es_username']
+    password = st.secrets['es_password']
+    cloudid = st.secrets['es_cloudid']
+    return create_es_client(username, password, cloudid)
+
+
+def create_async_es_client():
+    """
+    AsyncElasticsearch client with the same settings as get_es_client. Async clients are bound to the
+    event loop they are used on; the app shares one on a background loop (utils/async_clients).
+    """
+    return AsyncElasticsearch(
+        cloud_id=st.secrets['es_cloudid'],
+        basic_auth=(st.secrets['es_username'], st.secrets['es_password']),
+        connections_per_node=es_connections_per_node,
+        request_timeout=es_request_timeout,
+        max_retries=es_max_retries,
+        retry_on_timeout=es_retry_on_timeout,
+        http_compress=es_http_compress
+    )
+
+
+def manage_index(es: Elasticsearch, index_name: str, settings: dict, mappings: dict, deleteIndex: bool,
+                 vector_quantization: str = vector_index_quantization):
+    # Optionally store dense_vector fields with quantized HNSW index options (int8_hnsw, int4_hnsw, bbq_hnsw);
+    # Elasticsearch keeps the float vectors too, so kNN queries can rescore on full precision
+    if vector_quantization:
+        mappings = quantize_dense_vector_mappings(mappings, vector_quantization)
 
-def manage_index(es: Elasticsearch, index_name: str, settings: dict, mappings: dict, deleteIndex: bool):
     if es.indices.exists(index=index_name):
         if deleteIndex:
             print(f"Index {index_name} exists. Deleting it...")
@@ -0,0 +1,83 @@
+##Client-side rank fusion for hybrid search: combines the hit lists of several retrievers
+##(BM25, kNN, ELSER) without the server-side rank.rrf feature, so it works on any license and
+##rank_constant/window_size/weights can be tuned without re-running the retrievals.
+
+import numpy as np
+
+FUSION_METHODS = ("rrf", "weighted", "convex")
+
+
+def _score_matrix(result_lists):
+    # Rows are retrievers, columns are the union of doc ids; missing entries are NaN
+    doc_ids = []
+    column = {}
+    for hits in result_lists:
+        for hit in hits:
+            if hit['_id'] not in column:
+                column[hit['_id']] = len(doc_ids)
+                doc_ids.append(hit['_id'])
+
+    scores = np.full((len(result_lists), len(doc_ids)), np.nan, dtype=np.float64)
+    ranks = np.full((len(result_lists), len(doc_ids)), np.nan, dtype=np.float64)
+    for row, hits in enumerate(result_lists):
+        for rank, hit in enumerate(hits, start=1):
+            col = column[hit['_id']]
+            scores[row, col] = hit['_score'] or 0.0
+            ranks[row, col] = rank
+    return doc_ids, scores, ranks
+
+
+def _min_max(scores):
+    low = np.nanmin(scores, axis=1, keepdims=True)
+    high = np.nanmax(scores, axis=1, keepdims=True)
+    spread = np.where(high - low > 0, high - low, 1.0)
+    return (scores - low) / spread
+
+
+def _z_score(scores):
+    mean = np.nanmean(scores, axis=1, keepdims=True)
+    std = np.nanstd(scores, axis=1, keepdims=True)
+    return (scores - mean) / np.where(std > 0, std, 1.0)
+
+
+def fuse(result_lists, method="rrf", weights=None, rank_constant=60, window_size=100):
+    """
+    Fuse several ranked hit lists into one.
+
+    Parameters:
+    - result_lists: One list of raw hits (dicts with _id and _score) per retriever.
+    - method: "rrf" (reciprocal rank fusion), "weighted" (weighted sum of z-score normalized scores)
+      or "convex" (convex combination of min-max normalized scores, weights rescaled to sum to 1).
+    - weights: Per-retriever weights, default all 1.
+    - rank_constant: RRF k constant.
+    - window_size: Only the top window_size hits of each list take part.
+
+    Returns:
+    - A list of (doc_id, fused_score) sorted by descending score.
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Invalid fusion method: {method}")
+
+    if weights is None:
+        weights = [1.0] * len(result_lists)
+
+    # Retrievers that returned nothing are left out so they do not skew the normalization
+    kept = [i for i, hits in enumerate(result_lists) if hits]
+    result_lists = [result_lists[i][:window_size] for i in kept]
+    doc_ids, scores, ranks = _score_matrix(result_lists)
+    if not doc_ids:
+        return []
+
+    weights = np.asarray([weights[i] for i in kept], dtype=np.float64).reshape(-1, 1)
+
+    if method == "rrf":
+        contributions = np.where(np.isnan(ranks), 0.0, 1.0 / (rank_constant + ranks))
+    elif method == "weighted":
+        contributions = np.nan_to_num(_z_score(scores), nan=0.0)
+    else:
+        weights = weights / weights.sum()
+        contributions = np.nan_to_num(_min_max(scores), nan=0.0)
+
+    fused = (weights * contributions).sum(axis=0)
+    order = np.argsort(-fused, kind="stable")
+    return [(doc_ids[i], float(fused[i])) for i in order]
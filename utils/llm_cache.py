@@ -0,0 +1,355 @@
+##Two-tier LLM response cache in front of ElasticsearchLLMCache (the llm_cache index).
+##Tier 1 is in-process: an exact-match dict on normalized prompt text plus a semantic matrix of prompt
+##vectors with LRU eviction. Tier 2 is the llm_cache index, queried with the prompt vector already
+##computed for tier 1. Writes to the index are queued and bulk indexed on a background thread.
+##Entries are scoped by a context fingerprint (system prompt, retrieved titles, deployment and a coarse
+##bucket of the prompt embedding), so an answer is only reused for the same retrieval context.
+
+import atexit
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import streamlit as st
+from elasticsearch import helpers
+from elasticsearch_llm_cache.elasticsearch_llm_cache import ElasticsearchLLMCache
+
+from utils.embedding_cache import embedding_cache, normalize_query_text
+from variables import llm_cache_index_name, llm_cache_local_size, llm_cache_flush_interval, llm_cache_flush_size
+from variables import llm_cache_bucket_bits
+
+logger = logging.getLogger(__name__)
+
+
+def cache_context(system_prompt, titles, deployment):
+    """
+    Canonical key for everything besides the question that shapes a cached answer: the system
+    prompt, the set of retrieved titles (order and duplicates ignored) and the model deployment.
+    """
+    canonical = json.dumps({
+        'system_prompt': system_prompt,
+        'titles': sorted({title.strip().lower() for title in titles}),
+        'deployment': deployment
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class EmbeddingBucketer:
+    """
+    SimHash of a prompt vector: the sign pattern against `bits` fixed random hyperplanes. Nearby
+    prompts usually share a bucket; more bits make buckets narrower.
+    """
+
+    def __init__(self, bits=4, seed=0):
+        self.bits = bits
+        self.seed = seed
+        self.planes = None
+
+    def bucket(self, vector):
+        if not self.bits or vector is None:
+            return 0
+        if self.planes is None or self.planes.shape[1] != len(vector):
+            self.planes = np.random.default_rng(self.seed).standard_normal((self.bits, len(vector)))
+        signs = self.planes @ vector > 0
+        return int(signs @ (1 << np.arange(self.bits)))
+
+
+def context_fingerprint(context, bucket):
+    """
+    The cache scope of an entry: its context key plus the prompt embedding bucket.
+    """
+    return hashlib.sha256(f"{context}:{bucket}".encode('utf-8')).hexdigest()
+
+
+class LocalSemanticCache:
+    """
+    In-process prompt -> response cache with exact and nearest-neighbour lookup.
+
+    Prompt vectors live in a preallocated (max_size, dims) float32 matrix; a free slot list and an
+    LRU order over slots give O(1) insert and eviction, and a semantic lookup is one matrix-vector
+    product over the occupied rows. Keys are (context, normalized prompt) and semantic matches are
+    limited to slots with the same context fingerprint.
+    """
+
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.matrix = None
+        self.occupied = None
+        self.fingerprints = np.full(max_size, None, dtype=object)
+        self.slots = OrderedDict()  # slot -> (key, response), in LRU order
+        self.exact = {}  # (context, normalized prompt) -> slot
+        self.free = list(range(max_size - 1, -1, -1))
+        self.lock = threading.Lock()
+
+    def _evict(self):
+        slot, (key, _) = self.slots.popitem(last=False)
+        del self.exact[key]
+        if self.occupied is not None:
+            self.occupied[slot] = False
+        self.free.append(slot)
+
+    def get(self, key, vector, similarity_threshold, fingerprint=None):
+        """
+        The cached response for key, or for the most similar cached prompt with the same fingerprint
+        and a dot product of at least similarity_threshold. Returns (response, score) or None.
+        """
+        with self.lock:
+            slot = self.exact.get(key)
+            if slot is not None:
+                self.slots.move_to_end(slot)
+                return self.slots[slot][1], 1.0
+            if vector is None or self.matrix is None or not self.slots:
+                return None
+
+            scores = np.where(self.occupied & (self.fingerprints == fingerprint), self.matrix @ vector, -np.inf)
+            slot = int(np.argmax(scores))
+            if scores[slot] < similarity_threshold:
+                return None
+            self.slots.move_to_end(slot)
+            return self.slots[slot][1], float(scores[slot])
+
+    def put(self, key, vector, response, fingerprint=None):
+        with self.lock:
+            if key in self.exact:
+                slot = self.exact[key]
+            else:
+                if not self.free:
+                    self._evict()
+                slot = self.free.pop()
+            if vector is not None:
+                if self.matrix is None:
+                    self.matrix = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+                    self.occupied = np.zeros(self.max_size, dtype=bool)
+                self.matrix[slot] = vector
+                self.occupied[slot] = True
+            self.fingerprints[slot] = fingerprint
+            self.exact[key] = slot
+            self.slots[slot] = (key, response)
+            self.slots.move_to_end(slot)
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class TierStats:
+    """
+    Hits, misses and cumulative lookup latency of one cache tier.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.latency = 0.0
+
+    def record(self, hit, started_at):
+        self.latency += time.perf_counter() - started_at
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'mean_latency_ms': self.latency / lookups * 1000 if lookups else 0.0
+        }
+
+
+class TwoTierLLMCache:
+    """
+    Drop-in for ElasticsearchLLMCache's query/add/create_index with a local tier in front.
+
+    Parameters:
+    - es_cache: The ElasticsearchLLMCache whose index and embedding model are used.
+    - local_size: Maximum number of responses held in process.
+    - flush_interval: Seconds between background bulk writes to the index.
+    - flush_size: Queued writes that trigger an early flush.
+    - bucket_bits: SimHash bits of the prompt embedding in the context fingerprint, 0 to leave it out.
+
+    query and add take an optional context (see cache_context); entries are only reused for the same
+    context and embedding bucket. Without a context they behave like the plain prompt cache.
+    """
+
+    def __init__(self, es_cache, local_size=512, flush_interval=1.0, flush_size=32, bucket_bits=4):
+        self.es_cache = es_cache
+        self.es = es_cache.es
+        self.index_name = es_cache.index_name
+        self.local = LocalSemanticCache(local_size)
+        self.bucketer = EmbeddingBucketer(bucket_bits)
+        self.local_stats = TierStats()
+        self.es_stats = TierStats()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.writes = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="llm-cache-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def create_index(self, dims=768):
+        return self.es_cache.create_index(dims)
+
+    def prompt_vector(self, prompt_text):
+        """
+        Unit-length prompt vector from the cache's embedding model, via the query-embedding cache.
+        """
+        vector = embedding_cache.get_or_compute(self.es_cache.es_model_id, prompt_text,
+                                                self.es_cache._generate_vector)
+        if not vector:
+            return None
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def fingerprint(self, context, vector):
+        return context_fingerprint(context, self.bucketer.bucket(vector)) if context else None
+
+    def query(self, prompt_text, similarity_threshold=0.5, num_candidates=1000, create_date_gte="now-1y/y",
+              context=None):
+        """
+        Same contract as ElasticsearchLLMCache.query: the hit's fields (prompt, response, _score, ...)
+        with values as lists, or {} on a miss.
+        """
+        key = (context, normalize_query_text(prompt_text))
+
+        started_at = time.perf_counter()
+        local_hit = self.local.get(key, None, similarity_threshold)
+        vector = None
+        fingerprint = None
+        if local_hit is None:
+            vector = self.prompt_vector(prompt_text)
+            fingerprint = self.fingerprint(context, vector)
+            local_hit = self.local.get(key, vector, similarity_threshold, fingerprint)
+        self.local_stats.record(local_hit is not None, started_at)
+        if local_hit is not None:
+            response, score = local_hit
+            return {'prompt': [prompt_text], 'response': [response], '_score': score, 'tier': 'local'}
+
+        started_at = time.perf_counter()
+        fields = self._query_index(vector, similarity_threshold, num_candidates, create_date_gte, fingerprint)
+        self.es_stats.record(bool(fields), started_at)
+        if fields:
+            self.local.put(key, vector, fields['response'][0], fingerprint)
+            fields['tier'] = 'elasticsearch'
+        return fields
+
+    def _query_index(self, vector, similarity_threshold, num_candidates, create_date_gte, fingerprint):
+        if vector is None:
+            return {}
+        filters = [{"range": {"create_date": {"gte": create_date_gte}}}]
+        if fingerprint:
+            filters.append({"term": {"metadata.fingerprint.keyword": fingerprint}})
+        knn = {
+            "field": "prompt_vector",
+            "k": 1,
+            "num_candidates": num_candidates,
+            "similarity": similarity_threshold,
+            "query_vector": vector.tolist(),
+            "filter": {"bool": {"filter": filters}}
+        }
+        resp = self.es.search(index=self.index_name, knn=knn, fields=["prompt", "response", "metadata*"],
+                              size=1, source=False, filter_path=["hits.hits._id", "hits.hits._score",
+                                                                 "hits.hits.fields"])
+        hits = resp.get('hits', {}).get('hits', [])
+        if not hits:
+            return {}
+        self.writes.put({"_op_type": "update", "_index": self.index_name, "_id": hits[0]['_id'],
+                         "doc": {"last_hit_date": datetime.now()}})
+        fields = hits[0]['fields']
+        fields['_score'] = hits[0]['_score']
+        return fields
+
+    def add(self, prompt, response, source=None, metadata=None, context=None):
+        """
+        Cache a response locally right away and queue the llm_cache document for the background writer.
+        """
+        vector = self.prompt_vector(prompt)
+        fingerprint = self.fingerprint(context, vector)
+        self.local.put((context, normalize_query_text(prompt)), vector, response, fingerprint)
+        if vector is None:
+            return {'success': False, 'error': 'no prompt vector'}
+        if fingerprint:
+            metadata = dict(metadata or {}, context=context, fingerprint=fingerprint)
+
+        now = datetime.now()
+        self.writes.put({"_op_type": "index", "_index": self.index_name, "_source": {
+            "prompt": prompt,
+            "response": response,
+            "create_date": now,
+            "last_hit_date": now,
+            "prompt_vector": vector.tolist(),
+            "source": source,
+            "metadata": metadata
+        }})
+        return {'success': True, 'queued': True}
+
+    def _run(self):
+        while True:
+            actions = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(actions) < self.flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    actions.append(self.writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(actions)
+            for _ in actions:
+                self.writes.task_done()
+
+    def _write(self, actions):
+        try:
+            _, errors = helpers.bulk(self.es, actions, raise_on_error=False)
+            for error in errors:
+                logger.error(f"LLM cache write failed: {error}")
+        except Exception as e:
+            logger.error(f"LLM cache bulk write failed: {e}")
+
+    def flush(self):
+        """
+        Write any queued documents now and wait for writes in progress (used at exit and by batch jobs;
+        the background thread handles normal operation).
+        """
+        actions = []
+        while True:
+            try:
+                actions.append(self.writes.get_nowait())
+            except queue.Empty:
+                break
+        if actions:
+            self._write(actions)
+            for _ in actions:
+                self.writes.task_done()
+        self.writes.join()
+
+    def stats(self):
+        return {
+            'local': self.local_stats.as_dict(),
+            'elasticsearch': self.es_stats.as_dict(),
+            'local_size': len(self.local),
+            'pending_writes': self.writes.qsize()
+        }
+
+
+@st.cache_resource
+def get_llm_cache(_es):
+    """
+    Process-wide two-tier cache, so the local tier survives Streamlit reruns and is shared by sessions.
+    """
+    es_cache = ElasticsearchLLMCache(
+        es_client=_es,
+        index_name=llm_cache_index_name,
+        create_index=False,  # setting only because of Streamlit behavor
+    )
+    return TwoTierLLMCache(es_cache, llm_cache_local_size, llm_cache_flush_interval, llm_cache_flush_size,
+                           llm_cache_bucket_bits)
@@ -0,0 +1,220 @@
+##In-process vector index for the movie catalog, used for "Vector" and "Vector OpenAI" searches
+##instead of (or as a fallback for) the Elasticsearch kNN round-trip.
+##The vectors are a contiguous float32 matrix saved as .npy and memory-mapped on load; search is an
+##exact dot product (one BLAS matrix-vector product) with an optional HNSW index when hnswlib is installed.
+##"Vector" queries are embedded locally with sentence-transformers when it is installed, so the index keeps
+##answering while the Elasticsearch ML node is unreachable.
+##Build with: python -m utils.local_vector_index
+
+import json
+import os
+import time
+
+import numpy as np
+import streamlit as st
+from elasticsearch import helpers
+
+from utils.embedding_cache import embedding_cache
+from utils.query_templates import HIT_SOURCE
+from utils.vector_quantization import QuantizedVectors, rescore
+from variables import byom_index_name, vector_embedding_field, local_vector_index_dir, local_vector_index_hnsw
+from variables import local_vector_index_quantization, local_vector_index_oversample, \
+    local_vector_index_binary_oversample, local_embedding_model, model
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # "Vector" queries need the Elasticsearch ML node
+    SentenceTransformer = None
+
+try:
+    import hnswlib
+except ImportError:  # exact search only
+    hnswlib = None
+
+# searchtype -> (index file name, vector path in _source, one vector per passage?)
+LOCAL_INDEX_SOURCES = {
+    "Vector": ("minilm_passages", "passages.vector.predicted_value", True),
+    "Vector OpenAI": ("openai_docs", vector_embedding_field, False),
+}
+
+
+def _get_path(source, dotted_path):
+    value = source
+    for key in dotted_path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _doc_vectors(source, vector_path, per_passage):
+    if per_passage:
+        passages_key, rest = vector_path.split(".", 1)
+        return [v for v in (_get_path(p, rest) for p in source.get(passages_key, [])) if v]
+    vector = _get_path(source, vector_path)
+    return [vector] if vector else []
+
+
+def _strip_source(source):
+    # Keep only the fields search consumers read (see HIT_SOURCE), without vectors
+    kept = {field: source[field] for field in ("title", "url", "additional_urls", "body_content") if field in source}
+    if source.get("passages"):
+        kept["passages"] = [{"text": p.get("text")} for p in source["passages"]]
+    return kept
+
+
+def _index_files(directory, name):
+    return [os.path.join(directory, f"{name}{suffix}") for suffix in (".npy", ".rows.npy", ".docs.json")]
+
+
+def _write_atomically(path, write):
+    # Replace instead of overwriting in place: a running app keeps its memory-mapped copy valid until it
+    # notices the new files and reloads
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def build_local_vector_index(es, searchtype, directory=local_vector_index_dir, index_name=byom_index_name):
+    """
+    Scan the index and write <name>.npy (float32 vectors), <name>.rows.npy (row -> doc) and
+    <name>.docs.json (doc ids and trimmed sources) for the searchtype.
+    """
+    name, vector_path, per_passage = LOCAL_INDEX_SOURCES[searchtype]
+    os.makedirs(directory, exist_ok=True)
+
+    vectors = []
+    row_docs = []
+    doc_ids = []
+    sources = []
+    source_fields = HIT_SOURCE["includes"] + [vector_path]
+    for doc in helpers.scan(es, index=index_name, _source=source_fields):
+        doc_vectors = _doc_vectors(doc["_source"], vector_path, per_passage)
+        if not doc_vectors:
+            continue
+        vectors.extend(doc_vectors)
+        row_docs.extend([len(doc_ids)] * len(doc_vectors))
+        doc_ids.append(doc["_id"])
+        sources.append(_strip_source(doc["_source"]))
+
+    vectors_file, rows_file, docs_file = _index_files(directory, name)
+    _write_atomically(vectors_file, lambda f: np.save(f, np.asarray(vectors, dtype=np.float32)))
+    _write_atomically(rows_file, lambda f: np.save(f, np.asarray(row_docs, dtype=np.int32)))
+    _write_atomically(docs_file, lambda f: f.write(json.dumps({"ids": doc_ids, "sources": sources}).encode("utf-8")))
+
+    print(f"Local vector index {name}: {len(vectors)} vectors for {len(doc_ids)} documents")
+
+
+class LocalVectorIndex:
+    """
+    Memory-mapped float32 vectors with exact dot-product top-k, or HNSW when use_hnsw is set and
+    hnswlib is available, or int8/int4/binary quantized candidate selection with full-precision rescoring
+    when quantization is set. Scores follow Elasticsearch's dot_product similarity, (1 + dot) / 2, and
+    passage-level vectors are aggregated to the best passage per document.
+    """
+
+    def __init__(self, directory, name, use_hnsw=False, quantization=None, oversample=4):
+        self.matrix = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+        self.row_docs = np.load(os.path.join(directory, f"{name}.rows.npy"))
+        with open(os.path.join(directory, f"{name}.docs.json")) as f:
+            docs = json.load(f)
+        self.doc_ids = docs["ids"]
+        self.sources = docs["sources"]
+        if self.matrix.ndim != 2:
+            # An index built from no vectors is saved as an empty 1-d array
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+        self.hnsw = None
+        if use_hnsw and hnswlib is not None and len(self.matrix):
+            self.hnsw = hnswlib.Index(space="ip", dim=self.matrix.shape[1])
+            self.hnsw.init_index(max_elements=len(self.matrix), ef_construction=200, M=16)
+            self.hnsw.add_items(np.asarray(self.matrix))
+            self.hnsw.set_ef(100)
+
+        # With quantization only the compact codes stay resident; full vectors are read for rescoring
+        self.quantized = QuantizedVectors(np.asarray(self.matrix), quantization) \
+            if quantization and len(self.matrix) else None
+        self.oversample = oversample
+
+    def _row_scores(self, query, candidates):
+        if not len(self.matrix):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.hnsw is not None:
+            rows, distances = self.hnsw.knn_query(query, k=min(candidates, len(self.matrix)))
+            # hnswlib's "ip" distance is 1 - dot
+            return rows[0], 1.0 - distances[0]
+        if self.quantized is not None:
+            return rescore(self.matrix, self.quantized.candidates(query, candidates * self.oversample), query)
+        dots = self.matrix @ query
+        count = min(candidates, len(dots))
+        rows = np.argpartition(-dots, count - 1)[:count]
+        return rows, dots[rows]
+
+    def search(self, query_vector, k=5):
+        """
+        Top-k documents for the query vector, shaped like an Elasticsearch search response.
+        """
+        start_time = time.time()
+        query = np.asarray(query_vector, dtype=np.float32)
+
+        # Over-fetch passages so k distinct documents survive the per-document aggregation
+        rows, dots = self._row_scores(query, k * 10)
+        best = {}
+        for row, dot in zip(rows.tolist(), dots.tolist()):
+            doc = int(self.row_docs[row])
+            if dot > best.get(doc, -np.inf):
+                best[doc] = dot
+        top = sorted(best.items(), key=lambda item: item[1], reverse=True)[:k]
+
+        hits = [{"_id": self.doc_ids[doc], "_score": (1.0 + dot) / 2, "_source": self.sources[doc]}
+                for doc, dot in top]
+        return {"took": int((time.time() - start_time) * 1000), "hits": {"hits": hits}}
+
+
+def get_local_vector_index(searchtype):
+    """
+    Process-wide local index for a searchtype, or None if it has not been built (checked on every
+    call, so an index built or rebuilt while the app runs is picked up).
+    """
+    name, _, _ = LOCAL_INDEX_SOURCES[searchtype]
+    index_files = _index_files(local_vector_index_dir, name)
+    if not all(os.path.exists(path) for path in index_files):
+        print(f"Local vector index {name} not built, using Elasticsearch")
+        return None
+    # The files' modification times are part of the cache key, so a rebuild is loaded on the next search
+    return _load_local_vector_index(searchtype, tuple(os.stat(path).st_mtime_ns for path in index_files))
+
+
+# Bounded to one entry per searchtype, so indices replaced by a rebuild are evicted instead of accumulating
+@st.cache_resource(max_entries=len(LOCAL_INDEX_SOURCES))
+def _load_local_vector_index(searchtype, files_mtime):
+    name, _, _ = LOCAL_INDEX_SOURCES[searchtype]
+    oversample = local_vector_index_binary_oversample if local_vector_index_quantization == "binary" \
+        else local_vector_index_oversample
+    return LocalVectorIndex(local_vector_index_dir, name, local_vector_index_hnsw, local_vector_index_quantization,
+                            oversample)
+
+
+
+@st.cache_resource
+def _get_local_embedder():
+    return SentenceTransformer(local_embedding_model)
+
+
+def local_query_vector(text):
+    """
+    MiniLM vector for a "Vector" query computed in-process, or None without sentence-transformers.
+    Shares the query-embedding cache entries of the Elasticsearch-inferred vectors for the same model.
+    """
+    if SentenceTransformer is None:
+        return None
+    return embedding_cache.get_or_compute(
+        model, text, lambda query_text: _get_local_embedder().encode(query_text, normalize_embeddings=True).tolist())
+
+
+if __name__ == "__main__":
+    from utils.es_helper import get_es_client
+
+    for local_searchtype in LOCAL_INDEX_SOURCES:
+        build_local_vector_index(get_es_client(), local_searchtype)
@@ -0,0 +1,79 @@
+##Compact representation of a movie search hit, unpacked once per search and shared by the
+##result printers and the prompt builders instead of re-indexing results['hits']['hits'][i] dicts.
+
+from variables import hit_body_max_chars, hit_passage_max_chars
+
+
+class MovieHit:
+    """
+    The fields of a movie hit the app reads, with truncation limits applied in one place.
+
+    - url prefers the first of additional_urls over url.
+    - first_passage is the text of the best matching passage from inner_hits (nested kNN searches),
+      otherwise of the first passage in _source.
+    """
+
+    __slots__ = ("doc_id", "title", "url", "body_content", "first_passage", "score")
+
+    def __init__(self, doc_id, title, url, body_content, first_passage, score):
+        self.doc_id = doc_id
+        self.title = title
+        self.url = url
+        self.body_content = body_content
+        self.first_passage = first_passage
+        self.score = score
+
+    @classmethod
+    def from_hit(cls, hit):
+        source = hit.get("_source", {})
+
+        additional_urls = source.get("additional_urls")
+        url = additional_urls[0] if additional_urls else source.get("url", "No URL available")
+
+        first_passage = _inner_hit_passage(hit)
+        if first_passage is None:
+            passages = source.get("passages")
+            first_passage = passages[0].get("text", "No passages text available") if passages \
+                else "No passages text available"
+
+        return cls(
+            hit.get("_id"),
+            source.get("title", "No title available"),
+            url,
+            _truncate(source.get("body_content", "No body content available"), hit_body_max_chars),
+            _truncate(first_passage, hit_passage_max_chars),
+            hit.get("_score")
+        )
+
+    def __repr__(self):
+        return f"MovieHit({self.title!r}, score={self.score})"
+
+
+def _inner_hit_passage(hit):
+    # Nested inner hits carry the passage object itself as _source, best match first
+    inner_hits = hit.get("inner_hits", {}).get("passages", {}).get("hits", {}).get("hits")
+    if inner_hits:
+        return inner_hits[0].get("_source", {}).get("text")
+    return None
+
+
+def _truncate(text, max_chars):
+    if max_chars and text and len(text) > max_chars:
+        return text[:max_chars]
+    return text
+
+
+def iter_hits(results, limit=None):
+    """
+    Lazily yield MovieHit objects from a raw search response, up to limit hits.
+    """
+    hits = (results or {}).get('hits', {}).get('hits', [])
+    for hit in hits[:limit]:
+        yield MovieHit.from_hit(hit)
+
+
+def hits_from_response(results, limit=None):
+    """
+    MovieHit list for a raw search response, up to limit hits.
+    """
+    return list(iter_hits(results, limit))
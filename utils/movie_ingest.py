@@ -0,0 +1,175 @@
+##Client-side replacement for the movie-chunker ingest pipeline (output/ingest_pipeline.json).
+##Overviews are split into passages on a process pool with the same rules as the Painless script,
+##passages are embedded with multi-document infer_trained_model calls (MiniLM and ELSER) and the
+##finished documents are bulk indexed, so throughput scales with client cores instead of ingest nodes.
+##Run with: python -m utils.movie_ingest <source_index> [target_index]
+
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from elasticsearch import ApiError, helpers
+
+from utils.query_templates import ELSER_PASSAGE_MODEL
+from utils.text_segmentation import SENTENCE_BOUNDARY
+from variables import model, byom_index_name, scan_page_size, bulk_chunk_size
+from variables import ingest_model_limit, ingest_doc_batch_size, ingest_inference_batch_size, \
+    ingest_chunk_workers, ingest_inference_workers
+
+# (model id, passage field the results go to), as in the pipeline's two foreach inference processors
+PASSAGE_MODELS = [
+    (model, "vector"),
+    (ELSER_PASSAGE_MODEL, "content_embedding"),
+]
+
+
+def chunk_text(text, model_limit=ingest_model_limit):
+    """
+    Split text into passages of whole sentences, joining sentences while the passage stays under
+    model_limit characters. Mirrors the Painless script, including a single over-long sentence
+    becoming its own passage.
+    """
+    # Java's String.split drops trailing empty strings
+    sentences = SENTENCE_BOUNDARY.split(text)
+    while len(sentences) > 1 and not sentences[-1]:
+        sentences.pop()
+
+    passages = []
+    i = 0
+    while i < len(sentences):
+        passage = sentences[i]
+        i += 1
+        while i < len(sentences) and len(passage) + len(sentences[i]) < model_limit:
+            passage = passage + " " + sentences[i]
+            i += 1
+        passages.append({"text": passage})
+    return passages
+
+
+def chunk_document(doc, model_limit=ingest_model_limit):
+    """
+    Add the passages list to a scanned document's _source (runs in a worker process).
+    """
+    overview = doc["_source"].get("overview")
+    doc["_source"]["passages"] = chunk_text(overview, model_limit) if overview else []
+    return doc
+
+
+def _inference_error(doc, message):
+    # Same shape as the pipeline's on_failure append, so failed documents can be found the same way
+    errors = doc["_source"].setdefault("_ingest", {}).setdefault("inference_errors", [])
+    errors.append({
+        "message": f"Client-side inference failed with message '{message}'",
+        "pipeline": "movie-ingest",
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    })
+
+
+def infer_passages(es, documents, batch_size=ingest_inference_batch_size):
+    """
+    Run every passage of the documents through each model in PASSAGE_MODELS with up to batch_size
+    texts per infer_trained_model call, storing results on the passages in place.
+
+    Returns:
+    - The number of inference calls made.
+    """
+    passages = [(doc, passage) for doc in documents for passage in doc["_source"]["passages"]]
+    calls = 0
+    for model_id, target_field in PASSAGE_MODELS:
+        for start in range(0, len(passages), batch_size):
+            batch = passages[start:start + batch_size]
+            calls += 1
+            try:
+                response = es.ml.infer_trained_model(model_id=model_id,
+                                                     docs=[{"text_field": p["text"]} for _, p in batch],
+                                                     timeout="60s")
+            except ApiError as e:
+                for doc in {id(doc): doc for doc, _ in batch}.values():
+                    _inference_error(doc, e)
+                continue
+            for (_, passage), result in zip(batch, response["inference_results"]):
+                passage[target_field] = dict(result, model_id=model_id)
+    return calls
+
+
+def iter_source_batches(es, source_index, batch_size=ingest_doc_batch_size):
+    """
+    Lazily yield lists of up to batch_size raw movie documents from the source index.
+    """
+    batch = []
+    for doc in helpers.scan(es, index=source_index, size=scan_page_size):
+        batch.append({"_id": doc["_id"], "_source": doc["_source"]})
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_inferred_documents(es, source_index, stats, chunk_workers=ingest_chunk_workers,
+                            inference_workers=ingest_inference_workers):
+    """
+    Chunk each batch on a process pool, infer it on a bounded thread pool and yield finished
+    documents in scan order. At most inference_workers batches are in flight.
+    """
+    def chunk_and_infer(batch):
+        chunked = list(chunk_pool.map(chunk_document, batch))
+        return chunked, infer_passages(es, chunked)
+
+    def drain(future):
+        documents, calls = future.result()
+        stats["inference_calls"] += calls
+        return documents
+
+    with ProcessPoolExecutor(max_workers=chunk_workers) as chunk_pool, \
+            ThreadPoolExecutor(max_workers=inference_workers) as inference_pool:
+        in_flight = deque()
+        for batch in iter_source_batches(es, source_index):
+            in_flight.append(inference_pool.submit(chunk_and_infer, batch))
+            if len(in_flight) >= inference_workers:
+                yield from drain(in_flight.popleft())
+        while in_flight:
+            yield from drain(in_flight.popleft())
+
+
+def ingest_movies(es, source_index, target_index=byom_index_name, chunk_size=bulk_chunk_size, report_every=1000):
+    """
+    Chunk, embed and index every movie in source_index into target_index without an ingest pipeline.
+    Source _ids are kept, so re-runs overwrite instead of duplicating.
+
+    Returns:
+    - A dictionary with docs, failed, passages, inference_calls and elapsed seconds.
+    """
+    stats = {"docs": 0, "failed": 0, "passages": 0, "inference_calls": 0}
+    start_time = time.time()
+
+    def actions():
+        for doc in iter_inferred_documents(es, source_index, stats):
+            stats["passages"] += len(doc["_source"]["passages"])
+            yield {"_op_type": "index", "_index": target_index, "_id": doc["_id"], "_source": doc["_source"]}
+
+    for ok, item in helpers.streaming_bulk(es, actions(), chunk_size=chunk_size, raise_on_error=False):
+        stats["docs"] += 1
+        if not ok:
+            stats["failed"] += 1
+            print(f"Failed to index document: {item}")
+        if stats["docs"] % report_every == 0:
+            _print_throughput(stats, start_time)
+
+    stats["elapsed"] = time.time() - start_time
+    _print_throughput(stats, start_time)
+    return stats
+
+
+def _print_throughput(stats, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Ingest progress: {stats['docs']} docs ({stats['failed']} failed), {stats['passages']} passages, "
+          f"{stats['inference_calls']} inference calls, {stats['docs'] / elapsed:.1f} docs/s")
+
+
+if __name__ == "__main__":
+    from utils.es_helper import get_es_client
+
+    ingest_movies(get_es_client(), *sys.argv[1:])
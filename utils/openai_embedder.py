@@ -2,24 +2,30 @@
 ##create a vector representation of that field using azure open ai ada002 model
 ##then store the new document in a new index.  The embedding will be stored in the field text_embedding.predicted_value
 
+import hashlib
+import json
+import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import openai
 import time
-from utils.es_helper import create_es_client
-from variables import openai_embedding_deployment_name, rate_throttle
+from utils.es_helper import get_es_client
+from utils.embedding_cache import embedding_cache
+from utils.rate_limiter import get_rate_limiter, estimate_tokens
+from variables import openai_embedding_deployment_name
+from variables import embedding_batch_size, embedding_max_workers, scan_page_size, bulk_chunk_size
+from variables import checkpoint_pit_keep_alive
 from variables import openai_api_type, openai_api_base, openai_api_version
 import streamlit as st
 
-from elasticsearch import helpers
+from elasticsearch import helpers, NotFoundError
 
 
 # Connect to Elasticsearch
 try:
-    username = st.secrets['es_username']
-    password = st.secrets['es_password']
-    cloudid = st.secrets['es_cloudid']
-    es = create_es_client(username, password, cloudid)
+    es = get_es_client()
 except Exception as e:
     print("Connection failed", str(e))
     st.error("Error connecting to Elasticsearch. Fix connection and restart app")
@@ -36,15 +42,45 @@ def get_embedding(input_text):
     openai.api_key = st.secrets['pass']
 
 
-    response = openai.embeddings.create(input=[input_text], model=openai_embedding_deployment_name).data[0].embedding
+    # Throttling against the deployment quota
+    limiter = get_rate_limiter(openai_embedding_deployment_name)
+    response = limiter.call(
+        lambda: openai.embeddings.create(input=[input_text], model=openai_embedding_deployment_name),
+        estimate_tokens(input_text)).data[0].embedding
 
+    return response
 
-    # Throttling as per configuration
-    time.sleep(rate_throttle)
 
-    return response
+def get_query_embedding(query_text):
+    """
+    get_embedding for search queries, served from the query-embedding cache when possible.
+    """
+    return embedding_cache.get_or_compute(openai_embedding_deployment_name, query_text, get_embedding)
 
 
+def get_embeddings(input_texts):
+    """
+    Embed several texts with a single multi-input embeddings.create call.
+
+    Returns:
+    - A tuple (embeddings, total_tokens) with the embeddings in input order.
+    """
+    openai.api_type = openai_api_type
+    openai.api_base = openai_api_base
+    openai.api_version = openai_api_version
+    openai.azure_endpoint = openai_api_base
+    openai.api_key = st.secrets['pass']
+
+    limiter = get_rate_limiter(openai_embedding_deployment_name)
+    response = limiter.call(
+        lambda: openai.embeddings.create(input=input_texts, model=openai_embedding_deployment_name),
+        estimate_tokens(input_texts))
+
+    # The service does not guarantee ordering, so sort on the returned index
+    embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    total_tokens = response.usage.total_tokens if response.usage else 0
+
+    return embeddings, total_tokens
 
 
 def get_documents_from_index(index_name):
@@ -64,8 +100,8 @@ def add_document_with_embedding(index_name, source_field_name, document):
     embedding = get_embedding(doc_data[source_field_name])
     # Add the embedding to the 'text_embedding.predicted_value' field
     doc_data['text_embedding'] = {"predicted_value": embedding}
-    # Add the new document to the index
-    es.index(index=index_name, body=doc_data)
+    # Add the new document to the index, keeping the source _id so re-runs overwrite instead of duplicating
+    es.index(index=index_name, id=document['_id'], body=doc_data)
 
 
 def process_documents(source_index_name, source_field_name, target_index_name):
@@ -77,6 +113,288 @@ def process_documents(source_index_name, source_field_name, target_index_name):
         add_document_with_embedding(target_index_name, source_field_name, doc)
 
 
+def source_text_hash(text):
+    """
+    Stable fingerprint of the text an embedding was computed from.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def load_checkpoint(checkpoint_file):
+    """
+    Read a re-embed checkpoint. Returns None when no checkpoint exists.
+    """
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    """
+    Atomically persist a re-embed checkpoint so a crash mid-write never leaves a corrupt file.
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def open_scan_pit(index_name):
+    """
+    Open a point in time on the index for a resumable scan. Returns a dict whose 'id' iter_pit_documents
+    keeps current.
+    """
+    return {'id': es.open_point_in_time(index=index_name, keep_alive=checkpoint_pit_keep_alive)['id']}
+
+
+def pit_is_open(pit):
+    """
+    Whether a checkpointed point in time is still alive (it expires checkpoint_pit_keep_alive after the
+    last page was read).
+    """
+    try:
+        es.search(pit={"id": pit['id'], "keep_alive": checkpoint_pit_keep_alive}, size=0, track_total_hits=False)
+        return True
+    except NotFoundError:
+        return False
+
+
+def iter_pit_documents(pit, search_after=None):
+    """
+    Yield every document of a point in time in _shard_doc order, starting after the search_after sort
+    values. Unlike sorting on a document field this covers documents that lack the field and works on
+    any mapping, and a hit's sort values are enough to resume right after it.
+    """
+    while True:
+        page_kwargs = {}
+        if search_after is not None:
+            page_kwargs['search_after'] = search_after
+        response = es.search(pit={"id": pit['id'], "keep_alive": checkpoint_pit_keep_alive},
+                             sort=[{"_shard_doc": "asc"}], size=scan_page_size, track_total_hits=False,
+                             **page_kwargs)
+        # Elasticsearch may hand back a new id for the same point in time
+        pit['id'] = response['pit_id']
+        hits = response['hits']['hits']
+        if not hits:
+            return
+        yield from hits
+        search_after = hits[-1]['sort']
+
+
+def iter_document_batches(index_name, batch_size, pit=None, search_after=None):
+    """
+    Lazily yield lists of up to batch_size documents from the specified index.
+    Pages are pulled from Elasticsearch only as batches are consumed: scroll pages, or point in time
+    pages (see iter_pit_documents) when pit is given, starting after search_after.
+    """
+    if pit is None:
+        documents = helpers.scan(es, index=index_name, size=scan_page_size)
+    else:
+        documents = iter_pit_documents(pit, search_after)
+
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def filter_unchanged_documents(target_index_name, source_field_name, documents):
+    """
+    Drop documents whose embedding in the target index was computed from the current source text.
+
+    Returns:
+    - A tuple (changed_documents, skipped_count).
+    """
+    try:
+        response = es.mget(index=target_index_name, ids=[doc['_id'] for doc in documents],
+                           source_includes=["text_embedding.source_hash"])
+    except NotFoundError:
+        # First run into a new target index: nothing has been embedded yet
+        return documents, 0
+    stored_hashes = {}
+    for stored in response['docs']:
+        if stored.get('found'):
+            stored_hashes[stored['_id']] = stored['_source'].get('text_embedding', {}).get('source_hash')
+
+    changed = [doc for doc in documents
+               if stored_hashes.get(doc['_id']) != source_text_hash(doc['_source'][source_field_name])]
+    return changed, len(documents) - len(changed)
+
+
+def embed_document_batch(source_field_name, documents, target_index_name=None, skip_unchanged=False):
+    """
+    Embed the source field of a batch of documents and return (documents, embeddings, total_tokens, skipped).
+    With skip_unchanged, documents whose stored source_hash matches are dropped before embedding.
+    """
+    skipped = 0
+    if skip_unchanged:
+        documents, skipped = filter_unchanged_documents(target_index_name, source_field_name, documents)
+    if not documents:
+        return documents, [], 0, skipped
+
+    texts = [doc['_source'][source_field_name] for doc in documents]
+    embeddings, total_tokens = get_embeddings(texts)
+    return documents, embeddings, total_tokens, skipped
+
+
+def iter_embedded_documents(source_index_name, source_field_name, target_index_name, batch_size, max_workers,
+                            stats, pit=None, search_after=None, skip_unchanged=False):
+    """
+    Run embedding calls on a bounded thread pool and yield (document, embedding) pairs in scan order.
+    At most max_workers batches are in flight at any time, so memory stays flat regardless of index size.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for batch in iter_document_batches(source_index_name, batch_size, pit, search_after):
+            in_flight.append(executor.submit(embed_document_batch, source_field_name, batch,
+                                             target_index_name, skip_unchanged))
+            if len(in_flight) >= max_workers:
+                yield from _drain_embedding_future(in_flight.popleft(), stats)
+        while in_flight:
+            yield from _drain_embedding_future(in_flight.popleft(), stats)
+
+
+def _drain_embedding_future(future, stats):
+    documents, embeddings, total_tokens, skipped = future.result()
+    stats['tokens'] += total_tokens
+    stats['skipped'] += skipped
+    for doc, embedding in zip(documents, embeddings):
+        yield doc, embedding
+
+
+def build_bulk_actions(target_index_name, source_field_name, embedded_documents, sort_values=None):
+    """
+    Turn (document, embedding) pairs into bulk index actions for the target index.
+    The source _id is carried over so re-runs overwrite instead of duplicating.
+    If sort_values is a deque, each document's sort values are appended to it in action order.
+    """
+    for doc, embedding in embedded_documents:
+        doc_data = doc['_source']
+        doc_data['text_embedding'] = {
+            "predicted_value": embedding,
+            "source_hash": source_text_hash(doc_data[source_field_name])
+        }
+        if sort_values is not None:
+            sort_values.append(doc.get('sort'))
+        yield {
+            "_op_type": "index",
+            "_index": target_index_name,
+            "_id": doc['_id'],
+            "_source": doc_data
+        }
+
+
+def process_documents_streaming(source_index_name, source_field_name, target_index_name,
+                                batch_size=embedding_batch_size, max_workers=embedding_max_workers,
+                                chunk_size=bulk_chunk_size, report_every=1000,
+                                checkpoint_file=None, skip_unchanged=False):
+    """
+    Streaming variant of process_documents for large indices.
+
+    Pulls scan pages lazily, embeds batch_size texts per embeddings.create call with up to
+    max_workers calls in flight, and writes results back with helpers.streaming_bulk.
+    Throughput (docs/s, tokens/s) is printed every report_every documents.
+
+    Parameters:
+    - checkpoint_file: Optional path. The scan then runs on a point in time of the source index, and
+      the point in time plus the sort values up to which every document was indexed are saved there
+      every report_every documents; the run resumes after them if the file already exists and the
+      point in time has not expired (checkpoint_pit_keep_alive), otherwise it starts over.
+      A failed document holds the checkpoint before it, so the next run retries it; the _ids of
+      failed documents are recorded in the file, which is only removed when the run had no failures.
+    - skip_unchanged: Only re-embed documents whose source text hash differs from the stored one.
+
+    Returns:
+    - A dictionary with docs, failed, failed_ids, skipped, tokens and elapsed seconds.
+    """
+    stats = {'docs': 0, 'failed': 0, 'failed_ids': [], 'skipped': 0, 'tokens': 0}
+    start_time = time.time()
+
+    pit = None
+    search_after = None
+    sort_values = None
+    if checkpoint_file:
+        sort_values = deque()
+        checkpoint = load_checkpoint(checkpoint_file)
+        if checkpoint and checkpoint['source_index'] == source_index_name \
+                and checkpoint['target_index'] == target_index_name and checkpoint.get('pit_id'):
+            if pit_is_open({'id': checkpoint['pit_id']}):
+                pit = {'id': checkpoint['pit_id']}
+                search_after = checkpoint['search_after']
+                print(f"Resuming re-embed of {source_index_name} after {search_after}")
+            else:
+                print(f"The checkpoint's point in time on {source_index_name} expired, re-embedding from the start")
+        if pit is None:
+            pit = open_scan_pit(source_index_name)
+
+    embedded_documents = iter_embedded_documents(source_index_name, source_field_name, target_index_name,
+                                                 batch_size, max_workers, stats, pit, search_after,
+                                                 skip_unchanged)
+    actions = build_bulk_actions(target_index_name, source_field_name, embedded_documents, sort_values)
+
+    # Results come back in action order, so the checkpoint follows them until the first failure
+    last_sort_values = search_after
+    checkpoint_held = False
+    for ok, item in helpers.streaming_bulk(es, actions, chunk_size=chunk_size, raise_on_error=False):
+        stats['docs'] += 1
+        sort_value = sort_values.popleft() if sort_values is not None else None
+        if ok and not checkpoint_held:
+            last_sort_values = sort_value
+        if not ok:
+            stats['failed'] += 1
+            stats['failed_ids'].append(item.get('index', {}).get('_id'))
+            print(f"Failed to index document: {item}")
+            # Resuming starts after the checkpoint, so holding it before this document retries it
+            checkpoint_held = True
+
+        if stats['docs'] % report_every == 0:
+            _print_throughput(stats, start_time)
+            if checkpoint_file:
+                _save_reembed_checkpoint(checkpoint_file, source_index_name, target_index_name, pit,
+                                         last_sort_values, stats['failed_ids'])
+
+    stats['elapsed'] = time.time() - start_time
+    _print_throughput(stats, start_time)
+
+    if checkpoint_file:
+        if stats['failed']:
+            # The point in time stays open until it expires so a re-run can retry the failures
+            _save_reembed_checkpoint(checkpoint_file, source_index_name, target_index_name, pit,
+                                     last_sort_values, stats['failed_ids'])
+            print(f"{stats['failed']} documents failed; re-run within {checkpoint_pit_keep_alive} to retry them "
+                  f"from after {last_sort_values}")
+        else:
+            es.close_point_in_time(id=pit['id'])
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+
+    return stats
+
+
+def _save_reembed_checkpoint(checkpoint_file, source_index_name, target_index_name, pit, search_after,
+                             failed_ids):
+    save_checkpoint(checkpoint_file, {
+        'source_index': source_index_name,
+        'target_index': target_index_name,
+        'pit_id': pit['id'],
+        'search_after': search_after,
+        'failed_ids': failed_ids
+    })
+
+
+def _print_throughput(stats, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Re-embed progress: {stats['docs']} docs ({stats['failed']} failed, {stats['skipped']} unchanged), "
+          f"{stats['docs'] / elapsed:.1f} docs/s, {stats['tokens'] / elapsed:.1f} tokens/s")
+
+
 # Call the process_documents function
 #uncomment to run.  It is commentted out as streamlit app will try and run this
-#process_documents("ordercodes_processed", "combined_relevancy", "ordercodes_openai")
\ No newline at end of file
+#process_documents("ordercodes_processed", "combined_relevancy", "ordercodes_openai")
+#process_documents_streaming("ordercodes_processed", "combined_relevancy", "ordercodes_openai",
+#                            checkpoint_file="reembed.checkpoint.json", skip_unchanged=True)
\ No newline at end of file
@@ -3,7 +3,11 @@ import time
 
 from elasticsearch_llm_cache.elasticsearch_llm_cache import ElasticsearchLLMCache
 
+from utils.async_clients import on_client_loop, iterate_on_client_loop
 from utils.es_helper import create_es_client
+from utils.movie_hit import hits_from_response
+from utils.conversation_history import bound_session_history
+from utils.rate_limiter import get_rate_limiter, estimate_tokens
 from variables import openai_completion_deployment_name, openai_api_sa_base, \
     azure_client_deployment_name
 from variables import openai_api_type, openai_api_base, openai_api_version
@@ -12,10 +16,20 @@ import streamlit as st
 from openai import AzureOpenAI
 
 
-def add_to_cache(cache, prompt, response):
+CHAT_SYSTEM_PROMPT = "You are an AI assistant for Movies.  I supply you with movie titles and you answer questins based on the movie titles I provided. Give me a response for each title I supply." \
+                     "Include 4 columns per movie.  Movie Title, IMDB Rating, TV Guide, and Parental gGuidance rating. Also pretend you have TV guide information for the month of March 2024 and provide what channel the movie will play on with Date and Time in the TV Guide column. This must be populated with actual values and can be made up. Lastly your responses should ONLY be in markdown using table format."
+
+AVATAR_SYSTEM_PROMPT = "You are an AI assistant for Movies.  I supply you with movie titles and you answer questions based on the movie titles I provided. Your response should be brief per movie title and a conversational format, not bullet sytle. " \
+                       "Make sure the description is short per movie"
+
+
+def add_to_cache(cache, prompt, response, context=None):
     print("Added to cache")
+    if context:
+        return cache.add(prompt=prompt, response=response, context=context)
     return cache.add(prompt=prompt, response=response)
 
+
 def ini_chat_prompts():
 
 
@@ -46,11 +60,9 @@ def ini_chat_prompts():
     else:
         print("avatar_messages has not been initialized.")
         st.session_state.avatar_messages = []
-        system_content = "You are an AI assistant for Movies.  I supply you with movie titles and you answer questions based on the movie titles I provided. Your response should be brief per movie title and a conversational format, not bullet sytle. " \
-                  "Make sure the description is short per movie"
         st.session_state.avatar_messages.append(
             {"role": "system",
-             "content": system_content})
+             "content": AVATAR_SYSTEM_PROMPT})
 
     if 'messages' in st.session_state:
         print("messages has been initialized")
@@ -59,47 +71,16 @@ def ini_chat_prompts():
         st.session_state.messages = []
         st.session_state.messages.append(
             {"role": "system",
-             "content": "You are an AI assistant for Movies.  I supply you with movie titles and you answer questins based on the movie titles I provided. Give me a response for each title I supply."
-                        "Include 4 columns per movie.  Movie Title, IMDB Rating, TV Guide, and Parental gGuidance rating. Also pretend you have TV guide information for the month of March 2024 and provide what channel the movie will play on with Date and Time in the TV Guide column. This must be populated with actual values and can be made up. Lastly your responses should ONLY be in markdown using table format."})
+             "content": CHAT_SYSTEM_PROMPT})
 
 
-def get_chat_guidance_rag(prompt, client, results, conversation_history):
+def get_chat_guidance_rag(prompt, client, hits, conversation_history):
     # Prepare the messages for Azure OpenAI, including the system message
 
-    blog_bodies = []
-    urls = []
-    titles = []
-    passages_texts = []
-    scores = []
-
-    # Check if there are any hits
-    if results['hits']['hits']:
-        # Process up to the first 3 results
-        for hit in results['hits']['hits'][:3]:  # Limit to first 3 results
-            source = hit["_source"]
-
-            # Extract and accumulate the body content
-            blog_body = source.get("body_content", "No body content available")
-            blog_bodies.append(blog_body)
-
-            # Extract and accumulate the URL, preferring 'additional_urls' if available and non-empty
-            additional_urls = source.get("additional_urls", [])
-            url = additional_urls[0] if additional_urls else source.get("url", "No URL available")
-            urls.append(url)
-
-            # Extract and accumulate the title
-            title = source.get("title", "No title available")
-            titles.append(title)
-
-            # Extract and accumulate the first passage text if passages exist and are non-empty
-            passages = source.get("passages", [])
-            first_passage_text = passages[0].get("text",
-                                                 "No passages text available") if passages else "No passages available"
-            passages_texts.append(first_passage_text)
-
-            # Extract and accumulate the score
-            score = hit["_score"]
-            scores.append(score)
+    # hits is a list of MovieHit, use up to the first 3 results
+    hits = hits[:3]
+    blog_bodies = [hit.body_content for hit in hits]
+    blog_body = blog_bodies[-1] if blog_bodies else "No body content available"
 
     # Concatenate the body contents of up to the first 3 documents into a single blog_body field
     #blog_body = " ".join(blog_bodies)
@@ -114,11 +95,16 @@ def get_chat_guidance_rag(prompt, client, results, conversation_history):
     # for message in messages:
     #     print(f"{message['role'].title()}: {message['content']}")
 
+    # Keep the history within the token budget before sending it
+    messages = bound_session_history('messages', client)
+
     # Generate response from Azure OpenAI
-    response = client.chat.completions.create(
-        model=azure_client_deployment_name,
-        messages=st.session_state.messages
-    )
+    response = get_rate_limiter(azure_client_deployment_name).call(
+        lambda: client.chat.completions.create(
+            model=azure_client_deployment_name,
+            messages=messages
+        ),
+        estimate_tokens(messages))
 
     # Extract the text from the response
     return response.choices[0].message.content.strip()
@@ -126,22 +112,15 @@ def get_chat_guidance_rag(prompt, client, results, conversation_history):
 
 def get_chat_guidance(client):
     # Prepare the messages for Azure OpenAI, including the system message
-
+    messages = bound_session_history('messages', client)
 
     # # Print the messages array for debugging or logging purposes
     print("get_chat_guidance: Messages being sent to Azure OpenAI:")
-    for message in st.session_state.messages:
+    for message in messages:
        print(f"{message['role'].title()}: {message['content']}")
 
-    # Generate response from Azure OpenAI
-    response = client.chat.completions.create(
-        model=azure_client_deployment_name,
-        messages=st.session_state.messages
-    )
-
-
     # Extract the text from the response
-    return response.choices[0].message.content.strip()
+    return get_chat_completion(client, messages).choices[0].message.content.strip()
 
 
 def get_chat_guidance_summarized(client):
@@ -151,16 +130,110 @@ def get_chat_guidance_summarized(client):
     # for message in st.session_state.avatar_messages:
     #    print(f"{message['role'].title()}: {message['content']}")
 
-    # Generate response from Azure OpenAI
-    response = client.chat.completions.create(
-        model=azure_client_deployment_name,
-        messages=st.session_state.avatar_messages
-    )
+    messages = bound_session_history('avatar_messages', client)
 
+    # Extract the text from the response
+    return get_chat_completion(client, messages).choices[0].message.content.strip()
+
+
+def get_chat_completion(client, messages):
+    """
+    Rate-limited chat completion on the chat deployment. Returns the full response, including usage.
+    """
+    return get_rate_limiter(azure_client_deployment_name).call(
+        lambda: client.chat.completions.create(
+            model=azure_client_deployment_name,
+            messages=messages
+        ),
+        estimate_tokens(messages))
+
+def stream_chat_completion(client, messages):
+    """
+    Rate-limited streaming chat completion on the chat deployment: yields text deltas as they arrive.
+    """
+    # Rate limiting applies to opening the stream, which is where a 429 is raised
+    stream = get_rate_limiter(azure_client_deployment_name).call(
+        lambda: client.chat.completions.create(
+            model=azure_client_deployment_name,
+            messages=messages,
+            stream=True
+        ),
+        estimate_tokens(messages))
+
+    for chunk in stream:
+        # Azure sends a first chunk with only content filter results and no choices
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def get_chat_guidance_stream(client):
+    """
+    Streaming get_chat_guidance: yields text deltas as they arrive, e.g. for st.write_stream.
+    """
+    return stream_chat_completion(client, bound_session_history('messages', client))
+
+
+def get_chat_guidance_summarized_stream(client):
+    """
+    Streaming get_chat_guidance_summarized: yields text deltas as they arrive.
+    """
+    return stream_chat_completion(client, bound_session_history('avatar_messages', client))
+
+
+def render_chat_stream(container, deltas):
+    """
+    Render streamed deltas into a Streamlit container as they arrive and return the full text,
+    so callers can still pass it to add_to_cache.
+    """
+    return container.write_stream(deltas).strip()
+
+
+async def get_chat_guidance_stream_async(aclient, messages):
+    """
+    Async generator of text deltas for the shared AsyncAzureOpenAI client (utils/async_clients).
+    """
+    stream = await get_rate_limiter(azure_client_deployment_name).call_async(
+        lambda: on_client_loop(aclient.chat.completions.create(
+            model=azure_client_deployment_name,
+            messages=messages,
+            stream=True
+        )),
+        estimate_tokens(messages))
+
+    async for chunk in iterate_on_client_loop(stream):
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def render_chat_stream_async(container, deltas):
+    """
+    Async counterpart of render_chat_stream: updates a placeholder in the container on every delta.
+    """
+    placeholder = container.empty()
+    text = ""
+    async for delta in deltas:
+        text += delta
+        placeholder.markdown(text, unsafe_allow_html=True)
+    return text.strip()
+
+
+async def get_chat_guidance_async(aclient, messages):
+    """
+    Async counterpart of get_chat_guidance/get_chat_guidance_summarized for the shared AsyncAzureOpenAI
+    client (utils/async_clients). The message list is passed explicitly so several completions can run
+    concurrently.
+    """
+    response = await get_rate_limiter(azure_client_deployment_name).call_async(
+        lambda: on_client_loop(aclient.chat.completions.create(
+            model=azure_client_deployment_name,
+            messages=messages
+        )),
+        estimate_tokens(messages))
 
     # Extract the text from the response
     return response.choices[0].message.content.strip()
 
+
 def get_openai_guidance(user_query, results, num_results, searchtype):
     openai.api_type = openai_api_type
     openai.api_base = openai_api_base
@@ -170,7 +243,8 @@ def get_openai_guidance(user_query, results, num_results, searchtype):
     openai.api_key = st.secrets['pass']
 
     processed_results = []
-    retry_attempts = 3  # Number of retries before failing
+    retry_attempts = 3  # Number of attempts, rate-limited ones included, before failing
+    limiter = get_rate_limiter(openai_completion_deployment_name)
 
     for idx in range(num_results):
         if searchtype == "Elser" or searchtype == "Elser Hybrid":
@@ -183,66 +257,28 @@ def get_openai_guidance(user_query, results, num_results, searchtype):
 
         score = results['hits']['hits'][idx]["_score"]
 
-        for _ in range(retry_attempts):
-            try:
-                response = openai.ChatCompletion.create(
-                    engine=openai_completion_deployment_name,
-                    messages=[
-                        {"role": "system",
-                         "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
-                        {"role": "user",
-                         "content": f"Answer this question {user_query} based on the following text {text}"}
-                    ],
-                    temperature=0.7,
-                    max_tokens=800,
-                    top_p=0.95,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                    stop=None)
-
-                # print(response['choices'][0]['message']['content'])
-                completion_output = response['choices'][0]['message']['content'].strip()
-                processed_results.append((text, completion_output, score))
-                break  # If successful, break out of the retry loop
-
-            except openai.error.RateLimitError as e:
-                # Handle rate limit error
-                if _ < retry_attempts - 1:  # If it's not the last attempt
-                    print(f"Rate Limit Error: {e}. Retrying in 1 second...")
-                    time.sleep(1)  # Wait for 1 second before retrying
-                else:
-                    print(f"Rate Limit Error: {e}. No more retries.")
-
-            except openai.error.APIError as e:
-                print(f"OpenAI API returned an API Error: {e}")
-                break
-
-            except openai.error.AuthenticationError as e:
-                print(f"OpenAI API returned an Authentication Error: {e}")
-                break
-
-            except openai.error.APIConnectionError as e:
-                print(f"Failed to connect to OpenAI API: {e}")
-                break
-
-            except openai.error.InvalidRequestError as e:
-                print(f"Invalid Request Error: {e}")
-                break
-
-            except openai.error.ServiceUnavailableError as e:
-                print(f"Service Unavailable: {e}")
-                break
-
-            except openai.error.Timeout as e:
-                print(f"Request timed out: {e}")
-                break
-
-            except:
-                # Handles all other exceptions
-                print("An unexpected exception has occurred.")
-                break
-
-            time.sleep(4)
+        try:
+            response = limiter.call(lambda: openai.ChatCompletion.create(
+                engine=openai_completion_deployment_name,
+                messages=[
+                    {"role": "system",
+                     "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
+                    {"role": "user",
+                     "content": f"Answer this question {user_query} based on the following text {text}"}
+                ],
+                temperature=0.7,
+                max_tokens=800,
+                top_p=0.95,
+                frequency_penalty=0,
+                presence_penalty=0,
+                stop=None), estimate_tokens(user_query) + estimate_tokens(text) + 800, retry_attempts)
+
+            # print(response['choices'][0]['message']['content'])
+            completion_output = response['choices'][0]['message']['content'].strip()
+            processed_results.append((text, completion_output, score))
+
+        except Exception as e:
+            print(f"OpenAI request failed: {e}")
 
     return processed_results, results
 
@@ -255,103 +291,41 @@ def get_openai_large_guidance(user_query, results, num_results, searchtype):
     )
 
     processed_results = []
-    retry_attempts = 3  # Number of retries before failing
+    retry_attempts = 3  # Number of attempts, rate-limited ones included, before failing
+    limiter = get_rate_limiter("gpt-35-turbo")
 
     query_response_time = results['took']
 
-    text = None
-    url = None
-    title = None
-    first_passage_text = None
-
-    for idx in range(num_results):
+    for hit in hits_from_response(results, num_results):
         genai_start_time = time.time()
 
+        text = hit.body_content
+        url = hit.url
+        title = hit.title
+        first_passage_text = hit.first_passage
+        score = hit.score
 
         try:
-            text = results['hits']['hits'][idx]["_source"]["body_content"]
-            # Accessing the first value of 'additional_urls' if it exists and has at least one URL
-            if results['hits']['hits'][idx]["_source"].get("additional_urls") and len(
-                    results['hits']['hits'][idx]["_source"]["additional_urls"]) > 0:
-                url = results['hits']['hits'][idx]["_source"]["additional_urls"][0]
-            else:
-                url = results['hits']['hits'][idx]["_source"]["url"]
-            title = results['hits']['hits'][idx]["_source"]["title"]
-            # Accessing the first instance of 'passages.text'
-            # Check if 'passages' exists and has at least one item
-            if results['hits']['hits'][idx]["_source"].get("passages") and len(
-                    results['hits']['hits'][idx]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][idx]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
-
-        except KeyError:
-            text = None
-            url = None
-            title = None
-
-        score = results['hits']['hits'][idx]["_score"]
-
-        for _ in range(retry_attempts):
-            try:
-
-                response = client.chat.completions.create(
-                    model="gpt-35-turbo",  # model = "deployment_name".
-                    messages=[
-                        {"role": "system",
-                         "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
-                        {"role": "user",
-                         "content": f"Answer this question. Keep the response less than 30 words.  {user_query} based on the following text {text}"}
-                    ]
-                )
-
-                genai_end_time = time.time()
-                genai_query_time = (genai_end_time - genai_start_time) * 1000
-
-                completion_output = response.choices[0].message.content
-
-                processed_results.append(
-                    (text, completion_output, score, query_response_time, genai_query_time, url, title, first_passage_text))
-                break  # If successful, break out of the retry loop
-
-            except openai.error.RateLimitError as e:
-                # Handle rate limit error
-                if _ < retry_attempts - 1:  # If it's not the last attempt
-                    print(f"Rate Limit Error: {e}. Retrying in 1 second...")
-                    time.sleep(1)  # Wait for 1 second before retrying
-                else:
-                    print(f"Rate Limit Error: {e}. No more retries.")
-
-            except openai.error.APIError as e:
-                print(f"OpenAI API returned an API Error: {e}")
-                break
-
-            except openai.error.AuthenticationError as e:
-                print(f"OpenAI API returned an Authentication Error: {e}")
-                break
-
-            except openai.error.APIConnectionError as e:
-                print(f"Failed to connect to OpenAI API: {e}")
-                break
-
-            except openai.error.InvalidRequestError as e:
-                print(f"Invalid Request Error: {e}")
-                break
+            response = limiter.call(lambda: client.chat.completions.create(
+                model="gpt-35-turbo",  # model = "deployment_name".
+                messages=[
+                    {"role": "system",
+                     "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
+                    {"role": "user",
+                     "content": f"Answer this question. Keep the response less than 30 words.  {user_query} based on the following text {text}"}
+                ]
+            ), estimate_tokens(user_query) + estimate_tokens(text or ""), retry_attempts)
 
-            except openai.error.ServiceUnavailableError as e:
-                print(f"Service Unavailable: {e}")
-                break
+            genai_end_time = time.time()
+            genai_query_time = (genai_end_time - genai_start_time) * 1000
 
-            except openai.error.Timeout as e:
-                print(f"Request timed out: {e}")
-                break
+            completion_output = response.choices[0].message.content
 
-            except:
-                # Handles all other exceptions
-                print("An unexpected exception has occurred.")
-                break
+            processed_results.append(
+                (text, completion_output, score, query_response_time, genai_query_time, url, title, first_passage_text))
 
-            time.sleep(4)
+        except Exception as e:
+            print(f"OpenAI request failed: {e}")
 
     return processed_results, results
 
@@ -366,68 +340,31 @@ def get_openai_guidance_no_context(user_query):
 
     processed_results = []
     results = []
-    retry_attempts = 3  # Number of retries before failing
+    retry_attempts = 3  # Number of attempts, rate-limited ones included, before failing
+    limiter = get_rate_limiter(openai_completion_deployment_name)
 
     # Note: The openai-python library support for Azure OpenAI is in preview.
 
-    for _ in range(retry_attempts):
-        try:
-            response = openai.ChatCompletion.create(
-                engine=openai_completion_deployment_name,
-                messages=[
-                    {"role": "system",
-                     "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
-                    {"role": "user", "content": f"Answer this question {user_query}"}
-                ],
-                temperature=0.7,
-                max_tokens=800,
-                top_p=0.95,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None)
-
-            # print(response['choices'][0]['message']['content'])
-            completion_output = response['choices'][0]['message']['content'].strip()
-            processed_results.append(completion_output)
-            break  # If successful, break out of the retry loop
-
-        except openai.error.RateLimitError as e:
-            # Handle rate limit error
-            if _ < retry_attempts - 1:  # If it's not the last attempt
-                print(f"Rate Limit Error: {e}. Retrying in 1 second...")
-                time.sleep(1)  # Wait for 1 second before retrying
-            else:
-                print(f"Rate Limit Error: {e}. No more retries.")
-
-        except openai.error.APIError as e:
-            print(f"OpenAI API returned an API Error: {e}")
-            break
-
-        except openai.error.AuthenticationError as e:
-            print(f"OpenAI API returned an Authentication Error: {e}")
-            break
-
-        except openai.error.APIConnectionError as e:
-            print(f"Failed to connect to OpenAI API: {e}")
-            break
-
-        except openai.error.InvalidRequestError as e:
-            print(f"Invalid Request Error: {e}")
-            break
-
-        except openai.error.ServiceUnavailableError as e:
-            print(f"Service Unavailable: {e}")
-            break
-
-        except openai.error.Timeout as e:
-            print(f"Request timed out: {e}")
-            break
-
-        except:
-            # Handles all other exceptions
-            print("An unexpected exception has occurred.")
-            break
-
-        time.sleep(4)
+    try:
+        response = limiter.call(lambda: openai.ChatCompletion.create(
+            engine=openai_completion_deployment_name,
+            messages=[
+                {"role": "system",
+                 "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
+                {"role": "user", "content": f"Answer this question {user_query}"}
+            ],
+            temperature=0.7,
+            max_tokens=800,
+            top_p=0.95,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=None), estimate_tokens(user_query) + 800, retry_attempts)
+
+        # print(response['choices'][0]['message']['content'])
+        completion_output = response['choices'][0]['message']['content'].strip()
+        processed_results.append(completion_output)
+
+    except Exception as e:
+        print(f"OpenAI request failed: {e}")
 
     return processed_results, results
\ No newline at end of file
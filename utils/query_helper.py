@@ -1,35 +1,35 @@
-import json
-
-
-from utils.openai_embedder import get_embedding
-
+import asyncio
+import logging
+
+from utils.async_clients import on_client_loop
+from utils.embedding_cache import embedding_cache
+from utils.movie_hit import hits_from_response
+from utils.openai_embedder import get_query_embedding
+
+from utils.query_templates import BM25_TEMPLATE, OPENAI_HYBRID_TEMPLATE, HYBRID_TEMPLATE, KNN_TEMPLATE, \
+    RRF_TEMPLATE, ELSER_TEMPLATE, OPENAI_KNN_TEMPLATE, FUSION_KNN_TEMPLATE, SEARCH_RESPONSE_OPTIONS, HIT_SOURCE, \
+    RESPONSE_FILTER_PATH, MSEARCH_FILTER_PATH, debug_dump_query
+from utils.fusion import fuse
+from utils.search_batcher import get_search_batcher, MSearchItemError
+from utils.local_vector_index import LOCAL_INDEX_SOURCES, get_local_vector_index, local_query_vector
+from utils.search_templates import template_id_for, mark_template_missing, is_missing_template_error
 from utils.openai_helper import get_openai_guidance_no_context, get_openai_large_guidance, get_chat_guidance, \
     get_chat_guidance_rag
 from variables import vector_embedding_field, model, elser_embedding_field, elser_model, byom_index_name
+from variables import use_msearch_batching, local_vector_index_mode
+from variables import use_search_templates, fusion_retrievers, fusion_method, fusion_weights
+from elasticsearch import BadRequestError, NotFoundError, ConnectionError, ConnectionTimeout
 import streamlit as st
 
+logger = logging.getLogger(__name__)
+
+
 def build_bm25_query(user_query):
     # Constructing the match query for 'organic' search using 'body_content'
-    bm25_query = {
-        "bool": {
-            "should": [
-                {
-                    "query_string": {
-                        "default_field": "body_content",
-                        "query": user_query
-                    }
-                }
-            ]
-        }
-    }
-
-    full_query = {
-        "size": 5,  # Specify the number of results to return
-        "query": bm25_query
-    }
+    full_query = BM25_TEMPLATE.render(user_query=user_query)
 
     # Debug: Dump the assembled query for inspection
-    print(json.dumps(full_query, indent=4))
+    debug_dump_query(full_query)
 
     return full_query
 
@@ -42,40 +42,10 @@ def build_openai_hybrid_query(embeddings, user_query, BM25_Boost, KNN_Boost):
     - A dictionary representing the Elasticsearch query.
     """
 
-    knn_query = {
-        "field": vector_embedding_field,  # Field containing the OpenAI embeddings
-        "k": 10,
-        "num_candidates": 100,
-        "query_vector": embeddings,
-        "boost": KNN_Boost
-    }
-
-    main_filters = []
-
-    # Copy the main_filters for the knn part
-    knn_filters = list(main_filters)
-
-    query = {
-        "query": {
-            "bool": {
-                "must": {
-                    "match": {
-                        "combined_relevancy": {
-                            "query": user_query,
-                            "boost": BM25_Boost
-                        }
-                    }
-                },
-                "filter": main_filters
-            }
-        },
-        "knn": knn_query
-    }
-
-    if knn_filters:
-        query["knn"]["filter"] = knn_filters
+    query = OPENAI_HYBRID_TEMPLATE.render(user_query=user_query, bm25_boost=BM25_Boost, embeddings=embeddings,
+                                          knn_boost=KNN_Boost)
 
-    print(json.dumps(query, indent=4))
+    debug_dump_query(query)
 
     return query
 
@@ -88,54 +58,24 @@ def build_hybrid_query(user_query, BM25_Boost, KNN_Boost):
     - A dictionary representing the Elasticsearch query.
     """
 
-    # Base structure for knn
-    knn_structure = {
-        "field": vector_embedding_field,
-        "k": 10,
-        "num_candidates": 100,
-        "query_vector_builder": {
-            "text_embedding": {
-                "model_id": model,
-                "model_text": user_query
-            }
-        },
-        "boost": KNN_Boost
-    }
-
-    main_filters = []
-
-    # Copy the main_filters for the knn part
-    knn_filters = list(main_filters)
-
-    query = {
-        "query": {
-            "bool": {
-                "must": {
-                    "match": {
-                        "text": user_query
-                    }
-                },
-                "filter": main_filters
-            }
-        },
-        "knn": knn_structure
-    }
-
-    if knn_filters:
-        query["knn"]["filter"] = knn_filters
+    query = HYBRID_TEMPLATE.render(user_query=user_query, model_text=user_query, knn_boost=KNN_Boost)
 
-    print(json.dumps(query, indent=4))
+    debug_dump_query(query)
 
     return query
 
 
 def build_vector(es, text):
+    return embedding_cache.get_or_compute(model, text, lambda query_text: infer_vector(es, query_text))
+
+
+def infer_vector(es, text):
     docs = [{"text_field": text}]
     response = es.ml.infer_trained_model(model_id=model, docs=docs)
 
     predicted_value = response.get('inference_results', [{}])[0].get('predicted_value', [])
 
-    print(predicted_value)
+    logger.debug(f"Inferred {len(predicted_value)}-dim query vector")
     return predicted_value
 
 
@@ -244,28 +184,10 @@ def build_knn_query(user_query, query_vector):
     """
 
     # Nested KNN query structure
-    nested_knn_query = {
-        "query": {
-            "nested": {
-                "path": "passages",
-                "query": {
-                    "knn": {
-                        "query_vector": query_vector,
-                        "field": "passages.vector.predicted_value",
-                        "num_candidates": 2
-                    }
-                },
-                "inner_hits": {
-                    "_source": [
-                        "passages.text"
-                    ]
-                }
-            }
-        }
-    }
+    nested_knn_query = KNN_TEMPLATE.render(query_vector=query_vector)
 
     # Debug: Dump the assembled query for inspection
-    print(json.dumps(nested_knn_query, indent=4))
+    debug_dump_query(nested_knn_query)
 
     return nested_knn_query
 
@@ -285,124 +207,27 @@ def build_rrf_query(embeddings, user_query, rrf_rank_constant, rrf_window_size):
     - A dictionary representing the complex query.
     """
 
-    # Define the base structure of the query
-    query = {
-        "sub_searches": [
-            {
-                "query": {
-                    "match": {
-                        "body_content": user_query
-                    }
-                }
-            },
-            {
-                "query": {
-                    "nested": {
-                        "path": "passages",
-                        "query": {
-                            "knn": {
-                                "query_vector": embeddings,
-                                "field": "passages.vector.predicted_value",
-                                "num_candidates": 50
-                            }
-                        }
-                    }
-                }
-            },
-            {
-                "query": {
-                    "nested": {
-                        "path": "passages",
-                        "query": {
-                            "bool": {
-                                "should": [
-                                    {
-                                        "text_expansion": {
-                                            "passages.content_embedding.predicted_value": {
-                                                "model_id": ".elser_model_2_linux-x86_64",
-                                                "model_text": user_query
-                                            }
-                                        }
-                                    }
-                                ]
-                            }
-                        }
-                    }
-                }
-            }
-        ],
-        "rank": {
-            "rrf": {
-                "window_size": rrf_window_size,
-                "rank_constant": rrf_rank_constant
-            }
-        }
-    }
+    query = RRF_TEMPLATE.render(user_query=user_query, embeddings=embeddings, elser_text=user_query,
+                                window_size=rrf_window_size, rank_constant=rrf_rank_constant)
+
     # Debug: Print the assembled query for inspection
-    print(json.dumps(query, indent=4))
+    debug_dump_query(query)
 
     return query
 
 
 def build_elser_query(user_query):
     # Nested query with text_expansion
-    nested_query = {
-        "nested": {
-            "path": "passages",
-            "query": {
-                "bool": {
-                    "should": [
-                        {
-                            "text_expansion": {
-                                "passages.content_embedding.predicted_value": {
-                                    "model_id": ".elser_model_2_linux-x86_64",
-                                    "model_text": user_query
-                                }
-                            }
-                        }
-                    ]
-                }
-            }
-        }
-    }
-
-    query = {
-        "size": 5,
-        "query": nested_query
-    }
+    query = ELSER_TEMPLATE.render(user_query=user_query)
 
     # Debug: Print the assembled query for inspection
-    print(json.dumps(query, indent=4))
+    debug_dump_query(query)
 
     return query
 
 
-def build_openai_query(embeddings, color=None, os=None):
-    """
-    Builds an Elasticsearch KNN query using OpenAI embeddings and includes aggregations.
-
-    Parameters:
-    - embeddings: The vector embeddings.
-    - color (optional): Color value for filtering.
-    - os (optional): OS value for filtering.
-    - selected_states (optional): List of selected states.
-    - selected_companies (optional): List of selected companies.
-    - optional_state (optional): State value for the should clause.
-
-    Returns:
-    - A dictionary representing the Elasticsearch KNN query.
-    """
-
-    # Base KNN query structure
-    knn_query = {
-        "field": vector_embedding_field,  # Field containing the OpenAI embeddings
-        "k": 10,
-        "num_candidates": 100,
-        "query_vector": embeddings
-    }
-
+def build_openai_filters(color=None, os=None):
     filters = []
-    bool_query = {}
 
     # Handle color filter
     if color:
@@ -420,23 +245,36 @@ def build_openai_query(embeddings, color=None, os=None):
             }
         })
 
-    # If there are any filters, add them to the bool query
-    if filters:
-        bool_query["filter"] = filters
+    return filters
 
-    # If the bool_query is not empty, add it to the knn_query
-    if bool_query:
-        knn_query["filter"] = {
-            "bool": bool_query
-        }
 
-    # Final query structure including aggregations
-    full_query = {
-        "knn": knn_query
-    }
+def build_openai_query(embeddings, color=None, os=None):
+    """
+    Builds an Elasticsearch KNN query using OpenAI embeddings and includes aggregations.
+
+    Parameters:
+    - embeddings: The vector embeddings.
+    - color (optional): Color value for filtering.
+    - os (optional): OS value for filtering.
+
+    Returns:
+    - A dictionary representing the Elasticsearch KNN query.
+    """
+
+    full_query = OPENAI_KNN_TEMPLATE.render(embeddings=embeddings)
+
+    filters = build_openai_filters(color, os)
+
+    # "knn" was copied by render, so adding the filter does not touch the template
+    if filters:
+        full_query["knn"]["filter"] = {
+            "bool": {
+                "filter": filters
+            }
+        }
 
     # Dump the assembled query for debugging
-    print(json.dumps(full_query, indent=4))
+    debug_dump_query(full_query)
 
     return full_query
 
@@ -493,6 +331,22 @@ def find_os_in_text(text):
 
 def search_products_for_chatbot(es, user_query, searchtype, rrf_rank_constant, rrf_window_size,
                                 azureclient, conversation_history):
+    results = run_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
+
+    hits = hits_from_response(results, 5)
+    print_first_passages(hits)
+
+    return get_chat_guidance_rag(user_query, azureclient, hits, conversation_history)
+
+
+def print_first_passages(hits):
+    if not hits:
+        print("No results found.")
+    for hit in hits:
+        print(hit.first_passage)
+
+
+def build_search_query(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
     # Select the appropriate query building function based on searchtype
     if searchtype == "Vector":
         query = build_knn_query(user_query, build_vector(es, user_query))
@@ -503,8 +357,8 @@ def search_products_for_chatbot(es, user_query, searchtype, rrf_rank_constant, r
     elif searchtype == "Elser":
         query = build_elser_query(user_query)
     elif searchtype == "Vector OpenAI":
-        # query = build_openai_query(get_embedding(user_query), run_ner_inference(es, user_query))
-        query = build_openai_query(get_embedding(user_query), find_color_in_text(user_query),
+        # query = build_openai_query(get_query_embedding(user_query), run_ner_inference(es, user_query))
+        query = build_openai_query(get_query_embedding(user_query), find_color_in_text(user_query),
                                    find_os_in_text(user_query))
 
     elif searchtype == "GenAI":
@@ -512,107 +366,280 @@ def search_products_for_chatbot(es, user_query, searchtype, rrf_rank_constant, r
     else:
         raise ValueError(f"Invalid searchtype: {searchtype}")
 
-    results = es.search(index=byom_index_name, body=query, _source=True)
+    return query
+
+
+def build_search_params(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    Parameters for the stored search template of a searchtype (see utils/search_templates).
+    """
+    if searchtype == "Vector":
+        return {"query_vector": build_vector(es, user_query)}
+    elif searchtype == "BM25":
+        return {"user_query": user_query}
+    elif searchtype == "Reciprocal Rank Fusion":
+        return {"user_query": user_query, "embeddings": build_vector(es, user_query), "elser_text": user_query,
+                "window_size": rrf_window_size, "rank_constant": rrf_rank_constant}
+    elif searchtype == "Elser":
+        return {"user_query": user_query}
+    elif searchtype == "Vector OpenAI":
+        filters = build_openai_filters(find_color_in_text(user_query), find_os_in_text(user_query))
+        return {"embeddings": get_query_embedding(user_query), "filter": {"bool": {"filter": filters}}}
+    else:
+        raise ValueError(f"Invalid searchtype: {searchtype}")
 
-    # Set a default value for num_results
-    num_results = 0
 
-    if results and results.get('hits') and results['hits'].get('hits'):
-        # Limit the number of results displayed
+def apply_response_options(query, searchtype):
+    """
+    Add the searchtype's _source filtering and size to a query body (returns a new top-level dict).
+    """
+    return dict(query, **SEARCH_RESPONSE_OPTIONS.get(searchtype, {}))
 
-        num_results = min(5, len(results['hits']['hits']))
 
-        for i in range(num_results):
-            if results['hits']['hits'][i]["_source"].get("passages") and len(
-                    results['hits']['hits'][i]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][i]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
+def normalize_search_response(results):
+    """
+    filter_path drops "hits" entirely when nothing matched; put an empty list back so callers can
+    keep indexing results['hits']['hits'].
+    """
+    results = dict(results)
+    results.setdefault('hits', {}).setdefault('hits', [])
+    return results
 
-            print(first_passage_text)
 
+def build_fusion_searches(es, user_query, rrf_window_size):
+    """
+    msearch header/body pairs, one per configured fusion retriever, each returning rrf_window_size hits.
+    """
+    searches = []
+    for retriever in fusion_retrievers:
+        if retriever == "bm25":
+            body = BM25_TEMPLATE.render(user_query=user_query)
+        elif retriever == "knn":
+            body = FUSION_KNN_TEMPLATE.render(query_vector=build_vector(es, user_query),
+                                              num_candidates=max(50, rrf_window_size))
+        elif retriever == "knn_openai":
+            body = OPENAI_KNN_TEMPLATE.render(embeddings=get_query_embedding(user_query))
+        elif retriever == "elser":
+            body = ELSER_TEMPLATE.render(user_query=user_query)
+        else:
+            raise ValueError(f"Invalid fusion retriever: {retriever}")
+
+        searches.append({"index": byom_index_name})
+        searches.append(dict(body, _source=HIT_SOURCE, size=rrf_window_size))
+    return searches
+
+
+def fuse_msearch_response(responses, rrf_rank_constant, rrf_window_size, size=5):
+    """
+    Fuse the per-retriever hit lists of an msearch response into a search-shaped response with the
+    top `size` hits, whose _score is the fused score.
+    """
+    result_lists = []
+    sources = {}
+    took = 0
+    for retriever, response in zip(fusion_retrievers, responses['responses']):
+        if 'error' in response:
+            print(f"Fusion retriever {retriever} failed: {response['error']}")
+            result_lists.append([])
+            continue
+        took = max(took, response.get('took', 0))
+        hits = response.get('hits', {}).get('hits', [])
+        for hit in hits:
+            sources.setdefault(hit['_id'], hit)
+        result_lists.append(hits)
+
+    fused = fuse(result_lists, fusion_method, fusion_weights, rrf_rank_constant, rrf_window_size)
+    hits = [dict(sources[doc_id], _score=score) for doc_id, score in fused[:size]]
+    return {"took": took, "hits": {"hits": hits}}
+
+
+def fused_search(es, user_query, rrf_rank_constant, rrf_window_size):
+    """
+    Run the fusion retrievers concurrently in one msearch and fuse them client-side.
+    """
+    searches = build_fusion_searches(es, user_query, rrf_window_size)
+    responses = es.msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH)
+    return fuse_msearch_response(responses, rrf_rank_constant, rrf_window_size)
+
+
+async def fused_search_async(aes, es, user_query, rrf_rank_constant, rrf_window_size):
+    searches = await asyncio.to_thread(build_fusion_searches, es, user_query, rrf_window_size)
+    responses = await on_client_loop(aes.msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH))
+    return fuse_msearch_response(responses, rrf_rank_constant, rrf_window_size)
+
+
+def local_vector_search(es, user_query, searchtype, es_available=True):
+    """
+    Answer "Vector" / "Vector OpenAI" searches from the in-process index (utils/local_vector_index).
+    Returns None when the searchtype is not supported locally, has filters, or the index is not built,
+    or for "Vector" when es_available is False and the query cannot be embedded locally.
+    """
+    if searchtype not in LOCAL_INDEX_SOURCES:
+        return None
+    if searchtype == "Vector OpenAI" and build_openai_filters(find_color_in_text(user_query),
+                                                              find_os_in_text(user_query)):
+        return None
+    index = get_local_vector_index(searchtype)
+    if index is None:
+        return None
+
+    if searchtype == "Vector":
+        vector = local_query_vector(user_query)
+        if vector is None:
+            if not es_available:
+                return None
+            vector = build_vector(es, user_query)
     else:
-        print("No results found.")
+        vector = get_query_embedding(user_query)
+    return index.search(vector, SEARCH_RESPONSE_OPTIONS[searchtype]["size"])
+
 
-    return get_chat_guidance_rag(user_query, azureclient, results, conversation_history)
+def run_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    Search through the stored template for the searchtype when one is registered, sending only
+    parameters; otherwise (or if the template has gone missing) send the full inline body.
+    "Hybrid Fusion" runs several retrievers in one msearch and fuses them client-side.
+    """
+    if searchtype == "Hybrid Fusion":
+        return fused_search(es, user_query, rrf_rank_constant, rrf_window_size)
+
+    if local_vector_index_mode == "prefer":
+        results = local_vector_search(es, user_query, searchtype)
+        if results is not None:
+            return results
+
+    try:
+        return _run_es_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
+    except (ConnectionTimeout, ConnectionError):
+        # Keep answering "Vector" searches from the local index while the cluster is slow or unreachable
+        results = local_vector_search(es, user_query, searchtype, es_available=False) \
+            if local_vector_index_mode == "fallback" else None
+        if results is None:
+            raise
+        print(f"Elasticsearch search failed, served {searchtype} from the local vector index")
+        return results
+
+
+def _run_es_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    # With batching on, searches from all sessions are coalesced into shared msearch calls
+    batcher = get_search_batcher(es) if use_msearch_batching else None
+
+    template_id = template_id_for(searchtype) if use_search_templates else None
+    if template_id:
+        params = build_search_params(es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
+        try:
+            if batcher:
+                return normalize_search_response(batcher.search_template(byom_index_name, template_id, params))
+            return normalize_search_response(es.search_template(
+                index=byom_index_name, id=template_id, params=params, filter_path=RESPONSE_FILTER_PATH))
+        except (NotFoundError, BadRequestError) as e:
+            if not is_missing_template_error(e.status_code, e.body):
+                raise
+            mark_template_missing(template_id)
+        except MSearchItemError as e:
+            if not is_missing_template_error(e.status, e.error):
+                raise
+            mark_template_missing(template_id)
+
+    query = apply_response_options(build_search_query(es, user_query, searchtype, rrf_rank_constant,
+                                                      rrf_window_size), searchtype)
+    if batcher:
+        return normalize_search_response(batcher.search(byom_index_name, query))
+    return normalize_search_response(es.search(index=byom_index_name, body=query,
+                                               filter_path=RESPONSE_FILTER_PATH))
+
+
+async def run_search_async(aes, es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    run_search on the shared AsyncElasticsearch client (utils/async_clients). Query/parameter building (which may call the
+    embedding services synchronously) runs in a worker thread.
+    """
+    if searchtype == "Hybrid Fusion":
+        return await fused_search_async(aes, es, user_query, rrf_rank_constant, rrf_window_size)
+
+    if local_vector_index_mode == "prefer":
+        results = await asyncio.to_thread(local_vector_search, es, user_query, searchtype)
+        if results is not None:
+            return results
+
+    try:
+        return await _run_es_search_async(aes, es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
+    except (ConnectionTimeout, ConnectionError):
+        results = None
+        if local_vector_index_mode == "fallback":
+            results = await asyncio.to_thread(local_vector_search, es, user_query, searchtype, False)
+        if results is None:
+            raise
+        print(f"Elasticsearch search failed, served {searchtype} from the local vector index")
+        return results
+
+
+async def _run_es_search_async(aes, es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    # Batched searches share the sync batcher's msearch calls with every other session, sync or async
+    batcher = get_search_batcher(es) if use_msearch_batching else None
+
+    template_id = template_id_for(searchtype) if use_search_templates else None
+    if template_id:
+        params = await asyncio.to_thread(build_search_params, es, user_query, searchtype, rrf_rank_constant,
+                                         rrf_window_size)
+        try:
+            if batcher:
+                return normalize_search_response(
+                    await batcher.search_template_async(byom_index_name, template_id, params))
+            return normalize_search_response(await on_client_loop(aes.search_template(
+                index=byom_index_name, id=template_id, params=params, filter_path=RESPONSE_FILTER_PATH)))
+        except (NotFoundError, BadRequestError) as e:
+            if not is_missing_template_error(e.status_code, e.body):
+                raise
+            mark_template_missing(template_id)
+        except MSearchItemError as e:
+            if not is_missing_template_error(e.status, e.error):
+                raise
+            mark_template_missing(template_id)
+
+    query = apply_response_options(await asyncio.to_thread(build_search_query, es, user_query, searchtype,
+                                                           rrf_rank_constant, rrf_window_size), searchtype)
+    if batcher:
+        return normalize_search_response(await batcher.search_async(byom_index_name, query))
+    return normalize_search_response(await on_client_loop(aes.search(index=byom_index_name, body=query,
+                                                                     filter_path=RESPONSE_FILTER_PATH)))
 
 
 def search_products_v2(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
-    # Select the appropriate query building function based on searchtype
-    if searchtype == "Vector":
-        query = build_knn_query(user_query, build_vector(es, user_query))
-    elif searchtype == "BM25":
-        query = build_bm25_query(user_query)
-    elif searchtype == "Reciprocal Rank Fusion":
-        query = build_rrf_query(build_vector(es, user_query), user_query, rrf_rank_constant, rrf_window_size)
-    elif searchtype == "Elser":
-        query = build_elser_query(user_query)
-    elif searchtype == "Vector OpenAI":
-        # query = build_openai_query(get_embedding(user_query), run_ner_inference(es, user_query))
-        query = build_openai_query(get_embedding(user_query), find_color_in_text(user_query),
-                                   find_os_in_text(user_query))
+    results = run_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
 
-    elif searchtype == "GenAI":
-        print("GenAI Search Only")
-    else:
-        raise ValueError(f"Invalid searchtype: {searchtype}")
+    return collect_titles(results)
+
+
+def search_titles(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    The titles search_products_v2 would add to st.session_state.titles, without touching session state
+    (see speech_recognition_package/answer_pipeline.py).
+    """
+    results = run_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
 
-    results = es.search(index=byom_index_name, body=query, _source=True)
+    return titles_from_response(results)
 
-    # Set a default value for num_results
-    num_results = 0
 
-    if results and results.get('hits') and results['hits'].get('hits'):
-        # Limit the number of results displayed
+async def search_titles_async(aes, es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    search_titles on an AsyncElasticsearch client, so other pipeline steps keep running.
+    """
+    results = await run_search_async(aes, es, user_query, searchtype, rrf_rank_constant, rrf_window_size)
 
-        num_results = min(5, len(results['hits']['hits']))
+    return titles_from_response(results)
 
-        for i in range(num_results):
-            if results['hits']['hits'][i]["_source"].get("passages") and len(
-                    results['hits']['hits'][i]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][i]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
 
-            print(first_passage_text)
+def titles_from_response(results):
+    hits = hits_from_response(results, 5)
+    print_first_passages(hits)
+
+    # Process up to the first 3 results
+    return [" Movie Title: " + hit.title for hit in hits[:3]]
 
-    else:
-        print("No results found.")
 
-    blog_bodies = []
-    urls = []
-    titles = []
-    passages_texts = []
-    scores = []
-
-    # Check if there are any hits
-    if results['hits']['hits']:
-        # Process up to the first 3 results
-        for hit in results['hits']['hits'][:3]:  # Limit to first 3 results
-            source = hit["_source"]
-
-            # Extract and accumulate the body content
-            blog_body = source.get("body_content", "No body content available")
-            blog_bodies.append(blog_body)
-
-            # Extract and accumulate the URL, preferring 'additional_urls' if available and non-empty
-            additional_urls = source.get("additional_urls", [])
-            url = additional_urls[0] if additional_urls else source.get("url", "No URL available")
-            urls.append(url)
-
-            # Extract and accumulate the title
-            title = source.get("title", "No title available")
-
-            st.session_state.titles.append(" Movie Title: " + title)
-
-            # Extract and accumulate the first passage text if passages exist and are non-empty
-            passages = source.get("passages", [])
-            first_passage_text = passages[0].get("text",
-                                                 "No passages text available") if passages else "No passages available"
-            passages_texts.append(first_passage_text)
-
-            # Extract and accumulate the score
-            score = hit["_score"]
-            scores.append(score)
+def collect_titles(results):
+    titles = titles_from_response(results)
+    st.session_state.titles.extend(titles)
 
     return titles
@@ -0,0 +1,298 @@
+##Pre-built query skeletons for each search type in utils/query_helper.
+##Skeletons are built once at import; rendering copies only the dicts/lists on the path to each slot
+##(user text, vector, boosts) and shares everything else, so per-query build cost stays flat.
+
+import json
+import logging
+
+from variables import vector_embedding_field, model
+
+logger = logging.getLogger(__name__)
+
+ELSER_PASSAGE_MODEL = ".elser_model_2_linux-x86_64"
+
+
+class QueryTemplate:
+    """
+    A query skeleton plus named slot paths (tuples of dict keys / list indexes) into it.
+
+    render(**values) returns a query where the slots hold the given values. Containers on slot paths
+    are fresh copies; the rest of the skeleton is shared between renders, so rendered queries must be
+    treated as read-only apart from those paths.
+    """
+
+    def __init__(self, skeleton, slots):
+        self.skeleton = skeleton
+        self.slots = slots
+
+    def render(self, **values):
+        query = dict(self.skeleton)
+        copied = {id(query)}
+        for name, path in self.slots.items():
+            node = query
+            for key in path[:-1]:
+                child = node[key]
+                if id(child) not in copied:
+                    child = dict(child) if isinstance(child, dict) else list(child)
+                    node[key] = child
+                    copied.add(id(child))
+                node = child
+            node[path[-1]] = values[name]
+        return query
+
+
+def _elide_vectors(value):
+    # Replace long numeric lists (embeddings) with a short placeholder for logging
+    if isinstance(value, dict):
+        return {k: _elide_vectors(v) for k, v in value.items()}
+    if isinstance(value, list):
+        if len(value) > 8 and all(isinstance(v, (int, float)) for v in value[:8]):
+            return f"<{len(value)} floats>"
+        return [_elide_vectors(v) for v in value]
+    return value
+
+
+def debug_dump_query(query):
+    """
+    Log the assembled query at DEBUG level with vectors elided. Costs nothing when DEBUG is off.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(_elide_vectors(query), indent=4))
+
+
+# Only the fields the result consumers read; passage vectors and ELSER token maps stay on the server
+HIT_SOURCE = {
+    "includes": ["title", "url", "additional_urls", "body_content", "passages.text"],
+    "excludes": ["passages.vector", "passages.content_embedding", "text_embedding", "content_embedding"]
+}
+
+# Per-searchtype _source filtering and size, matched to the hits actually consumed (at most 5)
+SEARCH_RESPONSE_OPTIONS = {
+    "BM25": {"_source": HIT_SOURCE, "size": 5},
+    "Vector": {"_source": HIT_SOURCE, "size": 5},
+    "Reciprocal Rank Fusion": {"_source": HIT_SOURCE, "size": 5},
+    "Elser": {"_source": HIT_SOURCE, "size": 5},
+    "Vector OpenAI": {"_source": HIT_SOURCE, "size": 5},
+}
+
+# Response envelope kept by filter_path; shards, hit metadata and max_score are dropped
+RESPONSE_FILTER_PATH = ["took", "hits.hits._id", "hits.hits._score", "hits.hits._source", "hits.hits.inner_hits"]
+
+# Same for the per-retriever responses of a fusion msearch; "took" keeps every entry so they stay aligned
+MSEARCH_FILTER_PATH = ["responses.took", "responses.error", "responses.hits.hits._id", "responses.hits.hits._score",
+                       "responses.hits.hits._source"]
+
+
+BM25_TEMPLATE = QueryTemplate(
+    {
+        "size": 5,  # Specify the number of results to return
+        "query": {
+            "bool": {
+                "should": [
+                    {
+                        "query_string": {
+                            "default_field": "body_content",
+                            "query": None
+                        }
+                    }
+                ]
+            }
+        }
+    },
+    {"user_query": ("query", "bool", "should", 0, "query_string", "query")}
+)
+
+OPENAI_HYBRID_TEMPLATE = QueryTemplate(
+    {
+        "query": {
+            "bool": {
+                "must": {
+                    "match": {
+                        "combined_relevancy": {
+                            "query": None,
+                            "boost": None
+                        }
+                    }
+                },
+                "filter": []
+            }
+        },
+        "knn": {
+            "field": vector_embedding_field,  # Field containing the OpenAI embeddings
+            "k": 10,
+            "num_candidates": 100,
+            "query_vector": None,
+            "boost": None
+        }
+    },
+    {
+        "user_query": ("query", "bool", "must", "match", "combined_relevancy", "query"),
+        "bm25_boost": ("query", "bool", "must", "match", "combined_relevancy", "boost"),
+        "embeddings": ("knn", "query_vector"),
+        "knn_boost": ("knn", "boost")
+    }
+)
+
+HYBRID_TEMPLATE = QueryTemplate(
+    {
+        "query": {
+            "bool": {
+                "must": {
+                    "match": {
+                        "text": None
+                    }
+                },
+                "filter": []
+            }
+        },
+        "knn": {
+            "field": vector_embedding_field,
+            "k": 10,
+            "num_candidates": 100,
+            "query_vector_builder": {
+                "text_embedding": {
+                    "model_id": model,
+                    "model_text": None
+                }
+            },
+            "boost": None
+        }
+    },
+    {
+        "user_query": ("query", "bool", "must", "match", "text"),
+        "model_text": ("knn", "query_vector_builder", "text_embedding", "model_text"),
+        "knn_boost": ("knn", "boost")
+    }
+)
+
+KNN_TEMPLATE = QueryTemplate(
+    {
+        "query": {
+            "nested": {
+                "path": "passages",
+                "query": {
+                    "knn": {
+                        "query_vector": None,
+                        "field": "passages.vector.predicted_value",
+                        "num_candidates": 2
+                    }
+                },
+                "inner_hits": {
+                    "_source": [
+                        "passages.text"
+                    ]
+                }
+            }
+        }
+    },
+    {"query_vector": ("query", "nested", "query", "knn", "query_vector")}
+)
+
+# Nested kNN retriever for client-side fusion: no inner_hits and a candidate pool sized per query
+FUSION_KNN_TEMPLATE = QueryTemplate(
+    {
+        "query": {
+            "nested": {
+                "path": "passages",
+                "query": {
+                    "knn": {
+                        "query_vector": None,
+                        "field": "passages.vector.predicted_value",
+                        "num_candidates": None
+                    }
+                }
+            }
+        }
+    },
+    {
+        "query_vector": ("query", "nested", "query", "knn", "query_vector"),
+        "num_candidates": ("query", "nested", "query", "knn", "num_candidates")
+    }
+)
+
+ELSER_NESTED_QUERY = {
+    "nested": {
+        "path": "passages",
+        "query": {
+            "bool": {
+                "should": [
+                    {
+                        "text_expansion": {
+                            "passages.content_embedding.predicted_value": {
+                                "model_id": ELSER_PASSAGE_MODEL,
+                                "model_text": None
+                            }
+                        }
+                    }
+                ]
+            }
+        }
+    }
+}
+
+ELSER_TEXT_PATH = ("nested", "query", "bool", "should", 0, "text_expansion",
+                   "passages.content_embedding.predicted_value", "model_text")
+
+RRF_TEMPLATE = QueryTemplate(
+    {
+        "sub_searches": [
+            {
+                "query": {
+                    "match": {
+                        "body_content": None
+                    }
+                }
+            },
+            {
+                "query": {
+                    "nested": {
+                        "path": "passages",
+                        "query": {
+                            "knn": {
+                                "query_vector": None,
+                                "field": "passages.vector.predicted_value",
+                                "num_candidates": 50
+                            }
+                        }
+                    }
+                }
+            },
+            {
+                "query": ELSER_NESTED_QUERY
+            }
+        ],
+        "rank": {
+            "rrf": {
+                "window_size": None,
+                "rank_constant": None
+            }
+        }
+    },
+    {
+        "user_query": ("sub_searches", 0, "query", "match", "body_content"),
+        "embeddings": ("sub_searches", 1, "query", "nested", "query", "knn", "query_vector"),
+        "elser_text": ("sub_searches", 2, "query") + ELSER_TEXT_PATH,
+        "window_size": ("rank", "rrf", "window_size"),
+        "rank_constant": ("rank", "rrf", "rank_constant")
+    }
+)
+
+ELSER_TEMPLATE = QueryTemplate(
+    {
+        "size": 5,
+        "query": ELSER_NESTED_QUERY
+    },
+    {"user_query": ("query",) + ELSER_TEXT_PATH}
+)
+
+OPENAI_KNN_TEMPLATE = QueryTemplate(
+    {
+        "knn": {
+            "field": vector_embedding_field,  # Field containing the OpenAI embeddings
+            "k": 10,
+            "num_candidates": 100,
+            "query_vector": None
+        }
+    },
+    {"embeddings": ("knn", "query_vector")}
+)
@@ -0,0 +1,199 @@
+##Shared client-side rate limiting for Azure OpenAI deployments.
+##Each deployment gets a requests-per-minute and a tokens-per-minute token bucket. The effective rate
+##backs off multiplicatively on 429s (honoring Retry-After) and recovers additively on success (AIMD),
+##so callers run close to the quota ceiling instead of sleeping a fixed amount after every call.
+
+import asyncio
+import threading
+import time
+
+import openai
+
+from variables import default_rate_limit, rate_limits
+
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate (~4 characters per token) used to charge the tokens-per-minute bucket.
+    """
+    if isinstance(text, (list, tuple)):
+        return sum(estimate_tokens(t) for t in text)
+    if isinstance(text, dict):
+        return estimate_tokens(text.get('content', ''))
+    return max(1, len(str(text)) // 4)
+
+
+def retry_after_seconds(error, default=1.0):
+    """
+    Read Retry-After (or retry-after-ms) from an OpenAI error response, falling back to default.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return default
+
+
+def is_rate_limit_error(error):
+    """
+    True if the exception is a 429 from the OpenAI client.
+    """
+    if isinstance(error, getattr(openai, 'RateLimitError', ())):
+        return True
+    return getattr(error, 'status_code', None) == 429
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at rate_per_minute, holding at most one minute of capacity.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_minute = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_minute / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Requests larger than the bucket are allowed once it is full, otherwise they would never run
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.rate_per_minute
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter with AIMD backoff on 429 responses.
+
+    Parameters:
+    - rpm: Requests-per-minute quota of the deployment.
+    - tpm: Tokens-per-minute quota of the deployment.
+    - min_fraction: Lowest fraction of the quota the limiter backs off to.
+    - decrease_factor: Multiplier applied to the current rate on each 429.
+    - increase_fraction: Fraction of the quota added back after each successful call.
+    """
+
+    def __init__(self, rpm, tpm, min_fraction=0.1, decrease_factor=0.5, increase_fraction=0.02):
+        self.max_rpm = rpm
+        self.max_tpm = tpm
+        self.min_fraction = min_fraction
+        self.decrease_factor = decrease_factor
+        self.increase_fraction = increase_fraction
+        self.fraction = 1.0
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _apply_fraction(self):
+        self.requests.rate_per_minute = self.max_rpm * self.fraction
+        self.tokens.rate_per_minute = self.max_tpm * self.fraction
+
+    def _try_acquire(self, tokens):
+        # Consume one request and `tokens` tokens if available, otherwise return how long to wait
+        with self.lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            wait = max(self.blocked_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait <= 0:
+                self.requests.tokens -= 1
+                self.tokens.tokens -= min(tokens, self.tokens.capacity)
+            return wait
+
+    def acquire(self, tokens=1):
+        """
+        Block until one request and `tokens` tokens are available, then consume them.
+        """
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """
+        Same as acquire, but waits with asyncio.sleep so the event loop keeps running.
+        """
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        """
+        Additive increase back towards the full quota.
+        """
+        with self.lock:
+            if self.fraction < 1.0:
+                self.fraction = min(1.0, self.fraction + self.increase_fraction)
+                self._apply_fraction()
+
+    def on_rate_limited(self, retry_after=None):
+        """
+        Multiplicative decrease, and pause every caller until Retry-After has elapsed.
+        """
+        with self.lock:
+            self.fraction = max(self.min_fraction, self.fraction * self.decrease_factor)
+            self._apply_fraction()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            print(f"Rate limited: backing off to {self.fraction:.0%} of quota, retry after {retry_after}s")
+
+    def call(self, fn, tokens=1, retry_attempts=5):
+        """
+        Run fn() under the limiter, retrying on 429 up to retry_attempts times.
+        """
+        for attempt in range(retry_attempts):
+            self.acquire(tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                if is_rate_limit_error(e) and attempt < retry_attempts - 1:
+                    self.on_rate_limited(retry_after_seconds(e))
+                    continue
+                raise
+            self.on_success()
+            return result
+
+    async def call_async(self, fn, tokens=1, retry_attempts=5):
+        """
+        Await fn() under the limiter, retrying on 429 up to retry_attempts times.
+        """
+        for attempt in range(retry_attempts):
+            await self.acquire_async(tokens)
+            try:
+                result = await fn()
+            except Exception as e:
+                if is_rate_limit_error(e) and attempt < retry_attempts - 1:
+                    self.on_rate_limited(retry_after_seconds(e))
+                    continue
+                raise
+            self.on_success()
+            return result
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(deployment_name):
+    """
+    Return the process-wide limiter for a deployment, creating it from variables.rate_limits on first use.
+    """
+    with _limiters_lock:
+        if deployment_name not in _limiters:
+            rpm, tpm = rate_limits.get(deployment_name, default_rate_limit)
+            _limiters[deployment_name] = RateLimiter(rpm, tpm)
+        return _limiters[deployment_name]
@@ -0,0 +1,205 @@
+##Micro-batching of searches across Streamlit sessions (kiosks). Requests arriving within a short
+##window are coalesced into one _msearch / _msearch/template call and the responses fanned back out,
+##so many concurrent sessions cost one HTTP round-trip per window instead of one per search.
+##Sync callers block on a Future, async callers await it; both give up after the client's request timeout.
+
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import streamlit as st
+from elasticsearch import ConnectionTimeout
+
+from utils.query_templates import RESPONSE_FILTER_PATH
+from variables import msearch_batch_window_ms, msearch_max_batch_size, es_request_timeout
+
+logger = logging.getLogger(__name__)
+
+# Per-item responses keep status/error so failures can be mapped back to the caller
+MSEARCH_ITEM_FILTER_PATH = ["responses.status", "responses.error"] + [f"responses.{path}" for path in
+                                                                     RESPONSE_FILTER_PATH]
+
+
+class MSearchItemError(Exception):
+    """
+    An individual search inside a batched msearch failed.
+    """
+
+    def __init__(self, status, error):
+        super().__init__(f"msearch item failed with status {status}: {error}")
+        self.status = status
+        self.error = error
+
+
+class MSearchBatcher:
+    """
+    Coalesces search and search-template requests into msearch calls on a background thread.
+
+    Parameters:
+    - es: Elasticsearch client.
+    - window_ms: How long the first request of a batch waits for others to join.
+    - max_batch_size: A batch is sent as soon as it reaches this many requests.
+    - request_timeout: Seconds a caller waits for its response (on top of the batching window) before
+      ConnectionTimeout is raised, as the client itself would.
+    """
+
+    def __init__(self, es, window_ms=5, max_batch_size=32, request_timeout=30):
+        self.es = es
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.timeout = request_timeout + self.window
+        self.pending = []
+        self.in_flight = []
+        self.condition = threading.Condition()
+        self.batch_sizes = Counter()
+        self.thread = None
+        self._start()
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run, name="msearch-batcher", daemon=True)
+        self.thread.start()
+
+    def search(self, index, body):
+        """
+        Queue a search and block until its response is available.
+        """
+        return self._wait(self._submit("search", index, body))
+
+    def search_template(self, index, template_id, params):
+        """
+        Queue a stored-template search and block until its response is available.
+        """
+        return self._wait(self._submit("template", index, {"id": template_id, "params": params}))
+
+    async def search_async(self, index, body):
+        """
+        Queue a search and await its response without blocking the event loop.
+        """
+        return await self._wait_async(self._submit("search", index, body))
+
+    async def search_template_async(self, index, template_id, params):
+        """
+        Queue a stored-template search and await its response without blocking the event loop.
+        """
+        return await self._wait_async(self._submit("template", index, {"id": template_id, "params": params}))
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise ConnectionTimeout(f"msearch batch did not answer within {self.timeout:.1f}s")
+
+    async def _wait_async(self, future):
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionTimeout(f"msearch batch did not answer within {self.timeout:.1f}s")
+
+    def _submit(self, kind, index, body):
+        future = Future()
+        with self.condition:
+            # Restart the worker if it died, instead of queueing requests nobody will send
+            if not self.thread.is_alive():
+                logger.warning("msearch batcher thread stopped, restarting it")
+                self._start()
+            self.pending.append((kind, index, body, future))
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        try:
+            self._batch_loop()
+        except Exception as e:
+            logger.exception("msearch batcher stopped")
+            # Fail everything the dead worker owned so callers don't wait out their timeout
+            with self.condition:
+                stranded = self.in_flight + self.pending
+                self.in_flight = []
+                self.pending = []
+            for *_, future in stranded:
+                _resolve(future, error=e)
+
+    def _batch_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # Wait out the batching window unless the batch fills up first
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_batch_size]
+                self.pending = self.pending[self.max_batch_size:]
+                self.in_flight = batch
+
+            self.batch_sizes[len(batch)] += 1
+            for kind in ("search", "template"):
+                items = [item for item in batch if item[0] == kind]
+                if items:
+                    self._dispatch(kind, items)
+            with self.condition:
+                self.in_flight = []
+
+            if sum(self.batch_sizes.values()) % 100 == 0:
+                logger.info(f"msearch batching: {self.stats()}")
+
+    def _dispatch(self, kind, items):
+        searches = []
+        for _, index, body, _ in items:
+            searches.append({"index": index})
+            searches.append(body)
+
+        try:
+            if kind == "search":
+                response = self.es.msearch(searches=searches, filter_path=MSEARCH_ITEM_FILTER_PATH)
+            else:
+                response = self.es.msearch_template(search_templates=searches, filter_path=MSEARCH_ITEM_FILTER_PATH)
+        except Exception as e:
+            for *_, future in items:
+                _resolve(future, error=e)
+            return
+
+        for (*_, future), item_response in zip(items, response['responses']):
+            if 'error' in item_response:
+                _resolve(future, error=MSearchItemError(item_response.get('status'), item_response['error']))
+            else:
+                _resolve(future, item_response)
+
+    def stats(self):
+        batches = sum(self.batch_sizes.values())
+        requests = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            'batches': batches,
+            'requests': requests,
+            'mean_batch_size': requests / batches if batches else 0.0,
+            'max_batch_size': max(self.batch_sizes) if self.batch_sizes else 0,
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items()))
+        }
+
+
+def _resolve(future, result=None, error=None):
+    # Callers that timed out have cancelled their future already
+    if future.cancelled() or future.done():
+        return
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except Exception:  # cancelled in between
+        pass
+
+
+@st.cache_resource
+def get_search_batcher(_es):
+    """
+    Process-wide batcher shared by every session, so searches from different kiosks coalesce.
+    """
+    return MSearchBatcher(_es, msearch_batch_window_ms, msearch_max_batch_size, es_request_timeout)
@@ -0,0 +1,99 @@
+##Mustache search templates stored in Elasticsearch, one per searchtype of search_products_v2.
+##They are generated from the skeletons in utils/query_templates, so the stored and inline bodies
+##cannot drift apart. Searches then send only the template id and parameters.
+
+import json
+import logging
+
+from elasticsearch import ApiError
+
+from utils.query_templates import BM25_TEMPLATE, KNN_TEMPLATE, RRF_TEMPLATE, ELSER_TEMPLATE, OPENAI_KNN_TEMPLATE, \
+    SEARCH_RESPONSE_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TEMPLATE_IDS = {
+    "BM25": "movie-search-bm25",
+    "Vector": "movie-search-vector",
+    "Reciprocal Rank Fusion": "movie-search-rrf",
+    "Elser": "movie-search-elser",
+    "Vector OpenAI": "movie-search-vector-openai",
+}
+
+# Template ids known to be stored in the cluster; filled by register_search_templates
+registered_templates = set()
+
+
+def _mustache_source(template, searchtype, extra_slots=()):
+    # Render every slot with a sentinel, then swap the quoted sentinels for {{#toJson}} tags so
+    # parameters of any type (text, vectors, filters) are serialized correctly by the cluster
+    names = list(template.slots) + [name for name, _ in extra_slots]
+    query = template.render(**{name: f"__slot_{name}__" for name in template.slots})
+    query.update(SEARCH_RESPONSE_OPTIONS[searchtype])
+    for name, path in extra_slots:
+        node = query
+        for key in path[:-1]:
+            node = node[key]
+        node[path[-1]] = f"__slot_{name}__"
+
+    source = json.dumps(query)
+    for name in names:
+        source = source.replace(f'"__slot_{name}__"', "{{#toJson}}" + name + "{{/toJson}}")
+    return source
+
+
+def build_search_template_sources():
+    """
+    Mustache sources keyed by template id.
+    """
+    return {
+        SEARCH_TEMPLATE_IDS["BM25"]: _mustache_source(BM25_TEMPLATE, "BM25"),
+        SEARCH_TEMPLATE_IDS["Vector"]: _mustache_source(KNN_TEMPLATE, "Vector"),
+        SEARCH_TEMPLATE_IDS["Reciprocal Rank Fusion"]: _mustache_source(RRF_TEMPLATE, "Reciprocal Rank Fusion"),
+        SEARCH_TEMPLATE_IDS["Elser"]: _mustache_source(ELSER_TEMPLATE, "Elser"),
+        # render() copied "knn", so the extra filter slot can be added to it
+        SEARCH_TEMPLATE_IDS["Vector OpenAI"]: _mustache_source(OPENAI_KNN_TEMPLATE, "Vector OpenAI",
+                                                               [("filter", ("knn", "filter"))]),
+    }
+
+
+def register_search_templates(es):
+    """
+    Store a search template per searchtype. Failures are logged and leave that searchtype on the
+    inline-body path.
+    """
+    for template_id, source in build_search_template_sources().items():
+        try:
+            es.put_script(id=template_id, script={"lang": "mustache", "source": source})
+            registered_templates.add(template_id)
+            print(f"Search template {template_id} registered")
+        except ApiError as e:
+            registered_templates.discard(template_id)
+            print(f"Failed to register search template {template_id}: {e}")
+
+    return registered_templates
+
+
+def template_id_for(searchtype):
+    """
+    The registered template id for a searchtype, or None if searches must use inline bodies.
+    """
+    template_id = SEARCH_TEMPLATE_IDS.get(searchtype)
+    return template_id if template_id in registered_templates else None
+
+
+def is_missing_template_error(status, error):
+    """
+    Whether a failed search-template call means the stored template is gone: a 404, or the 400
+    "unable to find script" some cluster versions return. Other 400s (parse errors, license checks)
+    would fail the same way inline and must not drop the template.
+    """
+    if status == 404:
+        return True
+    text = str(error).lower()
+    return status == 400 and ("unable to find script" in text or "resource_not_found_exception" in text)
+
+
+def mark_template_missing(template_id):
+    logger.warning(f"Search template {template_id} missing, falling back to inline query bodies")
+    registered_templates.discard(template_id)
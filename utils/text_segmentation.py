@@ -0,0 +1,7 @@
+##Sentence splitting shared by passage chunking (utils/movie_ingest.py) and avatar speech
+##segmentation (avatar/avatar_helper.py).
+
+import re
+
+# The movie-chunker split: ". ", "! " or "? ", but not after Mr./Ms./Mrs.
+SENTENCE_BOUNDARY = re.compile(r"(?<!Mr\.)(?<!Ms\.)(?<!Mrs\.)(?<=[.!?]) ")
@@ -0,0 +1,120 @@
+##Int8, int4 and binary quantization for the local vector index, plus the Elasticsearch mapping side
+##(quantized dense_vector index_options). Quantized vectors are only used to pick candidates;
+##final scores are recomputed on the full-precision vectors (rescoring).
+##The LLM cache's semantic matrix and the embedding disk store stay float32: the first holds at most
+##llm_cache_local_size prompts (1.5 MB at 768 dims) and compares scores against a similarity
+##threshold, the second returns exact query vectors that are sent on to Elasticsearch.
+
+import numpy as np
+
+QUANTIZATION_METHODS = ("int8", "int4", "binary")
+
+# Elasticsearch dense_vector index_options type per quantization method
+ES_INDEX_TYPES = {
+    "int8": "int8_hnsw",
+    "int4": "int4_hnsw",
+    "binary": "bbq_hnsw",
+}
+
+# Rows per block when scoring int8/int4 codes: each block is widened to float32 on its own, so the
+# temporary stays in cache instead of materializing a float32 copy of the whole matrix
+SCORE_BLOCK_ROWS = 512
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def quantize_dense_vector_mappings(mappings, method):
+    """
+    Return a copy of index mappings where every dense_vector field uses the quantized HNSW index type
+    for method ("int8", "int4" or "binary").
+    """
+    if isinstance(mappings, dict):
+        mappings = {key: quantize_dense_vector_mappings(value, method) for key, value in mappings.items()}
+        if mappings.get("type") == "dense_vector":
+            mappings["index"] = True
+            mappings["index_options"] = dict(mappings.get("index_options", {}), type=ES_INDEX_TYPES[method])
+    return mappings
+
+
+class QuantizedVectors:
+    """
+    A quantized copy of a float32 matrix used for candidate selection.
+
+    - int8: each row scaled by max(|x|) / 127 and rounded, 4x smaller than float32.
+    - int4: each row scaled by max(|x|) / 7 and rounded, two dimensions packed per byte; 8x smaller.
+    - binary: one sign bit per dimension, packed, scored by Hamming similarity; 32x smaller. Its
+      ranking is much coarser, so it needs a far larger oversample for the same recall after rescoring
+      (variables.local_vector_index_binary_oversample; see vector_quantization_benchmark.py).
+    """
+
+    def __init__(self, matrix, method):
+        if method not in QUANTIZATION_METHODS:
+            raise ValueError(f"Invalid quantization method: {method}")
+        self.method = method
+        self.dims = matrix.shape[1]
+        if method in ("int8", "int4"):
+            levels = 127 if method == "int8" else 7
+            scales = np.abs(matrix).max(axis=1)
+            self.scales = np.where(scales > 0, scales / levels, 1.0).astype(np.float32)
+            self.codes = np.round(matrix / self.scales[:, None]).astype(np.int8)
+            if method == "int4":
+                self.codes = _pack_int4(self.codes)
+        else:
+            self.scales = None
+            self.codes = np.packbits(matrix > 0, axis=1)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def approximate_scores(self, query):
+        if self.method == "int8":
+            query = query.astype(np.float32)
+            scores = np.empty(len(self.codes), dtype=np.float32)
+            for start in range(0, len(self.codes), SCORE_BLOCK_ROWS):
+                block = self.codes[start:start + SCORE_BLOCK_ROWS]
+                scores[start:start + SCORE_BLOCK_ROWS] = block.astype(np.float32) @ query
+            return scores * self.scales
+        if self.method == "int4":
+            # Low nibbles hold the even dimensions, high nibbles the odd ones
+            padded = np.zeros(2 * self.codes.shape[1], dtype=np.float32)
+            padded[:self.dims] = query
+            even, odd = padded[0::2], padded[1::2]
+            scores = np.empty(len(self.codes), dtype=np.float32)
+            for start in range(0, len(self.codes), SCORE_BLOCK_ROWS):
+                low, high = _unpack_int4(self.codes[start:start + SCORE_BLOCK_ROWS])
+                scores[start:start + SCORE_BLOCK_ROWS] = low @ even + high @ odd
+            return scores * self.scales
+        query_bits = np.packbits(query > 0)
+        hamming = _POPCOUNT[np.bitwise_xor(self.codes, query_bits)].sum(axis=1, dtype=np.int32)
+        return self.dims - 2 * hamming
+
+    def candidates(self, query, count):
+        """
+        Row numbers of the `count` best rows by approximate score (unordered).
+        """
+        scores = self.approximate_scores(query)
+        count = min(count, len(scores))
+        return np.argpartition(-scores, count - 1)[:count]
+
+
+def _pack_int4(codes):
+    # Two's complement nibbles, dimension 2i in the low and 2i + 1 in the high nibble of byte i
+    if codes.shape[1] % 2:
+        codes = np.pad(codes, ((0, 0), (0, 1)))
+    nibbles = codes.astype(np.uint8) & 0x0F
+    return nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+
+def _unpack_int4(packed):
+    # Arithmetic shifts on the bytes as int8 sign-extend each nibble
+    signed = packed.view(np.int8)
+    return ((signed << 4) >> 4).astype(np.float32), (signed >> 4).astype(np.float32)
+
+
+def rescore(matrix, rows, query):
+    """
+    Exact dot products for candidate rows only; with a memory-mapped matrix just those rows are read.
+    """
+    rows = np.sort(rows)
+    return rows, np.asarray(matrix[rows]) @ query
@@ -24,16 +24,105 @@ DESCRIPTION = "Movie avatar"
 SUBSCRIPTION_KEY = st.secrets['speech_key']
 SERVICE_REGION = st.secrets['speech_region']
 
+# Talking avatar settings, also part of the avatar video cache key
+avatar_voice = "en-US-JennyNeural"
+avatar_character = "lisa"
+avatar_style = "casual-sitting"
+avatar_video_format = "mp4"
+avatar_video_cache_file = ".cache/avatar_videos.json"
+avatar_video_cache_dir = None  # set to a directory to also keep local copies of the videos
+avatar_video_cache_ttl = 24 * 3600  # seconds; keep at or below the service's output retention
+avatar_poll_initial_interval = 1.0  # seconds between status checks right after a status change
+avatar_poll_max_interval = 10.0  # upper bound while a job sits in the same status
+avatar_poll_backoff = 1.5
+avatar_poll_deadline = 600  # give up on a job after this many seconds
+avatar_segmented = True  # split long responses into sentence-bounded segments synthesized in parallel
+avatar_segment_max_chars = 300
 
 
+
+# Shared Elasticsearch client (see utils/es_helper.get_es_client)
+es_connections_per_node = 25
+es_request_timeout = 30  # seconds
+es_max_retries = 3
+es_retry_on_timeout = True
+es_http_compress = True
+
 byom_index_name = 'movies_inferred'
+hit_body_max_chars = 4000  # body_content truncation for prompts (see utils/movie_hit.MovieHit)
+hit_passage_max_chars = 1000
+# Client-side hybrid fusion, used by the "Hybrid Fusion" searchtype (utils/fusion.py)
+fusion_retrievers = ["bm25", "knn", "elser"]  # any of bm25, knn (MiniLM), knn_openai (ada-002), elser
+fusion_method = "rrf"  # rrf, weighted or convex
+fusion_weights = None  # one weight per retriever, None for equal weights
+# Coalesce searches from concurrent sessions into _msearch calls (utils/search_batcher.py)
+use_msearch_batching = False
+msearch_batch_window_ms = 5
+msearch_max_batch_size = 32
+# In-process vector index for "Vector"/"Vector OpenAI" (utils/local_vector_index.py)
+local_vector_index_mode = "fallback"  # off, prefer (always local when built) or fallback (when ES fails)
+local_vector_index_dir = ".cache/vector_index"
+local_vector_index_hnsw = False  # approximate search with hnswlib instead of exact dot products
+local_vector_index_quantization = None  # None, "int8", "int4" or "binary" candidate selection (utils/vector_quantization.py)
+local_vector_index_oversample = 4  # int8/int4 candidates per result before full-precision rescoring
+# Binary codes rank coarsely: at 4x, recall@10 after rescoring is ~0.3 on unstructured vectors, so binary
+# candidate selection oversamples more (measure on the real index with vector_quantization_benchmark.py)
+local_vector_index_binary_oversample = 20
+# sentence-transformers model that embeds "Vector" queries locally, matching the ES ML node's `model` below
+local_embedding_model = "sentence-transformers/all-MiniLM-L6-v2"
+# Quantized dense_vector index_options for manage_index: None, "int8", "int4" or "binary"
+vector_index_quantization = None
+use_search_templates = True  # search via stored mustache templates registered at startup (utils/search_templates)
 number_of_dims = 768
 similarity = "cosine"
-rate_throttle = .2
+rate_throttle = .2  # superseded by the rate_limits buckets below, kept for older scripts
+# Per-deployment Azure OpenAI quotas as (requests per minute, tokens per minute), see utils/rate_limiter.py
+rate_limits = {
+    openai_embedding_deployment_name: (720, 120000),
+    openai_completion_deployment_name: (720, 120000),
+    azure_client_deployment_name: (720, 120000),
+    "gpt-35-turbo": (720, 120000),
+}
+default_rate_limit = (300, 60000)
+# Conversation history budget for st.session_state.messages / avatar_messages (16k context model)
+history_max_tokens = 12000  # leaves room for the completion
+history_summarize = False  # fold evicted turns into a rolling summary (one extra completion per eviction)
+tiktoken_encoding = "cl100k_base"
+
+# Query-embedding cache (see utils/embedding_cache.py)
+embedding_cache_size = 1024  # vectors kept in memory
+embedding_cache_ttl = 24 * 3600  # seconds
+embedding_cache_dir = None  # e.g. ".cache/embeddings" to persist vectors across restarts
+# Streaming re-embed settings (see utils/openai_embedder.process_documents_streaming)
+embedding_batch_size = 16  # texts per embeddings.create call
+embedding_max_workers = 4  # concurrent in-flight embedding calls
+scan_page_size = 500  # docs per scroll page
+bulk_chunk_size = 500  # docs per bulk request
+checkpoint_pit_keep_alive = "1h"  # how long after a crash a checkpointed re-embed can still resume
+# Client-side chunking + inference ingest replacing the movie-chunker pipeline (see utils/movie_ingest.py)
+ingest_model_limit = 400  # passage length limit in characters, as the pipeline's model_limit param
+ingest_doc_batch_size = 100  # movies chunked and inferred together
+ingest_inference_batch_size = 64  # passages per infer_trained_model call
+ingest_chunk_workers = None  # chunking processes, None for one per core
+ingest_inference_workers = 4  # batches with inference calls in flight
 deleteExistingIndex = True
 model='sentence-transformers__all-minilm-l6-v2'
 elser_model=".elser_model_1"
 vector_embedding_field = "text_embedding.predicted_value"
 elser_embedding_field = "ml.tokens"
+# Two-tier LLM response cache (see utils/llm_cache.py)
+llm_cache_index_name = "llm_cache"
+llm_cache_local_size = 512  # responses kept in process
+llm_cache_flush_interval = 1.0  # seconds between background bulk writes to llm_cache
+llm_cache_flush_size = 32
+# SimHash bits of the prompt embedding in the cache context fingerprint; more bits = fewer, safer hits
+llm_cache_bucket_bits = 4
+
+use_async_pipeline = True  # overlap search, cache lookup and completions per spoken question
+# Continuous recognition on a warm per-session recognizer, searching on stable partial transcripts
+use_continuous_recognition = False
+recognition_stable_partial_ms = 300  # a partial unchanged this long is searched speculatively
+recognition_timeout = 15  # seconds to wait for a question
+recognition_pool_size = 4  # concurrent recognizers for batch transcription (audio_batch.py)
 
 cache=None
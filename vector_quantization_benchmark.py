@@ -0,0 +1,65 @@
+##Recall vs memory for the quantized local vector index (utils/vector_quantization), against exact
+##float32 search. Uses the built local index when present, random unit vectors otherwise.
+##Run with: python vector_quantization_benchmark.py [minilm_passages|openai_docs]
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from utils.vector_quantization import QuantizedVectors, rescore
+from variables import local_vector_index_dir, local_vector_index_oversample, local_vector_index_binary_oversample
+
+K = 10
+QUERIES = 200
+OVERSAMPLE = {"int8": local_vector_index_oversample, "int4": local_vector_index_oversample,
+              "binary": local_vector_index_binary_oversample}
+
+
+def load_matrix(name):
+    path = os.path.join(local_vector_index_dir, f"{name}.npy")
+    if os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+    print(f"{path} not found, using random vectors")
+    matrix = np.random.default_rng(0).standard_normal((20000, 384)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def exact_top_k(matrix, query, k):
+    dots = matrix @ query
+    return set(np.argpartition(-dots, k - 1)[:k].tolist())
+
+
+def top_k(rows, scores, k):
+    order = np.argsort(-scores)[:k]
+    return set(np.asarray(rows)[order].tolist())
+
+
+def run(name="minilm_passages"):
+    matrix = load_matrix(name)
+    rng = np.random.default_rng(1)
+    # Perturbed stored vectors stand in for queries that have close but not identical matches
+    queries = np.asarray(matrix[rng.choice(len(matrix), QUERIES, replace=False)], dtype=np.float32)
+    queries += rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+    truth = [exact_top_k(matrix, query, K) for query in queries]
+
+    print(f"{len(matrix)} x {matrix.shape[1]} vectors, float32 {matrix.nbytes / 1e6:.1f} MB")
+    print(f"{'method':<10}{'MB':>8}{'recall@10':>12}{'oversample':>12}{'rescored':>12}{'ms/query':>10}")
+    for method in ("int8", "int4", "binary"):
+        quantized = QuantizedVectors(np.asarray(matrix), method)
+        raw_recall = rescored_recall = 0.0
+        start_time = time.perf_counter()
+        for query, expected in zip(queries, truth):
+            rows = quantized.candidates(query, K * OVERSAMPLE[method])
+            rescored_rows, dots = rescore(matrix, rows, query)
+            rescored_recall += len(top_k(rescored_rows, dots, K) & expected) / K
+        elapsed_ms = (time.perf_counter() - start_time) / QUERIES * 1000
+        for query, expected in zip(queries, truth):
+            raw_recall += len(set(quantized.candidates(query, K).tolist()) & expected) / K
+        print(f"{method:<10}{quantized.nbytes / 1e6:>8.1f}{raw_recall / QUERIES:>12.3f}{OVERSAMPLE[method]:>12}"
+              f"{rescored_recall / QUERIES:>12.3f}{elapsed_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
@@ -1,31 +1,26 @@
 import sys
 
 import streamlit as st
-from elasticsearch_llm_cache.elasticsearch_llm_cache import ElasticsearchLLMCache
 
 import variables
-from speech_recognition_package.speech_recognition import microphone_to_es_with_avatar
-from utils.es_helper import create_es_client
+from speech_recognition_package.speech_recognition import microphone_to_es_with_avatar, \
+    microphone_to_es_with_avatar_async, microphone_to_es_with_avatar_continuous
+from utils.es_helper import get_es_client
+from utils.llm_cache import get_llm_cache
 from utils.openai_helper import ini_chat_prompts
+from utils.search_templates import register_search_templates
 
 
 # Connect to Elasticsearch
 try:
-    username = st.secrets['es_username']
-    password = st.secrets['es_password']
-    cloudid = st.secrets['es_cloudid']
-    es = create_es_client(username, password, cloudid)
+    es = get_es_client()
 except Exception as e:
     print("Connection failed", str(e))
     st.error("Error connecting to Elasticsearch. Fix connection and restart app")
     sys.exit(1)
 
-# Init Elasticsearch Cache
-variables.cache = ElasticsearchLLMCache(
-    es_client=es,
-    index_name="llm_cache",
-    create_index=False,  # setting only because of Streamlit behavor
-)
+# Init the two-tier LLM cache (in-process tier in front of the llm_cache index)
+variables.cache = get_llm_cache(es)
 print(f"_creating Elasticsearch Cache_")
 
 ini_chat_prompts()
@@ -34,6 +29,8 @@ ini_chat_prompts()
 if "index_created" not in st.session_state:
     print("_running create_index_")
     variables.cache.create_index(768)
+    if variables.use_search_templates:
+        register_search_templates(es)
     # Set the flag so it doesn't run every time
     st.session_state.index_created = True
 else:
@@ -47,7 +44,20 @@ def main():
 
 
     if st.sidebar.button('🎙 Start', key="start", help="Start Speech Recognition"):
-        microphone_to_es_with_avatar()
+        if variables.use_continuous_recognition:
+            microphone_to_es_with_avatar_continuous()
+        elif variables.use_async_pipeline:
+            microphone_to_es_with_avatar_async()
+        else:
+            microphone_to_es_with_avatar()
+
+    # Recorded questions (WAV) go through the same pipeline as the microphone
+    recording = st.sidebar.file_uploader('Recorded question', type=["wav"])
+    if recording is not None and st.sidebar.button('▶ Ask recording', key="ask_recording"):
+        if variables.use_async_pipeline:
+            microphone_to_es_with_avatar_async(recording.getvalue())
+        else:
+            microphone_to_es_with_avatar(recording.getvalue())
 
     # Use the toggle and set its value based on the session state
     cachetoggle = st.sidebar.toggle('Activate feature', st.session_state['toggle_state'])